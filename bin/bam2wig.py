@@ -21,127 +21,153 @@ import sys, os
 import pysam
 import numpy
 import shutil
-import subprocess
 import tempfile
-import time
 from itertools import izip
 
 sys.path.insert( 0, os.path.join( os.path.dirname( __file__ ), ".." ) )
 from grit.files.reads import clean_chr_name, fix_chrm_name_for_ucsc, \
     CAGEReads, RAMPAGEReads, RNAseqReads, PolyAReads, ChIPSeqReads
-from grit.lib.multiprocessing_utils import ProcessSafeOPStream
-
-import multiprocessing
-import threading
+from grit.files.bigwig import write_bigwig, RUN_DTYPE
+from grit.lib.multiprocessing_utils import WorkStealingScheduler
 
 # if we choose the --ucsc option, then replace thsi function
 # with fix_chrm_name_for_ucsc
 def fix_chrm_name(name):
     return name
 
-BUFFER_SIZE = 50000000
+BUFFER_SIZE = 5000000
 
-def populate_cvg_array_for_contig( 
-        merged_ofp, reads, chrm, chrm_length, strand ):
-    if VERBOSE: print "Starting ", chrm, strand
-    
-    # re-open the reads to make this multi-process safe
-    reads = reads.reload()
-    
-    # open a tempory file to write this to
-    with tempfile.NamedTemporaryFile(delete=True) as ofp:
-        # only find blocks of BUFFER_SIZE - to avoid running out of memory
-        for block_index in xrange(int(chrm_length/BUFFER_SIZE)+1):
-            buffer_array = reads.build_read_coverage_array( 
-                chrm, strand, 
-                block_index*BUFFER_SIZE, 
-                (block_index+1)*BUFFER_SIZE )
-            write_array_to_opstream( 
-                ofp, buffer_array, block_index*BUFFER_SIZE, 
-                chrm, chrm_length, strand)
+def find_coverage_runs(cvg, offset):
+    """Find the runs of equal values in cvg.
 
-        ofp.seek(0)
-        merged_ofp.write( ofp.read() )
+    Returns a RUN_DTYPE array, with positions offset by offset.
+    """
+    change_pts = numpy.flatnonzero(numpy.diff(cvg)) + 1
+    runs = numpy.empty(len(change_pts)+1, dtype=RUN_DTYPE)
+    runs['start'][0] = 0
+    runs['start'][1:] = change_pts
+    runs['stop'][:-1] = change_pts
+    runs['stop'][-1] = len(cvg)
+    runs['value'] = cvg[runs['start']]
+    runs['start'] += offset
+    runs['stop'] += offset
+    return runs
+
+def iter_coverage_runs(reads, chrm, chrm_length, strand):
+    """Iterate through arrays of the non-zero coverage runs in chrm.
+
+    The coverage is built in blocks of BUFFER_SIZE bases - to avoid running
+    out of memory - and runs that span a block boundary are merged.
+    """
+    prev_run = None
+    for block_start in xrange(0, chrm_length, BUFFER_SIZE):
+        block_stop = min(block_start+BUFFER_SIZE, chrm_length)
+        cvg = reads.build_read_coverage_array(
+            chrm, strand, block_start, block_stop)
+        runs = find_coverage_runs(cvg[:block_stop-block_start], block_start)
+        if prev_run is not None:
+            if prev_run['value'][0] == runs['value'][0]:
+                runs['start'][0] = prev_run['start'][0]
+            elif prev_run['value'][0] > 1e-12:
+                yield prev_run
+        # the last run may continue into the next block
+        prev_run = runs[-1:].copy()
+        runs = runs[:-1]
+        yield runs[runs['value'] > 1e-12]
     
-    if VERBOSE: print "Finished ", chrm, strand
+    if prev_run is not None and prev_run['value'][0] > 1e-12:
+        yield prev_run
     
     return
 
+def build_runs_fname(runs_dir, chrm, strand, build_bigwig):
+    strand_str = {'+': 'plus', '-': 'minus', None: 'both'}[strand]
+    return os.path.join(runs_dir, "%s.%s.%s" % (
+        chrm, strand_str, "runs" if build_bigwig else "bedgraph"))
 
-def write_array_to_opstream(ofp, buffer, buff_start, 
-                            chrm, chrm_length, strand ):
-    """write buffer to disk, buff_start determines the start of buffer in 
-       genomic coordinates.
+def write_coverage_runs_for_contigs(
+        contigs, reads, runs_dir, build_bigwig):
+    """Write the coverage runs of every (chrm, chrm_length, strand) in 
+       contigs into its own file in runs_dir.
+
+    The runs are written as RUN_DTYPE records if we are building a bigwig, 
+    and as bedgraph lines otherwise.
     """
-    chrm = fix_chrm_name( clean_chr_name( chrm ) )
-    
-    prev_pos = 0
-    prev_val = buffer[0]
-    for pos, val in enumerate(buffer[1:]):
-        # make sure this doesn't extend past the end of the chromosome
-        # bedGraphs are 0-based, so use chrm_length-1
-        if buff_start+pos+1 >= chrm_length:
-            pos = chrm_length-buff_start-1
-            break
-        if val != prev_val:
-            if prev_val > 1e-12:
-                write_val = -prev_val if strand == '-' else prev_val
-                line = "%s\t%i\t%i\t%.2f" % (
-                    chrm, buff_start+prev_pos, buff_start+pos+1, write_val )
-                ofp.write(line+"\n")
-            prev_pos, prev_val = pos+1, val
-    
-    if prev_val > 1e-12:
-        write_val = -prev_val if strand == '-' else prev_val
-        line = "%s\t%i\t%i\t%.2f" % (
-            chrm, buff_start+prev_pos, buff_start+pos+1, write_val )
-        ofp.write(line+"\n")
-    
+    # re-open the reads to make this multi-process safe
+    reads = reads.reload()
+    for chrm, chrm_length, strand in contigs:
+        if VERBOSE: print "Starting ", chrm, strand
+        op_chrm = fix_chrm_name( clean_chr_name( chrm ) )
+        with open(build_runs_fname(
+                runs_dir, op_chrm, strand, build_bigwig), "wb") as ofp:
+            for runs in iter_coverage_runs(reads, chrm, chrm_length, strand):
+                if strand == '-': runs['value'] *= -1
+                if build_bigwig:
+                    ofp.write(runs.tostring())
+                else:
+                    ofp.write("".join(
+                        "%s\t%i\t%i\t%.2f\n" % (op_chrm, start, stop, val)
+                        for start, stop, val in izip(
+                            runs['start'].tolist(), runs['stop'].tolist(), 
+                            runs['value'].tolist())))
+        if VERBOSE: print "Finished ", chrm, strand
     return
 
+def load_coverage_runs(runs_dir, chrm, strand):
+    fname = build_runs_fname(runs_dir, chrm, strand, True)
+    if not os.path.exists(fname) or os.path.getsize(fname) == 0:
+        return None
+    return numpy.memmap(fname, dtype=RUN_DTYPE, mode='r')
 
-def build_chrm_sizes_file(reads):
-    chrm_sizes_file = tempfile.NamedTemporaryFile(delete=True)
-    # find the chrm names and their associated lengths
-    chrm_lengths = zip(reads.references, reads.lengths)
-    #write out the chromosomes and its corrosponding size to disk
-    for chrm, chrm_length in chrm_lengths:
-        chrm_sizes_file.write(fix_chrm_name(chrm) + "   " + str(chrm_length) +"\n")
-    chrm_sizes_file.flush()
+def generate_wiggle(reads, op_prefix, stranded, build_bigwig, 
+                    num_threads=1, contig=None ):
+    strands = ['+', '-'] if stranded else [None,]
+    chrm_lengths = dict( (fix_chrm_name(clean_chr_name(chrm)), chrm_length)
+                         for chrm, chrm_length 
+                         in izip(reads.references, reads.lengths) )
     
-    return chrm_sizes_file
-
-def generate_wiggle(reads, ofps, num_threads=1, contig=None ):
-    all_args = []
-    for chrm_length, chrm  in sorted(izip(reads.lengths, reads.references)):
-        strands = ['+', '-'] if len(ofps) == 2 else [None,]
+    contigs, costs = [], []
+    contig_read_counts = reads.contig_read_counts()
+    for chrm_length, chrm in sorted(izip(reads.lengths, reads.references)):
         # skip regions not in the specified contig, if requested 
         if contig != None and clean_chr_name(chrm) != clean_chr_name(contig): 
             continue
         for strand in strands:
-            ofp = ofps[strand]
-            assert (ofp, reads, chrm, chrm_length, strand ) not in all_args
-            all_args.append((ofp, reads, chrm, chrm_length, strand ))
+            contigs.append((chrm, chrm_length, strand))
+            costs.append(contig_read_counts.get(clean_chr_name(chrm), 0)
+                         + chrm_length/BUFFER_SIZE)
     
-    if num_threads == 1:
-        for args in reversed(all_args):
-            populate_cvg_array_for_contig( *args )
-    else:
-        ps = [None]*num_threads
-        while len( all_args ) > 0:
-            for i in xrange(num_threads):
-                if ps[i] == None or not ps[i].is_alive():
-                    ps[i] = multiprocessing.Process( 
-                        target=populate_cvg_array_for_contig, 
-                        args=all_args.pop() )
-                    ps[i].start()
-                    break
-            time.sleep( 0.1 )
-
-        for p in ps:
-            if p != None: p.join()
-    
-    for fp in ofps.values(): fp.close()
+    # write each contig's runs into a temporary directory next to the 
+    # output, and then assemble the output files in contig order
+    runs_dir = tempfile.mkdtemp(
+        prefix=os.path.basename(op_prefix) + ".", 
+        dir=os.path.dirname(os.path.abspath(op_prefix)))
+    try:
+        WorkStealingScheduler(contigs, costs, num_threads).run(
+            write_coverage_runs_for_contigs, 
+            [reads, runs_dir, build_bigwig])
+        
+        for strand in strands:
+            strand_str = "" if strand == None else {
+                '+': '.plus', '-': '.minus'}[strand]
+            if build_bigwig:
+                if VERBOSE: print "Building bigwig for", strand_str
+                write_bigwig(
+                    op_prefix + strand_str + ".bw", 
+                    sorted(chrm_lengths.iteritems()),
+                    lambda chrm: load_coverage_runs(runs_dir, chrm, strand))
+                continue
+            
+            with open(op_prefix + strand_str + ".bedgraph", "w") as ofp:
+                ofp.write( "track name=%s%s type=bedGraph\n" \
+                               % ( os.path.basename(op_prefix), strand_str ) )
+                for chrm in sorted(chrm_lengths):
+                    fname = build_runs_fname(runs_dir, chrm, strand, False)
+                    if not os.path.exists(fname): continue
+                    with open(fname) as ifp:
+                        shutil.copyfileobj(ifp, ofp)
+    finally:
+        shutil.rmtree(runs_dir)
     
     return
 
@@ -209,21 +235,6 @@ def parse_arguments():
              args.region, args.threads )
         
 
-def build_bigwig_from_bedgraph(bedgraph_fp, chrm_sizes_file, op_fname):
-    with tempfile.NamedTemporaryFile(delete=True) as sorted_ofp:
-        if VERBOSE: print "Sorting ", bedgraph_fp.name
-        subprocess.call( 
-            ["sort -k1,1 -k2,2n " + bedgraph_fp.name,], 
-            stdout=sorted_ofp, shell=True )
-        sorted_ofp.flush()
-        
-        if VERBOSE: print "Building wig for", bedgraph_fp.name
-        subprocess.check_call( [ "bedGraphToBigWig", 
-                                 sorted_ofp.name, 
-                                 chrm_sizes_file.name, 
-                                 op_fname ] )
-    return
-
 def main():
     ( assay, stranded, reads_fname, op_prefix, build_bigwig, 
       reverse_read_strand, read_filter, region, num_threads) = parse_arguments()
@@ -260,55 +271,8 @@ def main():
     else:
         raise ValueError, "Unrecognized assay: '%s'" % assay
     
-    # if we want to build a bigwig, make sure that the script is on the path
-    if build_bigwig:
-        try: 
-            subprocess.check_call(["which", "bedGraphToBigWig"], stdout=None)
-        except subprocess.CalledProcessError:
-            raise ValueError, "bedGraphToBigWig does not exist on $PATH. " + \
-                "You can still build a bedGraph by removing the --bigwig(-b) option."        
-    
-    # Open the output files
-    if stranded:
-        ofps = { '+' : ProcessSafeOPStream(
-                open(op_prefix+".plus.bedgraph","w")), 
-                 '-' : ProcessSafeOPStream(
-                open(op_prefix+".minus.bedgraph", "w"))
-               }
-    else:
-        ofps = { None: ProcessSafeOPStream(open(op_prefix+".bedgraph", "w")) }
-
-    # write the bedgraph header information
-    if not build_bigwig:
-        for key, fp in ofps.iteritems():
-            strand_str = "" if key == None else {
-                '+': '.plus', '-': '.minus'}[key]
-            fp.write( "track name=%s%s type=bedGraph\n" \
-                          % ( os.path.basename(op_prefix), strand_str ) )
-    
-    
-    generate_wiggle( reads, ofps, num_threads, region )
-    
-    # finally, if we are building a bigwig, build it, and then remove the bedgraph files
-    if build_bigwig:
-        # build the chrm sizes file.
-        with build_chrm_sizes_file(reads) as chrm_sizes_file:        
-            threads = []
-            for strand, bedgraph_fp in ofps.iteritems():
-                strand_str = "" if strand == None else ( 
-                    {'+': '.plus', '-': '.minus'}[strand] )
-                op_fname = op_prefix + strand_str + ".bw"
-
-                t = threading.Thread( 
-                    target=build_bigwig_from_bedgraph, 
-                    args=(bedgraph_fp, chrm_sizes_file, op_fname) )
-                t.start()
-                threads.append( t )
-
-            for t in threads:
-                t.join()
-        
-        chrm_sizes_file.close()
+    generate_wiggle( reads, op_prefix, stranded, build_bigwig, 
+                     num_threads, region )
     
     # close the reads files
     reads.close()
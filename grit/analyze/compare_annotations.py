@@ -18,12 +18,17 @@ along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import sys, os
+import shutil
+import tempfile
+import cPickle as pickle
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from itertools import izip
+from bisect import bisect_left, bisect_right
 
 sys.path.insert(0, "/home/nboley/grit/grit/")
 from grit.files.gtf import load_gtf
+from grit.lib.multiprocessing_utils import WorkStealingScheduler
 
 VERBOSE = True
 
@@ -186,14 +191,23 @@ def build_element_stats( ref_genes, t_genes, output_stats ):
                     tes_e_overlap += 1.
                     break
         
+    # a reference single exon gene is recovered if any single exon gene
+    # starts before its start + MAX_GENE_BNDRY_DISTANCE, and stops after its
+    # stop - MAX_GENE_BNDRY_DISTANCE. Sort by start, and keep the running
+    # max stop, to check that with a binary search
+    t_se_bndries = sorted( t_se_gene[2] for t_se_gene in t_se_genes )
+    t_se_starts = [ start for start, stop in t_se_bndries ]
+    t_se_max_stops = []
+    for start, stop in t_se_bndries:
+        t_se_max_stops.append( 
+            stop if len(t_se_max_stops) == 0 else max(stop, t_se_max_stops[-1]))
     se_overlap = 0
     for r_se_gene in r_se_genes:
-        for t_se_gene in t_se_genes:
-            if ( t_se_gene[2][0] - MAX_GENE_BNDRY_DISTANCE 
-                 < r_se_gene[2][0] ) and ( 
-                t_se_gene[2][1] + MAX_GENE_BNDRY_DISTANCE > r_se_gene[2][1]):
-                se_overlap += 1.0
-                break
+        n_before = bisect_left( 
+            t_se_starts, r_se_gene[2][0] + MAX_GENE_BNDRY_DISTANCE )
+        if n_before > 0 and ( t_se_max_stops[n_before-1] 
+                              > r_se_gene[2][1] - MAX_GENE_BNDRY_DISTANCE ):
+            se_overlap += 1.0
     
     # get total number of exons
     num_r_exons = sum( map( len, (r_int_exons, r_tss_exons, r_tes_exons) ) ) 
@@ -507,6 +521,221 @@ def match_all_transcripts( clustered_transcripts, build_maps,
     
     return calc_trans_cnts( all_trans_cnts, build_maps_stats, output_stats )
 
+TranscriptRecord = namedtuple('TranscriptRecord', [
+        'gene_start', 'gene_stop', 'gene_id', 'trans_id', 
+        'start', 'stop', 'introns'])
+
+def iter_and_record_transcripts( genes, grpd_transcripts ):
+    """Iterate through genes, and add a record of each of their transcripts
+       to grpd_transcripts[(chrm, strand)].
+
+    This lets the element stats and the transcript records be built in a 
+    single pass over a streamed annotation.
+    """
+    for gene in genes:
+        for trans in gene.transcripts:
+            grpd_transcripts[(gene.chrm, gene.strand)].append(
+                TranscriptRecord( gene.start, gene.stop, gene.id, trans.id,
+                                  trans.start, trans.stop, trans.introns ) )
+        yield gene
+    
+    # order the transcripts the same way that cluster_overlapping_genes does
+    for records in grpd_transcripts.itervalues():
+        records.sort(key=lambda r: (r.gene_start, r.gene_stop, r.gene_id))
+    
+    return
+
+def build_intron_chain_index( grpd_transcripts ):
+    """Index the transcript records by (chrm, strand, intron chain).
+
+    """
+    index = defaultdict( list )
+    for (chrm, strand), records in grpd_transcripts.iteritems():
+        for record in records:
+            index[(chrm, strand, record.introns)].append( record )
+    return dict( index )
+
+def cluster_shard_genes( grpd_records ):
+    """Find the cluster of overlapping genes that each gene belongs to.
+
+    grpd_records is a list of transcript records for each source. Returns
+    a dict keyed by (source_id, gene_id, gene_start, gene_stop).
+    """
+    boundaries = sorted( set(
+            (r.gene_start, r.gene_stop, source_id, r.gene_id)
+            for source_id, records in enumerate(grpd_records) 
+            for r in records ) )
+    cluster_ids = {}
+    cluster_id, curr_grp_max_loc = -1, -1
+    for min_loc, max_loc, source_id, gene_id in boundaries:
+        if min_loc > curr_grp_max_loc:
+            cluster_id += 1
+        cluster_ids[(source_id, gene_id, min_loc, max_loc)] = cluster_id
+        curr_grp_max_loc = max( max_loc, curr_grp_max_loc )
+    return cluster_ids
+
+class BndryMatcher(object):
+    """Find the first of a list of transcript records whose boundaries are 
+       both within MAX_GENE_BNDRY_DISTANCE of a transcript's.
+
+    The records are indexed by start, so only the records with a matching
+    start are checked.
+    """
+    def __init__(self, records):
+        self.records = records
+        self._order = sorted(
+            xrange(len(records)), key=lambda i: records[i].start)
+        self._starts = [ records[i].start for i in self._order ]
+    
+    def find_first_match(self, record):
+        lo = bisect_right(self._starts, record.start - MAX_GENE_BNDRY_DISTANCE)
+        hi = bisect_left(self._starts, record.start + MAX_GENE_BNDRY_DISTANCE)
+        best_i = None
+        for i in self._order[lo:hi]:
+            if ( abs(record.stop - self.records[i].stop) 
+                    < MAX_GENE_BNDRY_DISTANCE
+                 and (best_i == None or i < best_i) ):
+                best_i = i
+        return None if best_i == None else self.records[best_i]
+
+def match_shard_transcripts( chrm, strand, r_records, t_records, ref_index, 
+                             build_maps, build_maps_stats ):
+    """Find and count the match classes of the transcripts in a contig and 
+       strand, using the reference intron chain index.
+
+    This gives the same counts as running match_transcripts on every 
+    cluster: transcripts that share an intron chain always overlap, so 
+    only the single exon transcripts need to be restricted to their 
+    cluster. The map lines are in gene order.
+    """
+    cluster_ids = cluster_shard_genes( (r_records, t_records) )
+    def match_key( source_id, record ):
+        if len( record.introns ) > 0: return record.introns
+        return cluster_ids[(source_id, record.gene_id, 
+                            record.gene_start, record.gene_stop)]
+    
+    r_se_records = defaultdict( list )
+    for record in ref_index.get( (chrm, strand, ()), [] ):
+        r_se_records[match_key(0, record)].append( record )
+    r_matchers = {}
+    def find_ref_match( record ):
+        key = match_key(1, record)
+        if key not in r_matchers:
+            if isinstance( key, int ): candidates = r_se_records.get(key, [])
+            else: candidates = ref_index.get( (chrm, strand, key), [] )
+            r_matchers[key] = BndryMatcher( candidates )
+        return r_matchers[key].find_first_match( record )
+    
+    t_index = defaultdict( list )
+    for record in t_records:
+        t_index[match_key(1, record)].append( record )
+    t_matchers = dict( (key, BndryMatcher(records)) 
+                       for key, records in t_index.iteritems() )
+    
+    build_class_lines = ( build_maps or build_maps_stats )
+    def add_map_line( record, match, map_lines, class_counts ):
+        class_cd = "u" if match == None else "="
+        if build_maps_stats:
+            class_counts[class_cd] += 1
+        if build_maps:
+            map_lines.append( '\t'.join( ( 
+                        record.gene_id, record.trans_id, class_cd, 
+                        "-" if match == None else match.gene_id, 
+                        "-" if match == None else match.trans_id ) ) )
+        return
+    
+    r_map, t_map = ( [], [] ) if build_maps else ( None, None )
+    r_class_cnts, t_class_cnts = ( 
+        ( { '=':0, 'c':0, 'j':0, 'u':0 }, { '=':0, 'c':0, 'j':0, 'u':0 } )
+        if build_maps_stats else ( None, None ) )
+    
+    observed_ref_trans = set()
+    matched_novel_cnt = 0
+    for record in t_records:
+        match = find_ref_match( record )
+        if match != None:
+            observed_ref_trans.add( 
+                (match.gene_id, match.trans_id, match.start, match.stop) )
+            matched_novel_cnt += 1
+        if build_class_lines:
+            add_map_line( record, match, t_map, t_class_cnts )
+    
+    if build_class_lines:
+        for record in r_records:
+            key = match_key(0, record)
+            match = ( t_matchers[key].find_first_match( record ) 
+                      if key in t_matchers else None )
+            add_map_line( record, match, r_map, r_class_cnts )
+    
+    trans_counts = ( len(r_records), len(t_records), 
+                     len(observed_ref_trans), matched_novel_cnt )
+    class_counts = ( r_class_cnts, t_class_cnts )
+    
+    return r_map, t_map, trans_counts, class_counts
+
+def match_shards_worker( shards, grpd_r_records, grpd_t_records, ref_index, 
+                         build_maps, build_maps_stats, op_dir ):
+    for shard_i, (chrm, strand) in shards:
+        r_map, t_map, trans_counts, class_counts = match_shard_transcripts(
+            chrm, strand, 
+            grpd_r_records.get((chrm, strand), []), 
+            grpd_t_records.get((chrm, strand), []), 
+            ref_index, build_maps, build_maps_stats )
+        if build_maps:
+            for ext, map_lines in (("refmap", r_map), ("tmap", t_map)):
+                with open(os.path.join(
+                        op_dir, "%i.%s" % (shard_i, ext)), "w") as ofp:
+                    ofp.write( "".join( line + "\n" for line in map_lines ) )
+        with open(os.path.join(op_dir, "%i.counts" % shard_i), "w") as ofp:
+            pickle.dump( (trans_counts, class_counts), ofp )
+    return
+
+def match_all_transcripts_indexed( grpd_r_records, grpd_t_records, 
+                                   build_maps, build_maps_stats, 
+                                   out_prefix, output_stats, num_threads=1 ):
+    """Match the transcripts with the reference intron chain index, sharded 
+       by contig and strand over num_threads processes.
+
+    The shards' map lines and counts are merged in (contig, strand) order,
+    so the output doesn't depend on the number of threads.
+    """
+    ref_index = build_intron_chain_index( grpd_r_records )
+    if VERBOSE:
+        print >> sys.stderr, "Built an index of %i reference intron chains" \
+            % len(ref_index)
+    
+    shards = sorted( set(grpd_r_records.keys() + grpd_t_records.keys()) )
+    costs = [ len(grpd_r_records.get(key, [])) 
+              + len(grpd_t_records.get(key, [])) for key in shards ]
+    
+    op_dir = tempfile.mkdtemp( 
+        prefix=".compare.", 
+        dir=None if out_prefix == None else os.path.dirname(
+            os.path.abspath(out_prefix)) )
+    try:
+        WorkStealingScheduler( 
+            list(enumerate(shards)), costs, num_threads ).run(
+            match_shards_worker, 
+            [ grpd_r_records, grpd_t_records, ref_index, 
+              build_maps, build_maps_stats, op_dir ] )
+        
+        all_trans_cnts = []
+        for shard_i in xrange(len(shards)):
+            with open(os.path.join(op_dir, "%i.counts" % shard_i)) as fp:
+                all_trans_cnts.append( pickle.load(fp) )
+        
+        if build_maps:
+            for ext in ("refmap", "tmap"):
+                with open( out_prefix + "." + ext, "w" ) as ofp:
+                    for shard_i in xrange(len(shards)):
+                        with open(os.path.join(
+                                op_dir, "%i.%s" % (shard_i, ext))) as fp:
+                            shutil.copyfileobj( fp, ofp )
+    finally:
+        shutil.rmtree( op_dir )
+    
+    return calc_trans_cnts( all_trans_cnts, build_maps_stats, output_stats )
+
 class OutputStats( dict ):
     def __init__(self, ref_fname, gtf_fname ):
         self.ref_fname = ref_fname
@@ -568,8 +797,12 @@ def make_class_cnts_string( class_counts, ref_fname, gtf_fname ):
     return '\n'.join( class_lines )
 
 def compare( ref_fname, gtf_fname, build_maps, build_maps_stats, 
-             out_prefix, num_threads=1 ):
+             out_prefix, num_threads=1, indexed=False ):
     """Compare refernce to another 'gtf' annotation by element types
+
+    If indexed is set, the transcripts are matched with an intron chain 
+    index of the reference (see match_all_transcripts_indexed) and both
+    annotations are streamed, rather than clustering all of the genes.
     """
     # load the gtf files
     ref_genes = load_gtf(ref_fname)
@@ -577,21 +810,35 @@ def compare( ref_fname, gtf_fname, build_maps, build_maps_stats,
                  
     output_stats = OutputStats( ref_fname, gtf_fname )
     
+    if indexed:
+        grpd_r_records, grpd_t_records = defaultdict(list), defaultdict(list)
+        ref_genes = iter_and_record_transcripts( 
+            ref_genes.iter_uncached(), grpd_r_records )
+        t_genes = iter_and_record_transcripts( 
+            t_genes.iter_uncached(), grpd_t_records )
+    
     # get recall and prceision stats for all types of exons and introns
     build_element_stats(ref_genes, t_genes, output_stats)
     if VERBOSE: print >> sys.stderr, "Finished building element stats"
     
-    clustered_transcripts = cluster_overlapping_genes( (ref_genes, t_genes) )
-    if VERBOSE:
-        n_clusters = sum(len(val) for val in clustered_transcripts.itervalues())
-        print >> sys.stderr, \
-            "Finished clustering genes into %i clusters." % n_clusters
-    
     # calculate transcript overlaps and class match counts
     # also write map files if requested
-    trans_class_cnts = \
-        match_all_transcripts( clustered_transcripts, build_maps, 
-                               build_maps_stats, out_prefix, output_stats )
+    if indexed:
+        trans_class_cnts = match_all_transcripts_indexed( 
+            grpd_r_records, grpd_t_records, build_maps, build_maps_stats, 
+            out_prefix, output_stats, num_threads )
+    else:
+        clustered_transcripts = cluster_overlapping_genes( 
+            (ref_genes, t_genes) )
+        if VERBOSE:
+            n_clusters = sum(
+                len(val) for val in clustered_transcripts.itervalues())
+            print >> sys.stderr, \
+                "Finished clustering genes into %i clusters." % n_clusters
+        
+        trans_class_cnts = \
+            match_all_transcripts( clustered_transcripts, build_maps, 
+                                   build_maps_stats, out_prefix, output_stats )
         
     if out_prefix == None:
         # dump stats to stdout
@@ -615,7 +862,7 @@ def parse_arguments():
     # if we just want to run unit tests
     if len( sys.argv ) > 1 and sys.argv[1] == "--test":
         return ( True, 1, "test.t.gtf", "test.ref.gtf",
-                 True, True, "test.slicompare" )
+                 True, True, "test.slicompare", False )
     
     import argparse
     desc = 'Get exon from a variety of sources.'
@@ -660,6 +907,10 @@ def parse_arguments():
     parser.add_argument(
         '--threads', "-t", default=1, type=int,
         help='Set the number of threads to use.')
+    parser.add_argument(
+        '--indexed', default=False, action='store_true',
+        help='Match transcripts with an intron chain index of the reference, '
+        + 'sharded by contig and strand over --threads processes.')
     parser.add_argument(
         '--verbose', '-v', default=False, action='store_true',
         help='Whether or not to print status information.')
@@ -691,18 +942,18 @@ def parse_arguments():
         FIND_BEST_JN_MATCH = False
     
     return args.test, args.threads, args.gtf, args.reference, \
-        args.build_maps, args.build_maps_stats, args.out_prefix
+        args.build_maps, args.build_maps_stats, args.out_prefix, args.indexed
 
 def main():
     test, n_threads, gtf, reference, build_maps, build_maps_stats, \
-        out_prefix = parse_arguments()
+        out_prefix, indexed = parse_arguments()
     
     # if we want unit tests, build the data and run them
     if test:
         build_test_data()
     
     compare( reference, gtf, build_maps, build_maps_stats, 
-             out_prefix, n_threads )
+             out_prefix, n_threads, indexed )
     
     return
 
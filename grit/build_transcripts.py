@@ -27,7 +27,7 @@ import numpy
 
 from pysam import Fastafile
 
-from itertools import chain
+from itertools import chain, izip
 from collections import namedtuple
 
 import threading
@@ -35,9 +35,11 @@ import multiprocessing
 from multiprocessing.sharedctypes import RawArray, RawValue
 from lib.multiprocessing_utils import Pool
 
-import networkx as nx
-
 from lib.multiprocessing_utils import ThreadSafeFile
+from lib.graphs import DAG
+from lib.profiling import StageMetrics
+from lib.checkpoint import (
+    get_gene_checkpoint, calc_signature, calc_files_signature )
 from transcript import Transcript, Gene
 from files.reads import fix_chrm_name_for_ucsc
 from proteomics.ORF import find_cds_for_gene
@@ -48,6 +50,8 @@ import config
 
 import Queue
 
+from cStringIO import StringIO
+
 GeneElements = namedtuple('GeneElements', 
                           ['id', 'chrm', 'strand',
                            'tss_exons', 'internal_exons', 'tes_exons',
@@ -56,21 +60,35 @@ GeneElements = namedtuple('GeneElements',
 
 SAMPLE_TYPE = None
 REP_ID = None
+# the per gene checkpoint, and the keys of the genes that it restored
+CHECKPOINT = None
+RESTORED_GENE_KEYS = set()
+
+def gene_elements_key(gene_elements):
+    elements = list(chain(
+            gene_elements.tss_exons, gene_elements.internal_exons, 
+            gene_elements.tes_exons, gene_elements.se_transcripts, 
+            gene_elements.promoter, gene_elements.polyas, 
+            gene_elements.introns))
+    return ( gene_elements.chrm, gene_elements.strand, 
+             min(x[0] for x in elements), max(x[1] for x in elements) )
 
 class TooManyCandidateTranscriptsError(Exception):
     pass
 
 def iter_transcripts(graph, tss_exons, tes_exons):
-    paths = [[exon,] for exon in tss_exons]
-    while len(paths) > 0:
-        curr_path = paths.pop()
-        for child in graph.successors(curr_path[-1]):
-            if child in tes_exons:
-                yield curr_path + [child,]
-            else:
-                paths.append(curr_path + [child,])
+    for path in graph.iter_paths(
+            [graph.node_ids[exon] for exon in tss_exons],
+            [graph.node_ids[exon] for exon in tes_exons]):
+        yield [graph.nodes[i] for i in path]
     return
 
+def count_transcripts(graph, tss_exons, tes_exons, max_count=None):
+    return graph.count_paths(
+        [graph.node_ids[exon] for exon in tss_exons],
+        [graph.node_ids[exon] for exon in tes_exons],
+        max_count)
+
 def path_len(path):
     return sum(exon[1]-exon[0]+1 for exon in path)
 
@@ -81,7 +99,8 @@ def iter_transcriptlets(graph, tss_exons, tes_exons, max_length):
         start_exons = set()
         while len(paths) > 0:
             curr_path = paths.pop()
-            for child in graph.successors(curr_path[-1]):
+            for child_i in graph.successors(graph.node_ids[curr_path[-1]]):
+                child = graph.nodes[child_i]
                 new_path = curr_path + [child,]
                 # if child is a tes exon, then there
                 # is nowhere to go so we are done
@@ -105,32 +124,48 @@ def build_splice_graph(
         tss_exons, internal_exons, tes_exons, se_transcripts, jns, strand ):
     # build a directed graph, with edges leading from exon to exon via junctions
     all_exons = sorted(chain(tss_exons, internal_exons, tes_exons))
-    graph = nx.DiGraph()
-    graph.add_nodes_from( tss_exons )
-    graph.add_nodes_from( internal_exons )
-    graph.add_nodes_from( tes_exons )
+    nodes = sorted(set(all_exons))
+    node_ids = dict( (exon, i) for i, exon in enumerate(nodes) )
     edges = find_jn_connected_exons(all_exons, jns, strand )
-    graph.add_edges_from( (start, stop) for jn, start, stop in edges )
-    assert nx.is_directed_acyclic_graph(graph)
-    return graph
+    return DAG( len(nodes), 
+                [ (node_ids[start], node_ids[stop]) 
+                  for jn, start, stop in edges ], 
+                nodes )
+
+def iter_transcripts_in_trie(graph, trie):
+    for path in trie:
+        # the nodes are sorted by position, so sorting the node ids of a
+        # path sorts its exons
+        path.sort()
+        yield [graph.nodes[i] for i in path]
+    return
 
 def build_transcripts_from_elements( 
         tss_exons, internal_exons, tes_exons, se_transcripts, jns, strand ):
+    """Return an iterator over the candidate transcripts' sorted exons.
+
+    The multi-exon transcripts are stored in a PathTrie, and each exon list 
+    is only built when it is reached.
+    """
     graph = build_splice_graph(
         tss_exons, internal_exons, tes_exons, se_transcripts, jns, strand)
-    transcripts = [ [x,] for x in se_transcripts ]
-    for transcript in iter_transcripts(graph, tss_exons, tes_exons):
-        transcripts.append( sorted(transcript) )
-        if len(transcripts) > config.MAX_NUM_CANDIDATE_TRANSCRIPTS:
-            raise TooManyCandidateTranscriptsError, "Too many candidate transcripts"
-    return transcripts
+    # count the transcripts before building them
+    if ( len(se_transcripts) + count_transcripts(
+            graph, tss_exons, tes_exons, config.MAX_NUM_CANDIDATE_TRANSCRIPTS)
+         > config.MAX_NUM_CANDIDATE_TRANSCRIPTS ):
+        raise TooManyCandidateTranscriptsError, "Too many candidate transcripts"
+    trie = graph.build_path_trie(
+        [graph.node_ids[exon] for exon in tss_exons],
+        [graph.node_ids[exon] for exon in tes_exons])
+    return chain( ([x,] for x in se_transcripts), 
+                  iter_transcripts_in_trie(graph, trie) )
 
 def build_transcript_fragments_from_elements( 
         tss_exons, internal_exons, tes_exons, se_transcripts, jns, strand ):
     graph = build_splice_graph(
         tss_exons, internal_exons, tes_exons, se_transcripts, jns, strand)
     transcripts = [ [x,] for x in se_transcripts ]
-    for transcript in iter_transcriplets(graph, tss_exons, tes_exons, 600):
+    for transcript in iter_transcriptlets(graph, tss_exons, tes_exons, 600):
         transcripts.append( sorted(transcript) )
         if len(transcripts) > config.MAX_NUM_CANDIDATE_TRANSCRIPTS:
             raise TooManyCandidateTranscriptsError, "Too many candidate transcripts"
@@ -323,8 +358,13 @@ def build_and_write_gene(gene_elements, output,
                 gene_elements.id, gene_elements.chrm, gene_elements.strand, 
                 start, stop) )
         
-        gene = build_gene(gene_elements, fasta, ref_genes)
+        with StageMetrics('build_gene', gene_elements.id) as metrics:
+            gene = build_gene(gene_elements, fasta, ref_genes)
+            metrics.set_sizes(num_transcripts=(
+                0 if gene == None else len(gene.transcripts)))
         if gene == None: 
+            if CHECKPOINT != None:
+                CHECKPOINT.add(gene_elements_key(gene_elements), None)
             return
         config.log_statement(
             "FINISHED Building transcript and ORFs for Gene %s" % gene.id)
@@ -335,9 +375,18 @@ def build_and_write_gene(gene_elements, output,
             config.get_gene_tmp_fname(gene.id, SAMPLE_TYPE, REP_ID))
         
         output.put((gene.id, len(gene.transcripts), ofname))
-        write_gene_to_gtf(gtf_ofp, gene)
-        write_gene_to_tracking_file(tracking_ofp, gene)
+        gtf_lines, tracking_lines = StringIO(), StringIO()
+        write_gene_to_gtf(gtf_lines, gene)
+        write_gene_to_tracking_file(tracking_lines, gene)
+        gtf_ofp.write(gtf_lines.getvalue())
+        tracking_ofp.write(tracking_lines.getvalue())
+        if CHECKPOINT != None:
+            CHECKPOINT.add(gene_elements_key(gene_elements), 
+                           ( gene.id, len(gene.transcripts), ofname,
+                             gtf_lines.getvalue(), tracking_lines.getvalue()))
     except TooManyCandidateTranscriptsError:
+        if CHECKPOINT != None:
+            CHECKPOINT.add(gene_elements_key(gene_elements), None)
         config.log_statement(
             "Too many candidate transcripts in %s(%s:%s:%i-%i)" % (
                 gene_elements.id, gene_elements.chrm, gene_elements.strand, 
@@ -373,17 +422,31 @@ def build_transcripts_worker( elements,
                               fasta, ref_genes)
     return
 
-def group_elements_in_gene(grpd_exons):    
+def group_elements_in_gene(grpd_exons):
+    """Yield the elements in each gene, as slices of the element arrays.
+
+    The element arrays are sorted by start, so the elements that start in a 
+    gene are contiguous, and are found with a binary search.
+    """
+    all_elements = []
+    for key in ('tss_exon', 'internal_exon', 'tes_exon', 
+                'single_exon_gene', 'promoter', 'polya', 'intron'):
+        if key not in grpd_exons or len(grpd_exons[key]) == 0: 
+            all_elements.append(numpy.zeros((0, 2), dtype=int))
+        else:
+            all_elements.append(grpd_exons[key])
+    all_starts = [ elements[:,0] for elements in all_elements ]
+    
     for g_start, g_stop in grpd_exons['gene']:
         args = []
-        for key in ('tss_exon', 'internal_exon', 'tes_exon', 
-                    'single_exon_gene', 'promoter', 'polya', 'intron'):
-            if key not in grpd_exons: 
-                args.append(set())
-            else:
-                exons = [tuple(x) for x in grpd_exons[key].tolist()
-                         if x[0] >= g_start and x[1] <= g_stop]
-                args.append(set(exons))
+        for elements, starts in izip(all_elements, all_starts):
+            gene_elements = elements[
+                starts.searchsorted(g_start, side='left'):
+                starts.searchsorted(g_stop, side='right')]
+            in_gene = (gene_elements[:,1] <= g_stop)
+            if not in_gene.all():
+                gene_elements = gene_elements[in_gene]
+            args.append(gene_elements)
         yield args
 
 def add_elements_for_contig_and_strand((contig, strand), 
@@ -407,22 +470,28 @@ def add_elements_for_contig_and_strand((contig, strand),
                 set(map(tuple, grpd_exons[key].tolist())))
     args.append(strand)
     """
-    for ( tss_es, internal_es, tes_es,
-          se_ts, promoters, polyas, jns ) in group_elements_in_gene(grpd_exons):
+    for gene_elements in group_elements_in_gene(grpd_exons):
+        ( tss_es, internal_es, tes_es, se_ts, promoters, polyas, jns 
+          ) = [ set(map(tuple, gene_elems.tolist())) 
+                for gene_elems in gene_elements ]
         # skip genes without all of the element types
         if len(se_ts) == 0 and (
                 len(tes_es) == 0 
                 or len( tss_es ) == 0 ):
             continue
         
-        with gene_id_cntr.get_lock():
-            gene_id = "XLOC_%i" % gene_id_cntr.value
-            gene_id_cntr.value += 1
-        
-        gene_data = GeneElements( gene_id, contig, strand,
+        gene_data = GeneElements( None, contig, strand,
                                   tss_es, internal_es, tes_es,
                                   se_ts, promoters, polyas, 
                                   jns )
+        # skip genes that were built by a previous run
+        if gene_elements_key(gene_data) in RESTORED_GENE_KEYS:
+            continue
+        
+        with gene_id_cntr.get_lock():
+            gene_id = "XLOC_%i" % gene_id_cntr.value
+            gene_id_cntr.value += 1
+        gene_data = gene_data._replace(id=gene_id)
 
         try: 
             elements.put(gene_data, timeout=0.1)
@@ -456,7 +525,7 @@ def add_elements_for_contig_and_strand_worker(
 
 def feed_elements(raw_elements, elements, 
                   output, gtf_ofp, tracking_ofp, 
-                  fasta_fp, ref_genes ):
+                  fasta_fp, ref_genes, first_gene_id=0 ):
     all_args = multiprocessing.Queue()
     for (contig, strand), grpd_exons in raw_elements.iteritems():
         all_args.put([(contig, strand), dict(grpd_exons)])
@@ -464,7 +533,7 @@ def feed_elements(raw_elements, elements,
         all_args.put('FINISHED')
 
     num_add_element_threads = min(len(raw_elements), config.NTHREADS)
-    gene_id_cntr = multiprocessing.Value('i', 0)
+    gene_id_cntr = multiprocessing.Value('i', first_gene_id)
     nthreads_remaining = multiprocessing.Value('i', num_add_element_threads)
     worker_args = [ all_args, elements, gene_id_cntr,
                     output, gtf_ofp, tracking_ofp, 
@@ -510,6 +579,7 @@ def build_transcripts(exons_bed_fp, gtf_ofname, tracking_ofname,
     SAMPLE_TYPE = sample_type
     global REP_ID
     REP_ID = rep_id
+    global CHECKPOINT
     
     # make sure that we're starting from the start of the 
     # elements files
@@ -533,6 +603,32 @@ def build_transcripts(exons_bed_fp, gtf_ofname, tracking_ofname,
              "locus".ljust(30), 
              "length"]) + "\n")
     
+    # write out the genes that were built by a previous run. The workers
+    # inherit the checkpoint, and skip these genes.
+    CHECKPOINT = get_gene_checkpoint(
+        os.path.basename(gtf_ofname), 
+        calc_signature( calc_files_signature([exons_bed_fp.name,]),
+                        None if fasta_fp == None else fasta_fp.name,
+                        config.MAX_NUM_CANDIDATE_TRANSCRIPTS,
+                        config.BUILD_MODELS_WITH_RETAINED_INTRONS ))
+    RESTORED_GENE_KEYS.clear()
+    restored_genes = []
+    first_gene_id = 0
+    for key, gene_data in ([] if CHECKPOINT == None else CHECKPOINT.items()):
+        if gene_data != None:
+            gene_id, n_transcripts, ofname, gtf_lines, tracking_lines = \
+                gene_data
+            # rebuild genes whose pickled file was removed
+            if not os.path.exists(ofname): continue
+            gtf_ofp.write(gtf_lines)
+            tracking_ofp.write(tracking_lines)
+            restored_genes.append((gene_id, n_transcripts, ofname))
+            first_gene_id = max(first_gene_id, int(gene_id.split("_")[-1])+1)
+        RESTORED_GENE_KEYS.add(key)
+    if len(RESTORED_GENE_KEYS) > 0:
+        config.log_statement( "Restored %i genes from '%s'" % (
+                len(RESTORED_GENE_KEYS), CHECKPOINT.fname), log=True )
+    
     config.log_statement( "Building Transcripts", log=True )
     manager = multiprocessing.Manager()
     elements = manager.Queue(2*config.NTHREADS)
@@ -559,7 +655,7 @@ def build_transcripts(exons_bed_fp, gtf_ofname, tracking_ofname,
     if elements_feeder_pid == 0:
         feed_elements( raw_elements, elements, 
                        output, gtf_ofp, tracking_ofp, 
-                       fasta_fp, ref_genes )
+                       fasta_fp, ref_genes, first_gene_id )
         os._exit(0)
 
     for pid in pids:
@@ -567,7 +663,7 @@ def build_transcripts(exons_bed_fp, gtf_ofname, tracking_ofname,
 
     os.waitpid(elements_feeder_pid, 0)
     
-    genes = []
+    genes = restored_genes
     while output.qsize() > 0:
         try: 
             genes.append(output.get_nowait())
@@ -26,7 +26,23 @@ MAX_NUM_TRANSCRIPTS_TO_QUANTIFY = 1000
 # thxe maximum number of candidate transcripts to build in a particular gene locus
 MAX_NUM_CANDIDATE_TRANSCRIPTS = 50000
 
+# genes with at most this many transcripts have their MLEs estimated in 
+# batches of BATCHED_MLE_SIZE genes
+MAX_NUM_TRANSCRIPTS_FOR_BATCHED_MLE = 10
+BATCHED_MLE_SIZE = 1000
+
 CB_SIG_LEVEL = 0.025
+# the maximum number of likelihood evaluations used to estimate the 
+# confidence bounds of a single gene
+MAX_NUM_CB_LHD_EVALS = 250000
+
+# quantify each gene from its design matrix through to its tracking file 
+# lines as soon as its reads are binned, instead of building every design 
+# matrix before estimating any expression. The read totals used for the out 
+# of gene bins and the FPKMs are taken up front from the bam index counts 
+# (halved for paired reads). These are bam wide totals, rather than the reads 
+# counted in the genes' design matrices, so the FPKMs differ from batch mode.
+STREAM_GENE_QUANTIFICATION = False
 
 # log statement is set in the main init, and is a global
 # function which facilitates smart, ncurses based logging
@@ -87,11 +103,37 @@ def get_gene_tmp_fname(gene_id, sample_type=None, rep_id=None):
     return rv + ".gene"
 
 
-def get_fmat_tmp_fname(gene_id, sample_type=None, rep_id=None):
-    rv = os.path.join(tmp_dir, "%s" % gene_id )
+# cache the expected read counts, which only depend on the gene structure 
+# and fragment length distribution, so that they are shared between 
+# replicates, samples and continued runs
+CACHE_EXPECTED_CNTS = True
+
+def get_expected_cnts_cache_dirname():
+    return os.path.join(tmp_dir, "expected_cnts_cache" )
+
+def get_fmat_store_fname(sample_type=None, rep_id=None):
+    rv = os.path.join(tmp_dir, "design_matrices" )
+    if sample_type != None: rv += ".%s" % sample_type
+    if rep_id != None: rv += ".%s" % rep_id
+    return rv + ".fmats"
+
+# record the results of every stage, gene by gene, so that a run restarted
+# with --continue-run (which sets RESUME_FROM_CHECKPOINTS) only redoes the 
+# genes and stages that hadn't finished
+WRITE_CHECKPOINTS = True
+RESUME_FROM_CHECKPOINTS = False
+
+def get_checkpoint_dirname():
+    return os.path.join(tmp_dir, "checkpoints" )
+
+def get_checkpoint_manifest_fname():
+    return os.path.join(get_checkpoint_dirname(), "manifest.json" )
+
+def get_checkpoint_fname(stage, sample_type=None, rep_id=None):
+    rv = os.path.join(get_checkpoint_dirname(), stage )
     if sample_type != None: rv += ".%s" % sample_type
     if rep_id != None: rv += ".%s" % rep_id
-    return rv + ".fmat"
+    return rv + ".ckpt"
 
 def log_statement(*args, **kwargs):
     print args[0]
@@ -18,11 +18,12 @@ along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import numpy
-import networkx as nx
 
 from collections import defaultdict, namedtuple
 from itertools import izip, chain
 
+from lib.graphs import find_connected_components
+
 RefElementsToInclude = namedtuple(
     'RefElementsToInclude', 
     ['genes', 'junctions', 'TSS', 'TES', 'promoters', 'polya_sites', 'exons'])
@@ -51,53 +52,84 @@ def load_elements( fp ):
     
     return convert_elements_to_arrays(all_elements)
 
+def build_intervals_array(intervals):
+    """Return the unique intervals, sorted, in an (n, 2) integer array.
+
+    """
+    intervals = numpy.array(list(intervals), dtype=int).reshape((-1, 2))
+    if len(intervals) == 0: return intervals
+    return numpy.unique(intervals, axis=0)
+
 def find_overlapping_exons(exons):
     overlapping_exons_mapping = set()
-    for o_i, (o_start, o_stop) in enumerate(exons):
-        for i_i, (i_start, i_stop) in enumerate(exons):
-            if i_i > o_i: break
-            if not (i_stop < o_start or i_start > o_stop):
-                overlapping_exons_mapping.add( 
-                    ((o_start, o_stop), (i_start, i_stop)) )
-                overlapping_exons_mapping.add( 
-                    ((i_start, i_stop), (o_start, o_stop)) )
+    # sweep over the exons in start order, keeping the exons that end at or 
+    # after the current start
+    active_exons = []
+    for exon in map(tuple, build_intervals_array(exons).tolist()):
+        active_exons = [ x for x in active_exons if x[1] >= exon[0] ]
+        active_exons.append(exon)
+        for o_exon in active_exons:
+            overlapping_exons_mapping.add( (exon, o_exon) )
+            overlapping_exons_mapping.add( (o_exon, exon) )
     
     return list(overlapping_exons_mapping)
 
+def find_overlapping_exon_clusters(exons):
+    """Return the overlap cluster of each exon in exons. 
+
+    exons must be sorted by start. Overlapping exons form contiguous runs
+    in start order, so the clusters are numbered in start order.
+    """
+    if len(exons) == 0: return numpy.zeros(0, dtype=int)
+    max_stops = numpy.maximum.accumulate(exons[:,1])
+    new_clusters = numpy.zeros(len(exons), dtype=int)
+    new_clusters[1:] = exons[1:,0] > max_stops[:-1]
+    return new_clusters.cumsum()
 
 def find_jn_connected_exons(exons, jns, strand):
-    edges = set()
+    """Return the set of (jn, upstream exon, downstream exon)'s for every 
+       pair of exons that a junction connects.
+
+    """
+    exons = build_intervals_array(exons)
+    jns = numpy.array(list(jns), dtype=int).reshape((-1, 2))
+    if len(exons) == 0 or len(jns) == 0: return set()
+
+    # find the exons that stop just before, and start just after, each jn
+    stops_order = exons[:,1].argsort(kind='mergesort')
+    stops = exons[stops_order,1]
+    starts_order = exons[:,0].argsort(kind='mergesort')
+    starts = exons[starts_order,0]
+    left_lbs = stops.searchsorted(jns[:,0]-1, side='left')
+    n_left = stops.searchsorted(jns[:,0]-1, side='right') - left_lbs
+    right_lbs = starts.searchsorted(jns[:,1]+1, side='left')
+    n_right = starts.searchsorted(jns[:,1]+1, side='right') - right_lbs
+
+    # build every (left exon, right exon) pair for each jn
+    n_pairs = n_left*n_right
+    jn_indices = numpy.repeat(numpy.arange(len(jns)), n_pairs)
+    pair_indices = ( numpy.arange(n_pairs.sum()) 
+                     - numpy.repeat(n_pairs.cumsum()-n_pairs, n_pairs) )
+    left_exons = exons[stops_order[
+            left_lbs[jn_indices] + pair_indices//n_right[jn_indices]]]
+    right_exons = exons[starts_order[
+            right_lbs[jn_indices] + pair_indices%n_right[jn_indices]]]
+    if strand != '+':
+        left_exons, right_exons = right_exons, left_exons
     
-    # build mappings from exon starts to indices
-    exon_starts_map = defaultdict(list)
-    exon_stops_map = defaultdict(list)
-    for start, stop in exons:
-        exon_starts_map[start].append( (start, stop) )
-        exon_stops_map[stop].append( (start, stop ) )
-    
-    for jn in jns:
-        for start_exon in exon_stops_map[jn[0]-1]:
-            for stop_exon in exon_starts_map[jn[1]+1]:
-                if strand == '+':
-                    edges.add((tuple(jn), start_exon, stop_exon))
-                else:
-                    edges.add((tuple(jn), stop_exon, start_exon))
-    
-    return edges
+    return set( (tuple(jn), tuple(start_exon), tuple(stop_exon))
+                for jn, start_exon, stop_exon in izip(
+                    jns[jn_indices].tolist(), 
+                    left_exons.tolist(), 
+                    right_exons.tolist()) )
 
 def iter_nonoverlapping_exons(exons):
     if len(exons) == 0: return
-    try: exons = exons.tolist()
-    except AttributeError: pass
-    exons = [tuple(x) for x in exons]
-    G = nx.Graph()
-    G.add_nodes_from(exons)
-    overlapping_exons = find_overlapping_exons(exons)
-    G.add_edges_from( overlapping_exons )
-    
-    for clustered_exons in nx.connected_components(G):
-        if len( clustered_exons ) == 1:
-            yield clustered_exons[0]
+    exons = build_intervals_array(exons)
+    clusters = find_overlapping_exon_clusters(exons)
+    cluster_sizes = numpy.bincount(clusters)
+    for exon in exons[cluster_sizes[clusters] == 1].tolist():
+        yield tuple(exon)
     
     return
 
@@ -110,25 +142,29 @@ def cluster_elements( tss_exons, internal_exons, tes_exons, se_transcripts,
     assert isinstance( promoters, set )
     assert isinstance( polyas, set )
     
-    all_exons = sorted( chain(tss_exons, internal_exons, 
-                              tes_exons, se_transcripts,
-                              promoters, polyas) )
+    all_exons = build_intervals_array( chain(
+            tss_exons, internal_exons, tes_exons, se_transcripts,
+            promoters, polyas) )
     if len(all_exons) == 0: return
+    exon_ids = dict( (exon, i) for i, exon 
+                     in enumerate(map(tuple, all_exons.tolist())) )
     
-    G = nx.Graph()
-    G.add_nodes_from(all_exons)
-    overlapping_exons = find_overlapping_exons(all_exons)
-    G.add_edges_from( overlapping_exons )
+    # join adjacent exons in the same overlap cluster, and junction 
+    # connected exons
+    clusters = find_overlapping_exon_clusters(all_exons)
+    edges = [ (i, i+1) for i in numpy.flatnonzero(
+            clusters[1:] == clusters[:-1]).tolist() ]
     jns_and_connected_exons = find_jn_connected_exons(all_exons, jns, strand)
-    edges = []
     observed_jns = set()
     for jn, start, stop in jns_and_connected_exons:
         observed_jns.add(jn)
-        edges.append((start, stop))
-    G.add_edges_from(edges)
+        edges.append((exon_ids[start], exon_ids[stop]))
     
-    for gene in nx.connected_component_subgraphs(G):
-        exons = gene.nodes()
+    components = find_connected_components(len(all_exons), edges)
+    genes_exons = [ [] for i in xrange(components.max()+1) ]
+    for exon, component in izip(all_exons.tolist(), components):
+        genes_exons[component].append(tuple(exon))
+    for exons in genes_exons:
         yield ( tss_exons.intersection( exons ),
                 tes_exons.intersection( exons ),
                 internal_exons.intersection( exons ),
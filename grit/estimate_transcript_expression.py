@@ -34,10 +34,15 @@ import Queue
 
 import multiprocessing
 from multiprocessing.sharedctypes import RawArray, RawValue
-from lib.multiprocessing_utils import Pool, ThreadSafeFile
+from lib.multiprocessing_utils import (
+    Pool, ThreadSafeFile, WorkStealingScheduler )
+from lib.profiling import StageMetrics
+from lib.checkpoint import (
+    get_gene_checkpoint, get_checkpoint_manifest, 
+    calc_signature, calc_files_signature )
 
 from files.gtf import load_gtf, Transcript, Gene
-from files.reads import fix_chrm_name_for_ucsc
+from files.reads import fix_chrm_name_for_ucsc, GeneReadCache
 
 import f_matrix
 import frequency_estimation
@@ -46,6 +51,7 @@ from frag_len import load_fl_dists, FlDist, build_normal_density
 import config
 
 import cPickle as pickle
+import shutil
 
 SAMPLE_ID = None
 REP_ID = None
@@ -53,6 +59,17 @@ REP_ID = None
 class NoDesignMatrixError(Exception):
     pass
 
+def calc_quantification_signature(pickled_gene_fnames):
+    """Return the signature of the inputs to the quantification checkpoints.
+
+    """
+    return calc_signature(
+        calc_files_signature(sorted(pickled_gene_fnames)), SAMPLE_ID, REP_ID,
+        config.MAX_NUM_TRANSCRIPTS_TO_QUANTIFY, config.CB_SIG_LEVEL,
+        config.ESTIMATE_LOWER_CONFIDENCE_BOUNDS, 
+        config.ESTIMATE_UPPER_CONFIDENCE_BOUNDS,
+        config.STREAM_GENE_QUANTIFICATION )
+
 class SharedData(object):
     """Share data across processes.
 
@@ -76,47 +93,42 @@ class SharedData(object):
         if self._cached_fmat_gene_id == gene_id:
             return self._cached_fmat
 
-        with self.design_mat_lock: 
-            fname = self.design_mat_filenames[gene_id].value
-        if fname == '': 
+        try: f_mat = self.design_matrices.get(gene_id)
+        except KeyError:
             raise NoDesignMatrixError, "No design matrix for '%s'" % gene_id
-        with open(fname) as fp:
-            f_mat = pickle.load(fp)
         self._cached_fmat_gene_id = gene_id
         self._cached_fmat = f_mat
         return f_mat
     
     def set_design_matrix(self, gene_id, f_mat):
-        ofname = config.get_fmat_tmp_fname(gene_id, SAMPLE_ID, REP_ID)
-        
         # because there's no cache invalidation mechanism, we're only
-        # allowed to set the f_mat object once. This also allows us to
-        # move the load outside of the lock
-        try: assert self.design_mat_filenames[gene_id].value == ''
-        except:
+        # allowed to set the f_mat object once
+        try: offset = self.design_matrices.add(gene_id, f_mat)
+        except ValueError:
             config.log_statement(
-                "%s has already had its design matrix set (%s)" % (
-                    gene_id, self.design_mat_filenames[gene_id].value ), 
+                "%s has already had its design matrix set" % gene_id, 
                 log=True)
             return
         
-        with open(ofname, "w") as ofp:
-            pickle.dump(f_mat, ofp)
-        
-        with self.design_mat_lock: 
-            self.design_mat_filenames[gene_id].value = ofname
+        num_reads = ( f_mat.num_rnaseq_reads, 
+                      f_mat.num_fp_reads, 
+                      f_mat.num_tp_reads )
+        self._add_num_reads(num_reads)
+        if self._fmats_checkpoint != None:
+            self._fmats_checkpoint.add(gene_id, (offset, num_reads))
         
-        if f_mat.num_rnaseq_reads != None:
+        return
+    
+    def _add_num_reads(self, (num_rnaseq_reads, num_fp_reads, num_tp_reads)):
+        if num_rnaseq_reads != None:
             with self.num_rnaseq_reads.get_lock():
-                self.num_rnaseq_reads.value += f_mat.num_rnaseq_reads
-        if f_mat.num_fp_reads != None:
+                self.num_rnaseq_reads.value += num_rnaseq_reads
+        if num_fp_reads != None:
             with self.num_cage_reads.get_lock():
-                self.num_cage_reads.value += f_mat.num_fp_reads
-        if f_mat.num_tp_reads != None:
+                self.num_cage_reads.value += num_fp_reads
+        if num_tp_reads != None:
             with self.num_polya_reads.get_lock():
-                self.num_polya_reads.value += f_mat.num_tp_reads
-        
-        return
+                self.num_polya_reads.value += num_tp_reads
     
     def get_num_reads_in_bams(self):
         return (self.num_cage_reads.value, 
@@ -130,6 +142,8 @@ class SharedData(object):
         assert len(mle) == len(gene.transcripts) + 1
         with self.mle_lock: 
             self.mle_estimates[gene.id][:] = mle
+        if self._mles_checkpoint != None:
+            self._mles_checkpoint.add(gene.id, numpy.array(mle))
             
     def get_cbs(self, gene_id, cb_type):
         if cb_type == 'ub':
@@ -139,7 +153,15 @@ class SharedData(object):
         else: 
             assert False, "Unrecognized confidence bound type '%s'" % cb_type
     
-    def set_cbs(self, gene_id, bnd_type_indices_and_values):
+    def set_cbs(self, gene_id, bnd_type_indices_and_values, num_bnds=None):
+        """Set bounds of gene_id. 
+        
+        num_bnds is the total number of bounds that will be set for the gene,
+        which is used to find finished genes when a run is resumed.
+        """
+        if self._cbs_checkpoint != None:
+            self._cbs_checkpoint.add(
+                gene_id, (num_bnds, list(bnd_type_indices_and_values)))
         with self.cbs_lock: 
             for cb_type, index, value in bnd_type_indices_and_values:
                 if cb_type == 'ub':
@@ -151,6 +173,74 @@ class SharedData(object):
         
         return
     
+    def _init_checkpoints(self):
+        """Open the checkpoints, and restore the finished design matrices.
+
+        Returns the restored design matrix offsets.
+        """
+        self._fmats_checkpoint = None
+        self._mles_checkpoint = None
+        self._cbs_checkpoint = None
+        if not config.WRITE_CHECKPOINTS: 
+            return {}
+        
+        signature = calc_quantification_signature(
+            [self.gene_fname_mapping[x] for x in self.gene_ids])
+        self._fmats_checkpoint = get_gene_checkpoint(
+            'design_matrices', signature, SAMPLE_ID, REP_ID)
+        self._mles_checkpoint = get_gene_checkpoint(
+            'mles', signature, SAMPLE_ID, REP_ID)
+        self._cbs_checkpoint = get_gene_checkpoint(
+            'cbs', signature, SAMPLE_ID, REP_ID)
+
+        restored_offsets = {}
+        fmats_fname = config.get_fmat_store_fname(SAMPLE_ID, REP_ID)
+        if os.path.exists(fmats_fname):
+            fmats_size = os.path.getsize(fmats_fname)
+            for gene_id, (offset, num_reads) in self._fmats_checkpoint.items():
+                if offset >= fmats_size: continue
+                restored_offsets[gene_id] = offset
+                self._add_num_reads(num_reads)
+        if len(restored_offsets) > 0:
+            config.log_statement( "Restored %i design matrices" 
+                                  % len(restored_offsets), log=True )
+        return restored_offsets
+    
+    def restore_checkpointed_estimates(self):
+        """Restore the MLEs and bounds found by a previous run.
+
+        The genes that were finished are added to restored_mle_gene_ids 
+        and restored_cbs_gene_ids.
+        """
+        if self._mles_checkpoint != None:
+            for gene_id, mle in self._mles_checkpoint.items():
+                if len(mle) != len(self.mle_estimates[gene_id]): continue
+                self.mle_estimates[gene_id][:] = mle
+                self.restored_mle_gene_ids.add(gene_id)
+        
+        if self._cbs_checkpoint != None:
+            gene_bnds = defaultdict(dict)
+            gene_num_bnds = {}
+            for gene_id, (num_bnds, cbs) in self._cbs_checkpoint.items():
+                gene_num_bnds[gene_id] = num_bnds
+                for cb_type, index, value in cbs:
+                    gene_bnds[gene_id][(cb_type, index)] = value
+            for gene_id, bnds in gene_bnds.iteritems():
+                if ( gene_id not in self.restored_mle_gene_ids 
+                     or len(bnds) != gene_num_bnds[gene_id] ): 
+                    continue
+                for (cb_type, index), value in bnds.iteritems():
+                    if cb_type == 'ub': self.ubs[gene_id][index] = value
+                    else: self.lbs[gene_id][index] = value
+                self.restored_cbs_gene_ids.add(gene_id)
+        
+        if len(self.restored_mle_gene_ids) > 0:
+            config.log_statement( 
+                "Restored %i MLEs and the bounds of %i genes" % (
+                    len(self.restored_mle_gene_ids), 
+                    len(self.restored_cbs_gene_ids)), log=True )
+        return
+    
     def __init__(self, pickled_gene_fnames):        
         self._manager = multiprocessing.Manager()
         
@@ -163,10 +253,6 @@ class SharedData(object):
         self.lbs = {}
         self.ubs = {}
         
-        # store data that all children need to be able to access        
-        self.design_mat_filenames = {}
-        self.design_mat_lock = multiprocessing.Lock()    
-        
         self.mle_lock = multiprocessing.Lock()    
         self.cbs_lock = multiprocessing.Lock()    
         
@@ -180,14 +266,17 @@ class SharedData(object):
             self.gene_fname_mapping[gene_id] = fname
             self.gene_ntranscripts_mapping[gene_id] = n_transcripts
             self.gene_ids.append(gene_id)
-            
-            self.design_mat_filenames[gene_id] = multiprocessing.Array(
-                'c', 1000)
-            self.design_mat_filenames[gene_id].value = ''
         
         self.num_rnaseq_reads = multiprocessing.Value('i', 0)
         self.num_cage_reads = multiprocessing.Value('i', 0)
         self.num_polya_reads = multiprocessing.Value('i', 0)
+        
+        # store data that all children need to be able to access        
+        self.restored_mle_gene_ids = set()
+        self.restored_cbs_gene_ids = set()
+        self.design_matrices = f_matrix.DesignMatrixStore(
+            config.get_fmat_store_fname(SAMPLE_ID, REP_ID), self.gene_ids,
+            self._init_checkpoints())
 
                 
         # create objects to cache gene objects, so that we dont have to do a 
@@ -206,6 +295,7 @@ class SharedData(object):
                 'd', [-1]*n_trans)
             self.lbs[gene_id] = RawArray(
                 'd', [-1]*n_trans)
+        self.restore_checkpointed_estimates()
     
 
 def calc_effective_transcript_length(t, fl_dists_and_weights):
@@ -254,7 +344,7 @@ def calc_fpkm( gene, fl_dists, freqs, num_reads_in_bam):
 
 def find_confidence_bounds_in_gene( gene, num_reads_in_bams,
                                     f_mat, mle_estimate, 
-                                    trans_indices, cntr,
+                                    trans_indices, cntr, lhd_evals_cntr,
                                     cb_alpha):
     # update the mle_estimate array to only store observable transcripts
     # add 1 to skip the out of gene bin
@@ -275,6 +365,9 @@ def find_confidence_bounds_in_gene( gene, num_reads_in_bams,
     #    observable_trans_indices, trans_indices]), log=True)
     #assert n_skipped == n_skipped_tmp
     
+    # all of the bounds that this process finds share the likelihood 
+    # evaluations, and warm starts, in a single session
+    session = None
     res = []
     while True:
         with cntr.get_lock():
@@ -288,11 +381,42 @@ def find_confidence_bounds_in_gene( gene, num_reads_in_bams,
         
         config.log_statement( 
             "Estimating %s confidence bound for gene %s (%i/%i remain)" % ( 
-                bnd_type, gene.id, cntr.value+1, len(gene.transcripts)))
+                bnd_type, gene.id, cntr.value+1, len(trans_indices)))
         try:
-            p_value, bnd = frequency_estimation.estimate_confidence_bound( 
-                f_mat, num_reads_in_bams,
-                exp_mat_row, mle_estimate, bnd_type, cb_alpha )
+            try:
+                if session == None:
+                    expected_array, observed_array = \
+                        f_mat.expected_and_observed(bam_cnts=num_reads_in_bams)
+                    session = frequency_estimation.ConfidenceBoundsSession(
+                        expected_array, observed_array, mle_estimate, cb_alpha)
+                # cap the likelihood evaluations across every process that 
+                # is working on this gene
+                with lhd_evals_cntr.get_lock():
+                    num_lhd_evals_left = max(
+                        0, config.MAX_NUM_CB_LHD_EVALS - lhd_evals_cntr.value)
+                num_lhd_evals = session.num_lhd_evals
+                session.max_num_lhd_evals = num_lhd_evals + num_lhd_evals_left
+                with StageMetrics('confidence_bound_%s' % bnd_type, gene.id,
+                                  transcript_index=trans_index,
+                                  num_transcripts=len(gene.transcripts)
+                                  ) as metrics:
+                    p_value, bnd = session.estimate_bound(
+                        exp_mat_row, bnd_type)
+                    metrics.set_sizes(
+                        num_lhd_evals=session.num_lhd_evals - num_lhd_evals)
+                with lhd_evals_cntr.get_lock():
+                    lhd_evals_cntr.value += (
+                        session.num_lhd_evals - num_lhd_evals)
+            except Exception, inst:
+                # fall back to the line search
+                config.log_statement( 
+                    "%i: The profile likelihood search failed for %s (%s) - "
+                    "using the line search" % (os.getpid(), gene.id, inst),
+                    log=True )
+                config.log_statement( traceback.format_exc(), log=True )
+                p_value, bnd = frequency_estimation.estimate_confidence_bound(
+                    f_mat, num_reads_in_bams, exp_mat_row, mle_estimate,
+                    bnd_type, cb_alpha)
         except Exception, inst:
             p_value = 1.
             bnd = 0.0 if bnd_type == 'lb' else 1.0
@@ -315,8 +439,20 @@ def find_confidence_bounds_in_gene( gene, num_reads_in_bams,
     
     return res
 
+def build_confidence_bound_indices( f_mat, bnd_types ):
+    """Return the (transcript index, expected array column, bound type) list.
+
+    The bounds of each transcript are next to each other, so that every
+    search is warm started from a neighbouring solution.
+    """
+    trans_indices = []
+    for row_num, t_index in enumerate(f_mat.transcript_indices()):
+        for bnd_type in bnd_types:
+            trans_indices.append((t_index, row_num+1, bnd_type))
+    return trans_indices
+
 def find_confidence_bounds_worker( 
-        data, gene_ids, trans_index_cntrs, bnd_type ):
+        data, gene_ids, trans_index_cntrs, lhd_evals_cntrs, bnd_types ):
     def get_new_gene():
         
         # get a gene to process
@@ -339,10 +475,7 @@ def find_confidence_bounds_worker(
             raise
 
         mle_estimate = data.get_mle(gene_id)
-        
-        trans_indices = []
-        for row_num, t_index in enumerate(f_mat.transcript_indices()):
-            trans_indices.append((t_index, row_num+1, bnd_type))
+        trans_indices = build_confidence_bound_indices(f_mat, bnd_types)
 
         cntr = trans_index_cntrs[gene_id]
         with cntr.get_lock():
@@ -366,10 +499,7 @@ def find_confidence_bounds_worker(
         gene = data.get_gene(longest_gene_id)
         f_mat = data.get_design_matrix(longest_gene_id)
         mle_estimate = data.get_mle(longest_gene_id)
-
-        trans_indices = []
-        for row_num, t_index in enumerate(f_mat.transcript_indices()):
-            trans_indices.append((t_index, row_num+1, bnd_type))
+        trans_indices = build_confidence_bound_indices(f_mat, bnd_types)
         
         return ( gene, f_mat, mle_estimate, 
                  trans_indices, trans_index_cntrs[longest_gene_id] )
@@ -391,9 +521,9 @@ def find_confidence_bounds_worker(
             cbs = find_confidence_bounds_in_gene( 
                 gene, num_reads_in_bams,
                 f_mat, mle_estimate, 
-                trans_indices, cntr,
+                trans_indices, cntr, lhd_evals_cntrs[gene.id],
                 cb_alpha=config.CB_SIG_LEVEL)
-            data.set_cbs(gene.id, cbs)
+            data.set_cbs(gene.id, cbs, len(trans_indices))
             
             if config.VERBOSE:
                 config.log_statement("Finished processing '%s'" % gene.id)
@@ -403,7 +533,10 @@ def find_confidence_bounds_worker(
     config.log_statement("")
     return
 
-def estimate_confidence_bounds( data, bnd_type ):
+def estimate_confidence_bounds( data, bnd_types ):
+    """Estimate the bnd_types ('lb', 'ub') confidence bounds of every gene.
+
+    """
     config.log_statement(
         "Populating estimate confidence bounds queue.")
 
@@ -411,18 +544,22 @@ def estimate_confidence_bounds( data, bnd_type ):
     # sort so that the biggest genes are processed first
     gene_ids = multiprocessing.Queue()
     trans_index_cntrs = {}
+    lhd_evals_cntrs = {}
     sorted_gene_ids = sorted(data.gene_ids, 
                              key=lambda x:data.gene_ntranscripts_mapping[x],
                              reverse=True)
     for i, gene_id in enumerate(sorted_gene_ids):
+        # skip genes whose bounds were restored from a checkpoint
+        if gene_id in data.restored_cbs_gene_ids: continue
         gene_ids.put(gene_id)
         trans_index_cntrs[gene_id] = multiprocessing.Value( 'i', -1000)
+        lhd_evals_cntrs[gene_id] = multiprocessing.Value( 'l', 0)
     
     config.log_statement("Waiting on gene bounds children")
 
     if False and config.NTHREADS == 1:
         find_confidence_bounds_worker( 
-            data, gene_ids, trans_indices_queues, bnd_type )
+            data, gene_ids, trans_index_cntrs, lhd_evals_cntrs, bnd_types )
     else:
         pids = []
         for i in xrange(config.NTHREADS):
@@ -431,7 +568,7 @@ def estimate_confidence_bounds( data, bnd_type ):
                 try: 
                     find_confidence_bounds_worker(
                         data, gene_ids, 
-                        trans_index_cntrs, bnd_type)
+                        trans_index_cntrs, lhd_evals_cntrs, bnd_types)
                 except Exception, inst:
                     config.log_statement( traceback.format_exc(), log=True )
                 finally:
@@ -445,96 +582,154 @@ def estimate_confidence_bounds( data, bnd_type ):
     return
 
 
-def estimate_mle_worker( gene_ids, data ):
-    while True:
-        config.log_statement("Retrieving gene from queue")
-        gene_id = gene_ids.get()
-        if gene_id == 'FINISHED': 
-            config.log_statement("")
-            return
-        
-        try:
-            config.log_statement(
-                "Loading gene %s" % gene_id )
-            gene = data.get_gene(gene_id)
-              
+def load_gene_and_arrays_for_mle( gene_id, data ):
+    """Load a gene and its observed and expected arrays.
+
+    Returns None if the gene can't be quantified.
+    """
+    config.log_statement(
+        "Loading gene %s" % gene_id )
+    gene = data.get_gene(gene_id)
+    
+    try: 
+        f_mat = data.get_design_matrix(gene_id)
+    except NoDesignMatrixError:
+        if config.DEBUG_VERBOSE:
+            config.log_statement("No design matrix for '%s'" % gene_id, 
+                                 log=True)
+        return None
+    num_reads_in_bams = data.get_num_reads_in_bams()
+    expected_array, observed_array = f_mat.expected_and_observed(
+        num_reads_in_bams)
+    if expected_array is None and observed_array is None: 
+        return None
+    return gene, f_mat, observed_array, expected_array
+
+def estimate_gene_mle( gene, f_mat, observed_array, expected_array, 
+                       data, mle=None ):
+    """Find (unless it is provided) and store the MLE for gene.
+
+    """
+    try:
+        if mle is None:
             config.log_statement(
                 "Finding MLE for Gene %s(%s:%s:%i-%i) - %i transcripts" \
                     % (gene.id, gene.chrm, gene.strand, 
                        gene.start, gene.stop, len(gene.transcripts) ) )
-            
-            try: 
-                f_mat = data.get_design_matrix(gene_id)
-            except NoDesignMatrixError:
-                if config.DEBUG_VERBOSE:
-                    config.log_statement("No design matrix for '%s'" % gene_id, 
-                                         log=True)
-                continue
-            num_reads_in_bams = data.get_num_reads_in_bams()
-            expected_array, observed_array = f_mat.expected_and_observed(
-                num_reads_in_bams)
-            if (expected_array, observed_array) == (None, None): 
-                continue
-            mle = frequency_estimation.estimate_transcript_frequencies( 
-                observed_array, expected_array)
-        except Exception, inst:
-            error_msg = "%i: Skipping %s (%s:%s:%i-%i): %s" % (
-                os.getpid(), gene.id, 
-                gene.chrm, gene.strand, gene.start, gene.stop, inst)
-            config.log_statement( error_msg, log=True )
-            config.log_statement( traceback.format_exc(), log=True )
-            continue
+            with StageMetrics('mle', gene.id, 
+                              num_transcripts=len(gene.transcripts),
+                              num_bins=expected_array.shape[0]):
+                mle = frequency_estimation.estimate_transcript_frequencies( 
+                    observed_array, expected_array)
+    except Exception, inst:
+        error_msg = "%i: Skipping %s (%s:%s:%i-%i): %s" % (
+            os.getpid(), gene.id, 
+            gene.chrm, gene.strand, gene.start, gene.stop, inst)
+        config.log_statement( error_msg, log=True )
+        config.log_statement( traceback.format_exc(), log=True )
+        return
 
-        log_lhd = frequency_estimation.calc_lhd( 
-            mle, observed_array, expected_array)
+    log_lhd = frequency_estimation.calc_lhd( 
+        mle, observed_array, expected_array)
 
-        # add back in the missing trasncripts
-        full_mle = -1*numpy.ones(len(gene.transcripts)+1, dtype=float)
-        full_mle[numpy.array([-1,]+f_mat.transcript_indices().tolist())+1] = mle
-        
-        data.set_mle(gene, full_mle)
-        config.log_statement( "FINISHED MLE %s\t%.2f - updating queues" % ( 
-                gene.id, log_lhd ) )
+    # add back in the missing trasncripts
+    full_mle = -1*numpy.ones(len(gene.transcripts)+1, dtype=float)
+    full_mle[numpy.array([-1,]+f_mat.transcript_indices().tolist())+1] = mle
 
-def estimate_mles( data ):
-    config.log_statement("Initializing MLE queue")
+    data.set_mle(gene, full_mle)
+    config.log_statement( "FINISHED MLE %s\t%.2f - updating queues" % ( 
+            gene.id, log_lhd ) )
+    return
 
-    gene_ids = multiprocessing.Queue()
-    sorted_gene_ids = sorted(data.gene_ids, 
-                             key=lambda x:data.gene_ntranscripts_mapping[x],
-                             reverse=True)
-    # sort so that the biggest genes are processed first
+def estimate_batched_mles( genes_and_arrays, data ):
+    """Estimate the MLEs of many small genes at once.
+
+    Genes that the batched optimizer can't handle are estimated one by one.
+    """
+    config.log_statement( "Finding MLEs for a batch of %i genes" 
+                          % len(genes_and_arrays) )
+    try:
+        with StageMetrics('batched_mle', num_genes=len(genes_and_arrays)):
+            mles = frequency_estimation.estimate_transcript_frequencies_batched(
+                [observed_array for gene, f_mat, observed_array, expected_array
+                 in genes_and_arrays],
+                [expected_array for gene, f_mat, observed_array, expected_array
+                 in genes_and_arrays] )
+    except Exception, inst:
+        config.log_statement( "Batched MLE failed: %s" % inst, log=True )
+        config.log_statement( traceback.format_exc(), log=True )
+        mles = [None]*len(genes_and_arrays)
     
-    args = [ gene_ids, data ]
-    if False and config.NTHREADS == 1:
-        estimate_mle_worker(*args)
-    else:
-        ps = []
-        for i in xrange(config.NTHREADS):
-            pid = os.fork()
-            if pid == 0:
-                try:
-                    estimate_mle_worker(*args)
-                except Exception, inst:
-                    config.log_statement( str(error_msg), log=True )
-                    config.log_statement( traceback.format_exc(), log=True )
-                finally:
-                    os._exit(0)
-            ps.append(pid)
+    for (gene, f_mat, observed_array, expected_array), mle in izip(
+            genes_and_arrays, mles):
+        estimate_gene_mle(
+            gene, f_mat, observed_array, expected_array, data, mle)
+    return
+
+def estimate_mle_worker( gene_ids, data ):
+    # genes with few transcripts are collected and optimized together
+    batch = []
+    for gene_id in gene_ids:
+        if gene_id in data.restored_mle_gene_ids: continue
+        try:
+            rv = load_gene_and_arrays_for_mle( gene_id, data )
+        except Exception, inst:
+            error_msg = "%i: Skipping %s: %s" % ( os.getpid(), gene_id, inst )
+            config.log_statement( error_msg, log=True )
+            config.log_statement( traceback.format_exc(), log=True )
+            continue
+        if rv == None: continue
         
-        # populate the queue
-        config.log_statement("Populating MLE queue")
-        for i, gene_id in enumerate(sorted_gene_ids):
-            gene_ids.put(gene_id)
-        for i in xrange(config.NTHREADS):
-            gene_ids.put("FINISHED")
-        config.log_statement("Waiting on MLE children")
+        gene, f_mat, observed_array, expected_array = rv
+        if ( expected_array.shape[1] 
+             > config.MAX_NUM_TRANSCRIPTS_FOR_BATCHED_MLE ):
+            estimate_gene_mle(
+                gene, f_mat, observed_array, expected_array, data)
+            continue
         
-        for pid in ps:
-            os.waitpid(pid, 0)
+        batch.append( rv )
+        if len(batch) >= config.BATCHED_MLE_SIZE:
+            estimate_batched_mles( batch, data )
+            batch = []
+    
+    if len(batch) > 0:
+        estimate_batched_mles( batch, data )
     
+    config.log_statement("")
     return
 
+def estimate_mles( data ):
+    config.log_statement("Initializing MLE queue")
+    # weight genes by their number of transcripts, so that the biggest 
+    # genes are processed first
+    scheduler = WorkStealingScheduler(
+        data.gene_ids, 
+        [data.gene_ntranscripts_mapping[x] for x in data.gene_ids],
+        config.NTHREADS)
+    config.log_statement("Waiting on MLE children")
+    scheduler.run(estimate_mle_worker, [data,])
+    return
+
+def build_design_matrix( gene, fl_dists, 
+                         (rnaseq_reads, promoter_reads, polya_reads) ):
+    config.log_statement( 
+        "Finding design matrix for Gene %s(%s:%s:%i-%i) - %i transcripts"%(
+            gene.id, gene.chrm, gene.strand, 
+            gene.start, gene.stop, len(gene.transcripts) ) )
+
+    with StageMetrics('design_matrix', gene.id, 
+                      num_transcripts=len(gene.transcripts)) as metrics:
+        gene_rnaseq_reads = GeneReadCache(
+            rnaseq_reads, gene.chrm, gene.strand, [(gene.start, gene.stop)])
+        f_mat = f_matrix.DesignMatrix(
+            gene, fl_dists, 
+            gene_rnaseq_reads, promoter_reads, polya_reads,
+            config.MAX_NUM_TRANSCRIPTS_TO_QUANTIFY)
+        metrics.set_sizes(num_bins=sum(
+                len(array) for array in f_mat.obs_cnt_arrays 
+                if array is not None))
+    return f_mat
+
 def build_design_matrices_worker( gene_ids, 
                                   data, fl_dists,
                                   (rnaseq_reads, promoter_reads, polya_reads)):
@@ -544,24 +739,14 @@ def build_design_matrices_worker( gene_ids,
     if promoter_reads != None: promoter_reads = promoter_reads.reload()
     if polya_reads != None: polya_reads = polya_reads.reload()
     
-    while True:
-        config.log_statement("Acquiring gene to process")        
-        gene_id = gene_ids.get()
-        if gene_id == 'FINISHED': 
-            config.log_statement("")
-            return
+    for gene_id in gene_ids:
+        # skip genes whose design matrix was restored from a checkpoint
+        if gene_id in data.design_matrices: continue
         try:
             config.log_statement("Loading gene '%s'" % gene_id)
             gene = data.get_gene(gene_id)
-            config.log_statement( 
-                "Finding design matrix for Gene %s(%s:%s:%i-%i) - %i transcripts"%(
-                    gene.id, gene.chrm, gene.strand, 
-                    gene.start, gene.stop, len(gene.transcripts) ) )
-            
-            f_mat = f_matrix.DesignMatrix(
-                gene, fl_dists, 
-                rnaseq_reads, promoter_reads, polya_reads,
-                config.MAX_NUM_TRANSCRIPTS_TO_QUANTIFY)
+            f_mat = build_design_matrix(
+                gene, fl_dists, (rnaseq_reads, promoter_reads, polya_reads))
             
             config.log_statement( "WRITING DESIGN MATRIX TO DISK %s" % gene.id )
             data.set_design_matrix(gene.id, f_mat)
@@ -577,57 +762,25 @@ def build_design_matrices_worker( gene_ids,
                 os.getpid(), gene_id, inst )
             config.log_statement( 
                 error_msg + "\n" + traceback.format_exc(), log=True )
+    
+    config.log_statement("")
+    return
 
 def build_design_matrices( data, fl_dists,
                            (rnaseq_reads, promoter_reads, polya_reads)):    
     assert fl_dists != None
-    gene_ids = multiprocessing.Queue()
     config.log_statement( "Populating build design matrices queue" )
-    sorted_gene_ids = sorted(data.gene_ids, 
-                             key=lambda x:data.gene_ntranscripts_mapping[x],
-                             reverse=True)
-    # sort so that the biggest genes are processed first
+    # weight genes by their number of transcripts, so that the biggest 
+    # genes are processed first
+    scheduler = WorkStealingScheduler(
+        data.gene_ids, 
+        [data.gene_ntranscripts_mapping[x] for x in data.gene_ids],
+        config.NTHREADS)
     config.log_statement("FINISHED Populating build design matrices queue")
     
-    args = [ gene_ids, data, fl_dists, 
-             (rnaseq_reads, promoter_reads, polya_reads)]
-    if False and config.NTHREADS == 1:
-        build_design_matrices_worker(*args)
-    else:
-        ps = []
-        for i in xrange(config.NTHREADS):
-            #p = multiprocessing.Process(
-            #    target=build_design_matrices_worker, args=args)
-            #p.start()
-            #ps.append(p)
-            pid = os.fork()
-            if pid == 0:
-                try:
-                    build_design_matrices_worker(*args)
-                except Exception, inst:
-                    config.log_statement( str(error_msg), log=True )
-                    config.log_statement( traceback.format_exc(), log=True )
-                finally:
-                    os._exit(0)
-            ps.append(pid)
-        
-        # populate the queue
-        config.log_statement("Populating design matrix queue")
-        for i, gene_id in enumerate(sorted_gene_ids):
-            gene_ids.put(gene_id)
-        for i in xrange(config.NTHREADS):
-            gene_ids.put('FINISHED')
-        config.log_statement("Waiting on design matrix children")
-        
-        #while any( p != None and p.is_alive() for p in ps ):
-        #while len(ps) > 0:
-        #    config.log_statement(
-        #   "Waiting for design matrix children processes to finish (%i/%i genes remain)"%(
-        #            gene_ids.qsize(), len(data.gene_ids)))
-        #    time.sleep(1.)
-        for pid in ps:
-            config.log_statement("Waiting on pid '%i'" % pid)
-            os.waitpid(pid, 0)
+    args = [ data, fl_dists, (rnaseq_reads, promoter_reads, polya_reads)]
+    config.log_statement("Waiting on design matrix children")
+    scheduler.run(build_design_matrices_worker, args)
 
     config.log_statement("Read counts: %s" % str(data.get_num_reads_in_bams()), 
                          log=True)
@@ -640,10 +793,10 @@ def build_gene_lines_for_tracking_file(
     mles = data.get_mle(gene_id)
     mle_fpkms = calc_fpkm( gene, fl_dists, mles[1:], num_reads_in_bams)
     ubs = data.get_cbs(gene_id, 'ub')
-    if ubs != None:
+    if ubs is not None:
         ub_fpkms = calc_fpkm( gene, fl_dists, ubs, num_reads_in_bams)
     lbs = data.get_cbs(gene_id, 'lb')
-    if lbs != None:
+    if lbs is not None:
         lb_fpkms = calc_fpkm( gene, fl_dists, lbs, num_reads_in_bams)
     try: sorted_transcripts = sorted(gene.transcripts,
                                      key=lambda x: int(x.id.split("_")[-1]))
@@ -655,25 +808,28 @@ def build_gene_lines_for_tracking_file(
         line.append(t.id.ljust(11))
         line.append(t.gene_id.ljust(11))
         line.append('-'.ljust(8))
-        if mles == None or mle_fpkms[i] == None: line.append('-       ')
+        if mles is None or mle_fpkms[i] == None: line.append('-       ')
         else: line.append(('%.2e' % mle_fpkms[i]).ljust(8))
-        if lbs == None or lb_fpkms[i] == None: line.append('-       ')
+        if lbs is None or lb_fpkms[i] == None: line.append('-       ')
         else: line.append(('%.2e' % lb_fpkms[i]).ljust(8))
-        if ubs == None or ub_fpkms[i] == None: line.append('-       ')
+        if ubs is None or ub_fpkms[i] == None: line.append('-       ')
         else: line.append(('%.2e' % ub_fpkms[i]).ljust(8))
         line.append( "OK" )
         lines.append("\t".join(line))
     
     return lines
 
-def write_data_to_tracking_file(data, fl_dists, ofp):
-    num_reads_in_bams = data.get_num_reads_in_bams()
+def write_tracking_file_header(ofp):
     ofp.write("\t".join(
             ["tracking_id", "gene_id ",
              "coverage", "FPKM    ",
              "FPKM_lo ", "FPKM_hi ", "status"] 
             ) + "\n")
 
+def write_data_to_tracking_file(data, fl_dists, ofp):
+    num_reads_in_bams = data.get_num_reads_in_bams()
+    write_tracking_file_header(ofp)
+
     try: 
         sorted_gene_ids = sorted(
             data.gene_ids, key=lambda x: int(x.split("_")[-1]))
@@ -690,6 +846,130 @@ def write_data_to_tracking_file(data, fl_dists, ofp):
         else:
             ofp.write("\n".join(lines) + "\n" )
 
+def estimate_num_reads_in_bams(promoter_reads, rnaseq_reads, polya_reads):
+    """Estimate the (cage, rnaseq, polya) read totals without binning reads.
+
+    The totals are taken from the bam indices. They are bam wide, so they 
+    include the reads that fall outside of every gene, and the FPKMs differ 
+    from the batch path, which normalizes by the reads counted in the genes'
+    design matrices. The read counts found while building the elements are 
+    not used because they cover every replicate of the sample.
+    """
+    num_reads_in_bams = []
+    for reads in (promoter_reads, rnaseq_reads, polya_reads):
+        if reads == None:
+            num_reads_in_bams.append(0)
+            continue
+        num_reads = sum(reads.contig_read_counts().values())
+        # the index counts both reads in a pair, but the design matrices
+        # count fragments
+        if reads.reads_are_paired: num_reads /= 2
+        num_reads_in_bams.append(num_reads)
+    
+    return tuple(num_reads_in_bams)
+
+def quantify_gene( gene_id, data, fl_dists, 
+                   (rnaseq_reads, promoter_reads, polya_reads),
+                   num_reads_in_bams, bnd_types ):
+    """Build the design matrix, and estimate the MLE and bounds of a gene.
+
+    """
+    # skip genes that were finished by a previous run
+    if gene_id in data.restored_mle_gene_ids and (
+            len(bnd_types) == 0 or gene_id in data.restored_cbs_gene_ids):
+        return
+    gene = data.get_gene(gene_id)
+    try:
+        f_mat = build_design_matrix(
+            gene, fl_dists, (rnaseq_reads, promoter_reads, polya_reads))
+    except f_matrix.NoObservableTranscriptsError:
+        if config.DEBUG_VERBOSE:
+            config.log_statement(
+                "No observable transcripts for '%s'" % gene_id, log=True)
+        return
+    
+    expected_array, observed_array = f_mat.expected_and_observed(
+        num_reads_in_bams)
+    if expected_array is None and observed_array is None: 
+        return
+    estimate_gene_mle(gene, f_mat, observed_array, expected_array, data)
+    
+    mle_estimate = data.get_mle(gene_id)
+    # the MLE estimation failed
+    if len(bnd_types) == 0 or mle_estimate[0] < 0: 
+        return
+    
+    trans_indices = build_confidence_bound_indices(f_mat, bnd_types)
+    cbs = find_confidence_bounds_in_gene( 
+        gene, num_reads_in_bams,
+        f_mat, mle_estimate, 
+        trans_indices, 
+        multiprocessing.Value('i', len(trans_indices)-1), 
+        multiprocessing.Value('l', 0),
+        cb_alpha=config.CB_SIG_LEVEL)
+    data.set_cbs(gene.id, cbs, len(trans_indices))
+    return
+
+def quantify_genes_worker( gene_ids, data, fl_dists,
+                           (rnaseq_reads, promoter_reads, polya_reads),
+                           num_reads_in_bams, bnd_types, ofp ):
+    config.log_statement("Reloading read data in subprocess")
+    if rnaseq_reads != None: rnaseq_reads = rnaseq_reads.reload()
+    if promoter_reads != None: promoter_reads = promoter_reads.reload()
+    if polya_reads != None: polya_reads = polya_reads.reload()
+    
+    for gene_id in gene_ids:
+        try:
+            quantify_gene( gene_id, data, fl_dists, 
+                           (rnaseq_reads, promoter_reads, polya_reads),
+                           num_reads_in_bams, bnd_types )
+        except Exception, inst:
+            error_msg = "%i: Skipping %s: %s" % (
+                os.getpid(), gene_id, inst )
+            config.log_statement( 
+                error_msg + "\n" + traceback.format_exc(), log=True )
+
+        try: 
+            lines = build_gene_lines_for_tracking_file(
+                gene_id, data, num_reads_in_bams, fl_dists)
+        except Exception, inst:
+            config.log_statement("Skipping '%s': %s" % (gene_id, str(inst)))
+            config.log_statement( traceback.format_exc(), log=True )
+        else:
+            ofp.write("\n".join(lines) + "\n" )
+        
+        config.log_statement( "FINISHED QUANTIFYING %s" % gene_id )
+    
+    config.log_statement("")
+    return
+
+def stream_transcript_expression( data, fl_dists, 
+                                  (rnaseq_reads, promoter_reads, polya_reads),
+                                  bnd_types, ofp ):
+    """Quantify every gene, and write it to ofp as soon as it is finished.
+
+    The genes are written in the order that they finish, rather than sorted
+    by gene id.
+    """
+    assert fl_dists != None
+    num_reads_in_bams = estimate_num_reads_in_bams(
+        promoter_reads, rnaseq_reads, polya_reads)
+    config.log_statement("Estimated read counts: %s" % str(num_reads_in_bams), 
+                         log=True)
+    
+    write_tracking_file_header(ofp)
+    # weight genes by their number of transcripts, so that the biggest 
+    # genes are processed first
+    scheduler = WorkStealingScheduler(
+        data.gene_ids, 
+        [data.gene_ntranscripts_mapping[x] for x in data.gene_ids],
+        config.NTHREADS)
+    args = [ data, fl_dists, (rnaseq_reads, promoter_reads, polya_reads),
+             num_reads_in_bams, bnd_types, ofp ]
+    config.log_statement("Waiting on quantification children")
+    scheduler.run(quantify_genes_worker, args)
+    return
+
 def quantify_transcript_expression(
     promoter_reads, rnaseq_reads, polya_reads,
     pickled_gene_fnames, 
@@ -705,12 +985,66 @@ def quantify_transcript_expression(
     
     write_design_matrices=False
 
+    # skip samples that were quantified by a previous run
+    manifest = get_checkpoint_manifest()
+    if manifest != None:
+        stage = os.path.basename(ofname)
+        signature = calc_quantification_signature(
+            [fname for gene_id, n_transcripts, fname in pickled_gene_fnames])
+        if ( config.RESUME_FROM_CHECKPOINTS and os.path.exists(ofname) 
+             and manifest.is_finished(stage, signature) ):
+            config.log_statement( 
+                "WARNING: '%s' already exists - using existing file." % ofname,
+                log=True )
+            return
+        manifest.mark_unfinished(stage)
+
     if config.VERBOSE: config.log_statement( 
         "Initializing processing data" )        
     data = SharedData(pickled_gene_fnames)
+
+    bnd_types = []
+    if config.ESTIMATE_LOWER_CONFIDENCE_BOUNDS: bnd_types.append('lb')
+    if config.ESTIMATE_UPPER_CONFIDENCE_BOUNDS: bnd_types.append('ub')
+
+    if config.STREAM_GENE_QUANTIFICATION:
+        if config.VERBOSE: config.log_statement( 
+            "Quantifying genes and writing them to the tracking file" )
+        data.populate_expression_queue()
+        expression_ofp = ThreadSafeFile(ofname + ".unfinished", "w")
+        stream_transcript_expression( 
+            data, rnaseq_reads.fl_dists,
+            (rnaseq_reads, promoter_reads, polya_reads),
+            bnd_types, expression_ofp )
+    else:
+        estimate_transcript_expression(
+            data, rnaseq_reads.fl_dists, 
+            (rnaseq_reads, promoter_reads, polya_reads), 
+            bnd_types )
+        if config.VERBOSE: config.log_statement( 
+            "Writing output data to tracking file" )
+        expression_ofp = ThreadSafeFile(ofname + ".unfinished", "w")
+        write_data_to_tracking_file(
+            data, rnaseq_reads.fl_dists, expression_ofp)    
+    expression_ofp.close()
+    
+    # we store to unfinished so we know if it errors out early
+    shutil.move(ofname + ".unfinished", ofname)
+    if manifest != None:
+        manifest.mark_finished(stage, signature)
+    
+    return
+
+def estimate_transcript_expression( 
+        data, fl_dists, (rnaseq_reads, promoter_reads, polya_reads), 
+        bnd_types ):
+    """Estimate the MLEs and bnd_types bounds of every gene in data.
+
+    """
+    
     if config.VERBOSE: config.log_statement( 
         "Building design matrices" )
-    build_design_matrices( data, rnaseq_reads.fl_dists,
+    build_design_matrices( data, fl_dists,
                            (rnaseq_reads, promoter_reads, polya_reads))
     
     if config.VERBOSE: config.log_statement( 
@@ -723,25 +1057,11 @@ def quantify_transcript_expression(
     if config.VERBOSE: config.log_statement( 
         "Calculating FPKMS and Writing mle's to output mle" )
     
-    if config.ESTIMATE_LOWER_CONFIDENCE_BOUNDS:
+    if len(bnd_types) > 0:
         if config.VERBOSE: config.log_statement( 
-            "Estimating lower confidence bounds" )
-        estimate_confidence_bounds(data, 'lb')
+            "Estimating confidence bounds" )
+        estimate_confidence_bounds(data, bnd_types)
         if config.VERBOSE: config.log_statement( 
-            "FINISHED Estimating lower confidence bounds" )
-    
-    if config.ESTIMATE_UPPER_CONFIDENCE_BOUNDS:
-        if config.VERBOSE: config.log_statement( 
-            "Estimating upper confidence bounds" )
-        estimate_confidence_bounds(data, 'ub')
-        if config.VERBOSE: config.log_statement( 
-            "FINISHED Estimating upper confidence bounds" )
-    
-    if config.VERBOSE: config.log_statement( 
-        "Writing output data to tracking file" )
-
-    expression_ofp = ThreadSafeFile(ofname, "w")
-    write_data_to_tracking_file(data, rnaseq_reads.fl_dists, expression_ofp)    
-    expression_ofp.close()
+            "FINISHED Estimating confidence bounds" )
     
     return
@@ -17,20 +17,32 @@ You should have received a copy of the GNU General Public License
 along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import sys
+import sys, os
 sys.setrecursionlimit(10000)
 
+import struct
+import mmap
+import hashlib
+import tempfile
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import cPickle as pickle
+
 import numpy
 from scipy.spatial import KDTree
 
 MIN_NUM_MAPPABLE_BASES = 1
 LET_READS_OVERLAP = True
+# bump this when the expected count calculations change, to invalidate the
+# on disk expected counts caches
+EXPECTED_CNTS_CACHE_VERSION = 1
 
 DEBUG=False
 
 from scipy.stats import beta
 
 import config
+from lib.profiling import add_to_counter
 
 import networkx as nx
 
@@ -40,7 +52,8 @@ from itertools import product, izip, chain
 from collections import defaultdict
 
 from grit.files.reads import ( iter_coverage_intervals_for_read, get_read_group,
-                               CAGEReads, RAMPAGEReads, PolyAReads )
+                               CAGEReads, RAMPAGEReads, PolyAReads, 
+                               GeneReadCache )
 
 class NoObservableTranscriptsError(Exception):
     pass
@@ -339,18 +352,16 @@ def iter_possible_fragment_bins_for_splice_graph(
     
     return
 
-def estimate_num_paired_reads_from_bin( 
+def find_paired_read_start_and_stop_bounds( 
         bin, transcript, exon_lens,
         fl_dist, read_len, min_num_mappable_bases=1 ):
-    """
+    """Find the fragment start and stop bounds that produce read pair bin.
 
+    Returns (min_start, max_start, min_stop, max_stop), relative to the first
+    exon in bin[0].
     """
     assert min_num_mappable_bases > 0, \
         "It doesn't make sense to map a read into a segment with 0 bases"
-    #global DEBUG
-    #if transcript == (20, 21):
-    #    print transcript, bin, fl_dist
-    #    DEBUG = True
     
     # calculate the exon lens for the first and second reads
     fr_exon_lens = [ exon_lens[i] for i in bin[0]  ]
@@ -412,6 +423,21 @@ def estimate_num_paired_reads_from_bin(
 
     if DEBUG:
         print "Stop Bnds", min_stop, max_stop
+
+    return min_start, max_start, min_stop, max_stop
+
+def estimate_num_paired_reads_from_bin( 
+        bin, transcript, exon_lens,
+        fl_dist, read_len, min_num_mappable_bases=1 ):
+    """Reference, scalar, implementation of the paired read bin density.
+
+    calc_expected_cnts uses estimate_num_paired_reads_from_bins.
+    """
+    min_start, max_start, min_stop, max_stop = \
+        find_paired_read_start_and_stop_bounds(
+            bin, transcript, exon_lens, 
+            fl_dist, read_len, min_num_mappable_bases)
+
     def do():
         density = 0.0
         for start_pos in xrange( min_start, max_start+1 ):
@@ -428,9 +454,46 @@ def estimate_num_paired_reads_from_bin(
         print "Density", density
         print
     
-    #DEBUG = False
     return float( density )
 
+def estimate_num_paired_reads_from_bins( 
+        bins_and_transcripts, exon_lens,
+        fl_dist, read_len, min_num_mappable_bases=1 ):
+    """Vectorized estimate_num_paired_reads_from_bin over many bins.
+
+    bins_and_transcripts is a sequence of (bin, transcript) tuples, where
+    transcript is the fragment bin that the read pair bin was found from.
+    Every (bin, start position) pair is flattened into a single array, and
+    the per start position densities are looked up from a zero padded
+    prefix sum of the fl cdf and then summed back into their bins.
+    """
+    bnds = numpy.array(
+        [ find_paired_read_start_and_stop_bounds(
+            bin, transcript, exon_lens, 
+            fl_dist, read_len, min_num_mappable_bases)
+          for bin, transcript in bins_and_transcripts ], 
+        dtype=int ).reshape(-1, 4)
+    min_start, max_start, min_stop, max_stop = bnds.T
+    
+    # flatten all of the bins' start positions
+    n_starts = numpy.maximum(max_start - min_start + 1, 0)
+    bin_indices = numpy.repeat(numpy.arange(len(bnds)), n_starts)
+    start_pos = ( numpy.arange(n_starts.sum()) 
+                  - numpy.repeat(n_starts.cumsum() - n_starts, n_starts)
+                  + min_start[bin_indices] )
+    
+    min_fl = numpy.maximum(min_stop[bin_indices] - start_pos, fl_dist.fl_min)
+    max_fl = numpy.minimum(max_stop[bin_indices] - start_pos, fl_dist.fl_max)
+    valid = (min_fl <= max_fl)
+    
+    # cumsum[i] is the probability that a fragment is shorter than fl_min+i
+    cumsum = numpy.hstack(((0.0,), fl_dist.fl_density_cumsum))
+    densities = ( cumsum[max_fl[valid] - fl_dist.fl_min + 1]
+                  - cumsum[min_fl[valid] - fl_dist.fl_min] )
+    
+    return numpy.bincount(
+        bin_indices[valid], weights=densities, minlength=len(bnds))
+
 def calc_expected_cnts( exon_boundaries, transcripts, fl_dist, 
                         r1_len, r2_len,
                         max_num_unmappable_bases=MIN_NUM_MAPPABLE_BASES,
@@ -461,28 +524,132 @@ def calc_expected_cnts( exon_boundaries, transcripts, fl_dist,
             nonoverlapping_indices, nonoverlapping_exon_lens, fl_dist, 
             read_len, min_num_mappable_bases=1 )
         
+        # we can only re-use cached full_bin/bin combos
+        # because it's possible for the middle of a fragment
+        # to skip a region in one transcript, and be spliced
+        # out in another transcript
+        keys = [ (full_bin, bin) 
+                 for full_bin, paired_bins in pair.iteritems()
+                 for bin in paired_bins ]
+        
+        # calculate all of the uncached paired read bin counts at once
+        new_keys = [ key for key in set(keys) 
+                     if key not in cached_f_mat_entries ]
+        pseudo_cnts = estimate_num_paired_reads_from_bins(
+            [ (bin, full_bin) for full_bin, bin in new_keys ],
+            nonoverlapping_exon_lens, fl_dist,
+            read_len, max_num_unmappable_bases )
+        for key, pseudo_cnt in izip(new_keys, pseudo_cnts):
+            cached_f_mat_entries[ key ] = float(pseudo_cnt)
+        
         # add the expected counts for paired reads
-        for full_bin, paired_bins in pair.iteritems():
-            for bin in paired_bins:
-                # we can only re-use cached full_bin/bin combos
-                # because it's possible for the middle of a fragment
-                # to skip a region in one transcript, and be spliced
-                # out in another transcript
-                key = (full_bin, bin)
-                if key in cached_f_mat_entries:
-                    pseudo_cnt = cached_f_mat_entries[ key ]
-                else:
-                    pseudo_cnt = estimate_num_paired_reads_from_bin(
-                        bin, full_bin, 
-                        nonoverlapping_exon_lens, fl_dist,
-                        read_len, max_num_unmappable_bases )
-
-                    cached_f_mat_entries[ key ] = pseudo_cnt
-                if pseudo_cnt > 0:
-                    f_mat_entries[nonoverlapping_indices][bin] = pseudo_cnt
+        for full_bin, bin in keys:
+            pseudo_cnt = cached_f_mat_entries[ (full_bin, bin) ]
+            if pseudo_cnt > 0:
+                f_mat_entries[nonoverlapping_indices][bin] = pseudo_cnt
     
     return f_mat_entries
 
+def calc_expected_cnts_cache_key( exon_boundaries, transcripts, fl_dist, 
+                                  r1_len, r2_len, 
+                                  max_num_unmappable_bases ):
+    """Return a content address for the calc_expected_cnts arguments.
+
+    The expected counts only depend on the lengths of the non-overlapping 
+    exons, so genes with the same structure share a key, wherever they are.
+    """
+    hasher = hashlib.sha1()
+    hasher.update(repr((
+        EXPECTED_CNTS_CACHE_VERSION, 'paired', r1_len, r2_len, 
+        max_num_unmappable_bases, LET_READS_OVERLAP, 
+        fl_dist.fl_min, fl_dist.fl_max)))
+    hasher.update(numpy.asarray(fl_dist.fl_density, dtype=float).tostring())
+    hasher.update(numpy.diff(exon_boundaries).astype(numpy.int64).tostring())
+    hasher.update(repr([tuple(indices) for indices in transcripts]))
+    return hasher.hexdigest()
+
+class ExpectedCntsCache(object):
+    """A persistent, content addressed cache of calc_expected_cnts results.
+
+    Entries are pickled into a file named by their key, which is written to 
+    a temporary file and then moved into place, so concurrent processes 
+    never see a partial entry.
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        try: os.makedirs(dirname)
+        except OSError: 
+            if not os.path.isdir(dirname): raise
+    
+    def _fname(self, key):
+        return os.path.join(self.dirname, key[:2], key)
+    
+    def get(self, key):
+        try:
+            with open(self._fname(key), 'rb') as fp:
+                return pickle.load(fp)
+        except IOError:
+            return None
+        except Exception, inst:
+            config.log_statement( 
+                "WARNING: Could not load cached expected counts '%s': %s" % (
+                    key, inst), log=True )
+            return None
+    
+    def set(self, key, expected_cnts):
+        fname = self._fname(key)
+        try:
+            try: os.mkdir(os.path.dirname(fname))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(fname)): raise
+            fd, tmp_fname = tempfile.mkstemp(
+                dir=os.path.dirname(fname), prefix=".%s." % key)
+            with os.fdopen(fd, 'wb') as ofp:
+                pickle.dump(expected_cnts, ofp, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_fname, fname)
+        except (IOError, OSError), inst:
+            config.log_statement( 
+                "WARNING: Could not cache expected counts '%s': %s" % (
+                    key, inst), log=True )
+
+_expected_cnts_caches = {}
+def get_expected_cnts_cache():
+    """Return the expected counts cache for this run, or None if it's disabled.
+
+    """
+    if not config.CACHE_EXPECTED_CNTS or config.tmp_dir == None:
+        return None
+    dirname = config.get_expected_cnts_cache_dirname()
+    if dirname not in _expected_cnts_caches:
+        _expected_cnts_caches[dirname] = ExpectedCntsCache(dirname)
+    return _expected_cnts_caches[dirname]
+
+def calc_cached_expected_cnts( exon_boundaries, transcripts, fl_dist, 
+                               r1_len, r2_len,
+                               max_num_unmappable_bases=MIN_NUM_MAPPABLE_BASES ):
+    """calc_expected_cnts, with the results stored in the expected cnts cache.
+
+    """
+    cache = get_expected_cnts_cache()
+    if cache == None:
+        return calc_expected_cnts( 
+            exon_boundaries, transcripts, fl_dist, r1_len, r2_len, 
+            max_num_unmappable_bases )
+    
+    key = calc_expected_cnts_cache_key(
+        exon_boundaries, transcripts, fl_dist, r1_len, r2_len, 
+        max_num_unmappable_bases)
+    expected_cnts = cache.get(key)
+    if expected_cnts == None:
+        expected_cnts = calc_expected_cnts( 
+            exon_boundaries, transcripts, fl_dist, r1_len, r2_len, 
+            max_num_unmappable_bases )
+        cache.set(key, expected_cnts)
+    elif config.DEBUG_VERBOSE:
+        config.log_statement("Using cached expected counts '%s'" % key)
+    
+    return expected_cnts
+
 def convert_f_matrices_into_arrays( f_mats, normalize=True ):
     expected_cnts = []
     observed_cnts = []
@@ -574,7 +741,7 @@ def build_expected_and_observed_rnaseq_counts(gene, reads, fl_dists):
     """
     expected_cnts = defaultdict(lambda: defaultdict(float))
     for (rg, (r1_len,r2_len)), (fl_dist, marginal_frac) in fl_dists.iteritems():
-        for transcript, read_bins_and_vals in calc_expected_cnts( 
+        for transcript, read_bins_and_vals in calc_cached_expected_cnts( 
                 exon_boundaries, transcripts_non_overlapping_exon_indices, 
                 fl_dist, r1_len, r2_len).iteritems():
             for read_bin, expected_bin_cnt in read_bins_and_vals.iteritems():
@@ -758,25 +925,46 @@ def find_nonoverlapping_exons_covered_by_segment(exon_bndrys, start, stop):
     return tuple(xrange( bin_1, bin_2+1 ))
  
 
-def bin_rnaseq_reads( reads, chrm, strand, exon_boundaries, include_read_type=True ):
-    """Bin reads into non-overlapping exons.
+def iter_binnable_read_pairs( paired_reads ):
+    """Convert (read1, read2) pairs into the tuples that bin_read_pairs expects.
 
-    exon_boundaries should be a numpy array that contains
-    pseudo exon starts.
     """
-    if not reads.reads_are_stranded: strand = '.'
+    for r1, r2 in paired_reads:
+        if r1.rlen == 0: 
+            rlen = sum( x[1] for x in r1.cigar if x[0] == 0 )
+        else: 
+            rlen = r1.rlen
+            if rlen != r2.rlen:
+                if config.DEBUG_VERBOSE:
+                    config.log_statement(
+                        "WARNING: read lengths are not the same for %s and %s" % (
+                            r1.qname, r2.qname),
+                        log=True, display=False)
+                    config.log_statement(
+                        str(r1), log=True, display=False)
+                    config.log_statement(
+                        str(r2), log=True, display=False)                    
+                continue
+        
+        rg = get_read_group( r1, r2 )
+        yield ( rlen, rg, 
+                tuple(iter_coverage_intervals_for_read( r1 )),
+                tuple(iter_coverage_intervals_for_read( r2 )) )
     
-    # first get the paired reads
-    gene_start = int(exon_boundaries[0])
-    gene_stop = int(exon_boundaries[-1])
-    paired_reads = list( reads.iter_paired_reads(
-            chrm, strand, gene_start, gene_stop+1) )
+    return
+
+def bin_read_pairs( read_pairs, exon_boundaries, include_read_type=True ):
+    """Bin (read_len, read_group, cov_regions_1, cov_regions_2) tuples into 
+       non-overlapping exons.
+
+    """
+    read_pairs = list(read_pairs)
     
     # find the unique subset of contiguous read sub-locations
     read_locs = set()
-    for r in chain(*paired_reads):
-        for start, stop in iter_coverage_intervals_for_read( r ):
-            read_locs.add( (start, stop) )
+    for rlen, rg, r1_cov_regions, r2_cov_regions in read_pairs:
+        read_locs.update( r1_cov_regions )
+        read_locs.update( r2_cov_regions )
     
     # build a mapping from contiguous regions into the non-overlapping exons (
     # ie, exon segments ) that they overlap
@@ -786,34 +974,17 @@ def bin_rnaseq_reads( reads, chrm, strand, exon_boundaries, include_read_type=Tr
             find_nonoverlapping_exons_covered_by_segment( 
                 exon_boundaries, start, stop )
 
-    def build_bin_for_read( read ):
+    def build_bin_for_read( cov_regions ):
         bin = set()
-        for start, stop in iter_coverage_intervals_for_read( read ):
+        for start, stop in cov_regions:
             bin.update( read_locs_into_bins[(start, stop)] )
         return tuple(sorted(bin))
     
     # finally, aggregate the bins
     binned_reads = defaultdict( int )
-    for r1, r2 in paired_reads:
-        if r1.rlen == 0: 
-            rlen = sum( x[1] for x in r1.cigar if x[0] == 0 )
-        else: 
-            rlen = r1.rlen
-            if rlen != r2.rlen:
-                if config.DEBUG_VERBOSE:
-                    config.log_statement(
-                        "WARNING: read lengths are not the same for %s and %s" % (
-                            r1.qname, r2.qname),
-                        log=True, display=False)
-                    config.log_statement(
-                        str(r1), log=True, display=False)
-                    config.log_statement(
-                        str(r2), log=True, display=False)                    
-                continue
-        
-        rg = get_read_group( r1, r2 )
-        bin1 = build_bin_for_read( r1 )
-        bin2 = build_bin_for_read( r2 )
+    for rlen, rg, r1_cov_regions, r2_cov_regions in read_pairs:
+        bin1 = build_bin_for_read( r1_cov_regions )
+        bin2 = build_bin_for_read( r2_cov_regions )
         # skip any reads that don't completely overlap the gene
         if bin1 == () or bin2== () or any(x==() for x in chain(bin1, bin2)): continue
         assert len(bin1) > 0
@@ -824,6 +995,32 @@ def bin_rnaseq_reads( reads, chrm, strand, exon_boundaries, include_read_type=Tr
     
     return dict(binned_reads)
 
+def bin_rnaseq_reads( reads, chrm, strand, exon_boundaries, include_read_type=True ):
+    """Bin reads into non-overlapping exons.
+
+    exon_boundaries should be a numpy array that contains
+    pseudo exon starts. If reads is a GeneReadCache, then the read pairs are
+    taken from the cache and the binned reads are memoized in it.
+    """
+    if isinstance(reads, GeneReadCache):
+        key = (tuple(exon_boundaries), include_read_type)
+        if key not in reads.binned_reads:
+            reads.binned_reads[key] = bin_read_pairs(
+                reads.iter_binnable_read_pairs(), 
+                exon_boundaries, include_read_type)
+        return reads.binned_reads[key]
+    
+    if not reads.reads_are_stranded: strand = '.'
+    
+    # first get the paired reads
+    gene_start = int(exon_boundaries[0])
+    gene_stop = int(exon_boundaries[-1])
+    paired_reads = reads.iter_paired_reads(
+            chrm, strand, gene_start, gene_stop+1)
+    
+    return bin_read_pairs( iter_binnable_read_pairs(paired_reads), 
+                           exon_boundaries, include_read_type )
+
 def bin_single_end_rnaseq_reads(reads, chrm, strand, exon_boundaries):
     # first get the paired reads
     gene_start = int(exon_boundaries[0])
@@ -983,7 +1180,10 @@ class DesignMatrix(object):
                 continue
             if bam_cnts != None: 
                 #obs_arrays_to_stack.append( bam_cnts[i]-sum(observed) )
-                observed = numpy.hstack((bam_cnts[i]-sum(observed), observed))
+                # bam_cnts may be estimated (e.g. from the bam index), so 
+                # make sure that the out of gene count is never negative
+                observed = numpy.hstack(
+                    (max(0, bam_cnts[i]-sum(observed)), observed))
                 expected = numpy.vstack(
                     (numpy.zeros(expected.shape[1]), expected))
                 #print "zeros", numpy.zeros((expected.shape[0], 1)).shape, expected.shape,
@@ -1009,7 +1209,7 @@ class DesignMatrix(object):
 
     def find_transcripts_to_filter(self,expected,observed,max_num_transcripts):
         # cluster bins
-        expected, observed = cluster_rows(expected, observed)
+        expected, observed, clusters = cluster_rows(expected, observed)
         
         num_transcripts = expected.shape[1]
         low_expression_ts = set(self.unobservable_transcripts)
@@ -1098,8 +1298,192 @@ class DesignMatrix(object):
         
         return
 
+class MappedDesignMatrix(DesignMatrix):
+    """A read only design matrix whose arrays are views into a DesignMatrixStore.
+
+    """
+    def __init__(self, header, expected_freq_arrays, obs_cnt_arrays):
+        self.array_types = header['array_types']
+        self.expected_freq_arrays = expected_freq_arrays
+        self.obs_cnt_arrays = obs_cnt_arrays
+        self.unobservable_transcripts = header['unobservable_transcripts']
+        self.filtered_transcripts = header['filtered_transcripts']
+        self.max_num_transcripts = header['max_num_transcripts']
+        ( self.num_rnaseq_reads, self.num_fp_reads, self.num_tp_reads
+          ) = header['num_reads']
+
+        self._cached_bam_cnts = None
+        self._cached_indices = None
+        self._expected_and_observed = None
+        return
+
+class DesignMatrixStore(object):
+    """Append only, memory mapped store of design matrix arrays.
+
+    Every design matrix is packed into a single record of one file: a length
+    prefixed pickled header followed by the raw, 8 byte aligned, expected and
+    observed arrays. The record offsets live in a shared array indexed by gene,
+    so forked workers can find a design matrix and map its arrays directly
+    from the page cache instead of unpickling a per gene file.
+    """
+    _header_len_fmt = '<q'
+
+    def __init__(self, fname, gene_ids, restored_offsets={}):
+        self.fname = fname
+        self._gene_indices = dict(
+            (gene_id, i) for i, gene_id in enumerate(gene_ids))
+        self._offsets = RawArray('l', [-1]*len(self._gene_indices))
+        self._lock = multiprocessing.Lock()
+        # truncate any data from a previous run, unless we are restoring 
+        # some of its design matrices
+        if len(restored_offsets) == 0 or not os.path.exists(self.fname):
+            with open(self.fname, "wb"): pass
+        else:
+            for gene_id, offset in restored_offsets.iteritems():
+                self._offsets[self._gene_indices[gene_id]] = offset
+
+        self._mmap = None
+        self._mmap_size = 0
+
+    def __contains__(self, gene_id):
+        return self._offsets[self._gene_indices[gene_id]] != -1
+
+    @staticmethod
+    def _pad(size):
+        return (8 - size%8)%8
+
+    def add(self, gene_id, f_mat):
+        """Append f_mat to the store, and return its offset. 
+
+        Each gene can only be added once.
+        """
+        data_blocks = []
+        data_size = [0,]
+        def add_arrays(arrays):
+            rv = []
+            for array in arrays:
+                if array is None:
+                    rv.append(None)
+                    continue
+                array = numpy.ascontiguousarray(array)
+                rv.append((array.dtype.str, array.shape, data_size[0]))
+                data_blocks.append(array.tostring())
+                data_blocks.append('\0'*self._pad(array.nbytes))
+                data_size[0] += array.nbytes + self._pad(array.nbytes)
+            return rv
+
+        header = {
+            'array_types': f_mat.array_types,
+            'unobservable_transcripts': f_mat.unobservable_transcripts,
+            'filtered_transcripts': f_mat.filtered_transcripts,
+            'max_num_transcripts': f_mat.max_num_transcripts,
+            'num_reads': (f_mat.num_rnaseq_reads,
+                          f_mat.num_fp_reads,
+                          f_mat.num_tp_reads),
+            'expected_freq_arrays': add_arrays(f_mat.expected_freq_arrays),
+            'obs_cnt_arrays': add_arrays(f_mat.obs_cnt_arrays)
+        }
+        pickled_header = pickle.dumps(header, protocol=-1)
+        add_to_counter('bytes_pickled', len(pickled_header))
+        header_size = struct.calcsize(self._header_len_fmt) + len(pickled_header)
+        record = [ struct.pack(self._header_len_fmt, len(pickled_header)),
+                   pickled_header,
+                   '\0'*self._pad(header_size) ]
+        record.extend(data_blocks)
+
+        gene_index = self._gene_indices[gene_id]
+        with self._lock:
+            if self._offsets[gene_index] != -1:
+                raise ValueError, \
+                    "'%s' has already been added to the store" % gene_id
+            with open(self.fname, "ab") as ofp:
+                ofp.seek(0, os.SEEK_END)
+                offset = ofp.tell()
+                ofp.write("".join(record))
+                # the checkpoints store this offset, so the record must be
+                # on disk before it is returned
+                ofp.flush()
+                os.fsync(ofp.fileno())
+            self._offsets[gene_index] = offset
+        return offset
+
+    def _ensure_mapped(self, stop):
+        if stop <= self._mmap_size: return
+        # we don't close the old map because the arrays of previously
+        # loaded design matrices may still point into it
+        with open(self.fname, "rb") as fp:
+            self._mmap_size = os.fstat(fp.fileno()).st_size
+            self._mmap = mmap.mmap(
+                fp.fileno(), self._mmap_size, access=mmap.ACCESS_READ)
+        assert stop <= self._mmap_size
+        return
+
+    def get(self, gene_id):
+        """Return a MappedDesignMatrix for gene_id.
+
+        Raises a KeyError if the gene's design matrix hasn't been added.
+        """
+        offset = self._offsets[self._gene_indices[gene_id]]
+        if offset == -1:
+            raise KeyError, "No design matrix for '%s'" % gene_id
+
+        len_size = struct.calcsize(self._header_len_fmt)
+        self._ensure_mapped(offset + len_size)
+        header_len, = struct.unpack_from(
+            self._header_len_fmt, self._mmap, offset)
+        self._ensure_mapped(offset + len_size + header_len)
+        header = pickle.loads(
+            self._mmap[offset+len_size:offset+len_size+header_len])
+
+        header_size = len_size + header_len
+        data_offset = offset + header_size + self._pad(header_size)
+        def load_arrays(arrays_data):
+            rv = []
+            for array_data in arrays_data:
+                if array_data is None:
+                    rv.append(None)
+                    continue
+                dtype, shape, rel_offset = array_data
+                dtype = numpy.dtype(dtype)
+                count = int(numpy.prod(shape))
+                start = data_offset + rel_offset
+                self._ensure_mapped(start + count*dtype.itemsize)
+                rv.append(numpy.frombuffer(
+                    self._mmap, dtype, count, start).reshape(shape))
+            return rv
+
+        return MappedDesignMatrix(
+            header,
+            load_arrays(header['expected_freq_arrays']),
+            load_arrays(header['obs_cnt_arrays']))
+
+def test_vectorized_paired_read_bin_densities( ):
+    for exon_lens, fl_dist, read_len in (
+            ([100,1,100], frag_len.build_uniform_density( 100, 100 ), 50),
+            ([500, 500, 50, 5, 5, 500, 500], 
+             frag_len.build_uniform_density( 105, 400 ), 100),
+            ([500, 500, 50, 5, 5, 500, 500], 
+             frag_len.build_normal_density( 100, 600, 250, 50 ), 76) ):
+        transcript = range( len(exon_lens) )
+        full, paired, single = find_possible_read_bins_for_transcript( 
+            transcript, exon_lens, fl_dist, read_len )
+        bins_and_transcripts = [ (bin, full_bin) 
+                                 for full_bin in sorted(paired)
+                                 for bin in sorted(paired[full_bin]) ]
+        vectorized_cnts = estimate_num_paired_reads_from_bins(
+            bins_and_transcripts, exon_lens, fl_dist, read_len, 1 )
+        for (bin, full_bin), cnt in izip(
+                bins_and_transcripts, vectorized_cnts):
+            ref_cnt = estimate_num_paired_reads_from_bin( 
+                bin, full_bin, exon_lens, fl_dist, read_len, 1 )
+            assert abs(ref_cnt - cnt) < 1e-12, \
+                "%s %s: %e != %e" % (full_bin, bin, ref_cnt, cnt)
+    
+    return
 
 def tests( ):
+    test_vectorized_paired_read_bin_densities()
+    
     exon_lens = [100,1,100]
     transcript = range( len(exon_lens) )
     fl_dist = frag_len.build_uniform_density( 100, 100 )
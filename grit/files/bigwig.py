@@ -0,0 +1,433 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Write bigWig files without the UCSC tools.
+
+The layout follows the bbi format (Kent et al. 2010) as written by
+bedGraphToBigWig: a header, a chromosome B+ tree, the bedGraph data
+sections, an R tree index of the sections and, for every zoom level,
+the summary sections and their R tree index.
+"""
+
+import struct
+import zlib
+
+import numpy
+
+BIGWIG_MAGIC = 0x888FFC26
+BPT_MAGIC = 0x78CA8C91
+CIR_TREE_MAGIC = 0x2468ACE0
+BIGWIG_VERSION = 4
+
+BLOCK_SIZE = 256
+ITEMS_PER_SLOT = 1024
+MAX_N_ZOOM_LEVELS = 10
+ZOOM_INCREMENT = 4
+
+BEDGRAPH_SECTION_TYPE = 1
+
+HEADER_FMT = '<IHHQQQHHQQIQ'
+ZOOM_HEADER_FMT = '<IIQQ'
+TOTAL_SUMMARY_FMT = '<Qdddd'
+SECTION_HEADER_FMT = '<IIIIIBBH'
+BPT_HEADER_FMT = '<IIIIQQ'
+CIR_TREE_HEADER_FMT = '<IIQIIIIQII'
+NODE_HEADER_FMT = '<BBH'
+CIR_LEAF_ITEM_FMT = '<IIIIQQ'
+CIR_NON_LEAF_ITEM_FMT = '<IIIIQ'
+
+# the coverage runs that are written into a bigWig - sorted, non
+# overlapping, half open intervals
+RUN_DTYPE = numpy.dtype(
+    [('start', '<i8'), ('stop', '<i8'), ('value', '<f8')])
+
+BEDGRAPH_ITEM_DTYPE = numpy.dtype(
+    [('start', '<u4'), ('stop', '<u4'), ('value', '<f4')])
+
+ZOOM_RECORD_DTYPE = numpy.dtype(
+    [('chrm_id', '<u4'), ('start', '<u4'), ('stop', '<u4'),
+     ('valid_count', '<u4'), ('min', '<f4'), ('max', '<f4'),
+     ('sum', '<f4'), ('sum_sq', '<f4')])
+
+def _iter_level_sizes(n_items, block_size):
+    """Return the number of nodes in each level of a tree, from the leaves up.
+
+    """
+    n_nodes = max(1, (n_items + block_size - 1)//block_size)
+    level_sizes = [n_nodes,]
+    while n_nodes > 1:
+        n_nodes = (n_nodes + block_size - 1)//block_size
+        level_sizes.append(n_nodes)
+    return level_sizes
+
+def _write_chrm_tree(fp, chrm_names_and_sizes):
+    """Write the B+ tree that maps chromosome names to ids and sizes.
+
+    The names must be sorted - a chromosome's id is its index.
+    """
+    n_chrms = len(chrm_names_and_sizes)
+    block_size = max(1, min(BLOCK_SIZE, n_chrms))
+    key_size = max([1,] + [len(name) for name, size in chrm_names_and_sizes])
+    fp.write(struct.pack(BPT_HEADER_FMT, BPT_MAGIC, block_size,
+                         key_size, 8, n_chrms, 0))
+
+    # every node is padded to block_size items, so the node offsets can be
+    # calculated before they are written
+    node_header_size = struct.calcsize(NODE_HEADER_FMT)
+    node_size = node_header_size + block_size*(key_size + 8)
+    level_sizes = list(reversed(_iter_level_sizes(n_chrms, block_size)))
+    level_offsets = [fp.tell(),]
+    for level_size in level_sizes[:-1]:
+        level_offsets.append(level_offsets[-1] + level_size*node_size)
+
+    # a node in level_i spans n_items_per_node chromosomes, and each of its
+    # slots spans child_span of them
+    for level_i, level_size in enumerate(level_sizes):
+        is_leaf = (level_i == len(level_sizes) - 1)
+        n_items_per_node = block_size**(len(level_sizes) - level_i)
+        child_span = n_items_per_node//block_size
+        for node_i in xrange(level_size):
+            first = node_i*n_items_per_node
+            item_indices = range(
+                first, min(first + n_items_per_node, n_chrms), child_span)
+            fp.write(struct.pack(NODE_HEADER_FMT, int(is_leaf), 0,
+                                 len(item_indices)))
+            for slot_i, item_i in enumerate(item_indices):
+                name, size = chrm_names_and_sizes[item_i]
+                fp.write(name.ljust(key_size, '\0'))
+                if is_leaf:
+                    fp.write(struct.pack('<II', item_i, size))
+                else:
+                    child_i = node_i*block_size + slot_i
+                    fp.write(struct.pack(
+                        '<Q', level_offsets[level_i+1] + child_i*node_size))
+            fp.write('\0'*((block_size - len(item_indices))*(key_size + 8)))
+    return
+
+def _write_cir_tree(fp, index_items, end_file_offset):
+    """Write the R tree index of the data sections.
+
+    index_items is a sorted list of
+    (start_chrm_id, start, end_chrm_id, end, file_offset, size) tuples.
+    """
+    n_items = len(index_items)
+    block_size = BLOCK_SIZE
+    if n_items > 0:
+        bounds = (index_items[0][:2], max(item[2:4] for item in index_items))
+    else:
+        bounds = ((0, 0), (0, 0))
+    fp.write(struct.pack(
+        CIR_TREE_HEADER_FMT, CIR_TREE_MAGIC, block_size, n_items,
+        bounds[0][0], bounds[0][1], bounds[1][0], bounds[1][1],
+        end_file_offset, ITEMS_PER_SLOT, 0))
+
+    # find the bounds of every node, from the leaves up
+    levels = [[item[:4] for item in index_items],]
+    for level_size in _iter_level_sizes(n_items, block_size):
+        children = levels[-1]
+        level = []
+        for node_i in xrange(level_size):
+            node_children = children[node_i*block_size:(node_i+1)*block_size]
+            if len(node_children) == 0:
+                level.append((0, 0, 0, 0))
+            else:
+                level.append(node_children[0][:2] +
+                             max(child[2:4] for child in node_children))
+        levels.append(level)
+    # order the levels from the root down. The children of the nodes in 
+    # levels[i] are the entries of levels[i+1], and the last level holds
+    # the index items
+    levels.reverse()
+    n_node_levels = len(levels) - 1
+
+    node_header_size = struct.calcsize(NODE_HEADER_FMT)
+    def node_size(level_i):
+        if level_i == n_node_levels - 1:
+            item_size = struct.calcsize(CIR_LEAF_ITEM_FMT)
+        else:
+            item_size = struct.calcsize(CIR_NON_LEAF_ITEM_FMT)
+        return node_header_size + block_size*item_size
+
+    # every node is padded to block_size items, so the node offsets can be
+    # calculated before they are written
+    level_offsets = [fp.tell(),]
+    for level_i in xrange(n_node_levels - 1):
+        level_offsets.append(
+            level_offsets[-1] + len(levels[level_i])*node_size(level_i))
+
+    for level_i in xrange(n_node_levels):
+        is_leaf = (level_i == n_node_levels - 1)
+        children = levels[level_i+1]
+        for node_i in xrange(len(levels[level_i])):
+            child_indices = range(node_i*block_size,
+                                  min((node_i+1)*block_size, len(children)))
+            fp.write(struct.pack(NODE_HEADER_FMT, int(is_leaf), 0,
+                                 len(child_indices)))
+            for child_i in child_indices:
+                if is_leaf:
+                    fp.write(struct.pack(
+                        CIR_LEAF_ITEM_FMT, *index_items[child_i]))
+                else:
+                    child_offset = ( level_offsets[level_i+1]
+                                     + child_i*node_size(level_i+1) )
+                    fp.write(struct.pack(
+                        CIR_NON_LEAF_ITEM_FMT,
+                        *(children[child_i] + (child_offset,))))
+            n_empty_slots = block_size - len(child_indices)
+            fp.write('\0'*(n_empty_slots*(
+                node_size(level_i) - node_header_size)//block_size))
+    return
+
+def _iter_zoom_records(runs, reduction, chunk_size=1<<20):
+    """Iterate through arrays of the summaries of runs in windows of size
+       reduction.
+
+    The runs are processed in chunks so that the memory usage is bounded,
+    and the window that spans two chunks is merged.
+    """
+    summary_dtype = [('bin', 'i8'), ('start', 'i8'), ('stop', 'i8'),
+                     ('valid_count', 'i8'), ('min', 'f8'), ('max', 'f8'),
+                     ('sum', 'f8'), ('sum_sq', 'f8')]
+    carry = None
+    for chunk_start in xrange(0, len(runs), chunk_size):
+        chunk = runs[chunk_start:chunk_start+chunk_size]
+        starts, stops = chunk['start'], chunk['stop']
+        values = numpy.asarray(chunk['value'], dtype=float)
+
+        # split the runs at window boundaries
+        first_bins = starts//reduction
+        n_pieces = (stops - 1)//reduction - first_bins + 1
+        run_indices = numpy.repeat(numpy.arange(len(chunk)), n_pieces)
+        piece_offsets = numpy.arange(n_pieces.sum()) - numpy.repeat(
+            n_pieces.cumsum() - n_pieces, n_pieces)
+        bins = first_bins[run_indices] + piece_offsets
+        piece_starts = numpy.maximum(starts[run_indices], bins*reduction)
+        piece_stops = numpy.minimum(stops[run_indices], (bins+1)*reduction)
+        piece_lens = piece_stops - piece_starts
+        piece_values = values[run_indices]
+
+        bin_bnds = numpy.flatnonzero(numpy.diff(bins)) + 1
+        firsts = numpy.concatenate(([0,], bin_bnds))
+        lasts = numpy.concatenate((bin_bnds, [len(bins),])) - 1
+        summary = numpy.zeros(len(firsts), dtype=summary_dtype)
+        summary['bin'] = bins[firsts]
+        summary['start'] = piece_starts[firsts]
+        summary['stop'] = piece_stops[lasts]
+        summary['valid_count'] = numpy.add.reduceat(piece_lens, firsts)
+        summary['min'] = numpy.minimum.reduceat(piece_values, firsts)
+        summary['max'] = numpy.maximum.reduceat(piece_values, firsts)
+        summary['sum'] = numpy.add.reduceat(piece_values*piece_lens, firsts)
+        summary['sum_sq'] = numpy.add.reduceat(
+            piece_values*piece_values*piece_lens, firsts)
+
+        if carry is not None:
+            if carry['bin'][0] == summary['bin'][0]:
+                summary['start'][0] = carry['start'][0]
+                summary['min'][0] = min(summary['min'][0], carry['min'][0])
+                summary['max'][0] = max(summary['max'][0], carry['max'][0])
+                for key in ('valid_count', 'sum', 'sum_sq'):
+                    summary[key][0] += carry[key][0]
+            else:
+                yield carry
+        yield summary[:-1]
+        carry = summary[-1:].copy()
+
+    if carry is not None: yield carry
+    return
+
+def _count_zoom_records(runs, reduction, chunk_size=1<<20):
+    n_records = 0
+    prev_last_bin = None
+    for chunk_start in xrange(0, len(runs), chunk_size):
+        chunk = runs[chunk_start:chunk_start+chunk_size]
+        first_bins = chunk['start']//reduction
+        last_bins = (chunk['stop'] - 1)//reduction
+        n_records += (last_bins - first_bins + 1).sum()
+        n_records -= (first_bins[1:] == last_bins[:-1]).sum()
+        if prev_last_bin == first_bins[0]: n_records -= 1
+        prev_last_bin = last_bins[-1]
+    return n_records
+
+class _SectionWriter(object):
+    """Write sections of at most ITEMS_PER_SLOT records, and record the
+       items of their R tree index.
+
+    """
+    def __init__(self, fp, compress):
+        self.fp = fp
+        self.compress = compress
+        self.index_items = []
+        self.max_uncompressed_size = 0
+
+    def write(self, chrm_id, start, stop, data):
+        if self.compress:
+            self.max_uncompressed_size = max(
+                self.max_uncompressed_size, len(data))
+            data = zlib.compress(data)
+        self.index_items.append(
+            (chrm_id, start, chrm_id, stop, self.fp.tell(), len(data)))
+        self.fp.write(data)
+
+def _write_data_sections(fp, chrm_runs, compress):
+    """Write the bedGraph data sections, and return their writer.
+
+    """
+    sections = _SectionWriter(fp, compress)
+    for chrm_id, runs in chrm_runs:
+        for section_start in xrange(0, len(runs), ITEMS_PER_SLOT):
+            items = numpy.empty(
+                min(ITEMS_PER_SLOT, len(runs) - section_start),
+                dtype=BEDGRAPH_ITEM_DTYPE)
+            section_runs = runs[section_start:section_start+len(items)]
+            for key in ('start', 'stop', 'value'):
+                items[key] = section_runs[key]
+            start, stop = int(items['start'][0]), int(items['stop'][-1])
+            header = struct.pack(SECTION_HEADER_FMT, chrm_id, start, stop,
+                                 0, 0, BEDGRAPH_SECTION_TYPE, 0, len(items))
+            sections.write(chrm_id, start, stop, header + items.tostring())
+    return sections
+
+def _write_zoom_sections(fp, chrm_runs, reduction, compress):
+    """Write the zoom level with window size reduction, and return its
+    section writer and the number of zoom records.
+
+    """
+    sections = _SectionWriter(fp, compress)
+    n_records = 0
+    for chrm_id, runs in chrm_runs:
+        pending = []
+        n_pending = 0
+        for summary in _iter_zoom_records(runs, reduction):
+            records = numpy.empty(len(summary), dtype=ZOOM_RECORD_DTYPE)
+            records['chrm_id'] = chrm_id
+            for key in ZOOM_RECORD_DTYPE.names[1:]:
+                records[key] = summary[key]
+            pending.append(records)
+            n_pending += len(records)
+            if n_pending < ITEMS_PER_SLOT: continue
+            records = numpy.concatenate(pending)
+            n_full = (len(records)//ITEMS_PER_SLOT)*ITEMS_PER_SLOT
+            for i in xrange(0, n_full, ITEMS_PER_SLOT):
+                section = records[i:i+ITEMS_PER_SLOT]
+                sections.write(chrm_id, int(section['start'][0]),
+                               int(section['stop'][-1]), section.tostring())
+            pending = [records[n_full:],]
+            n_pending = len(pending[0])
+            n_records += n_full
+        if n_pending > 0:
+            section = numpy.concatenate(pending)
+            sections.write(chrm_id, int(section['start'][0]),
+                           int(section['stop'][-1]), section.tostring())
+            n_records += n_pending
+    return sections, n_records
+
+def write_bigwig(ofname, chrm_sizes, load_runs, compress=True):
+    """Write a bigWig file from coverage runs.
+
+    chrm_sizes is a list of (chrm name, chrm length) tuples, and
+    load_runs(chrm) returns a RUN_DTYPE array (typically memory mapped)
+    of the non zero runs in chrm, or None if there are none. Every contig
+    is loaded once for the data and then once for each zoom level, so
+    only one contig needs to be in memory at any time.
+    """
+    chrm_names_and_sizes = sorted(chrm_sizes)
+    def iter_chrm_runs():
+        for chrm_id, (chrm, size) in enumerate(chrm_names_and_sizes):
+            runs = load_runs(chrm)
+            if runs is None or len(runs) == 0: continue
+            yield chrm_id, runs
+        return
+
+    with open(ofname, "wb") as fp:
+        # leave space for the header, zoom headers and total summary
+        fp.write('\0'*struct.calcsize(HEADER_FMT))
+        zoom_headers_offset = fp.tell()
+        fp.write('\0'*(struct.calcsize(ZOOM_HEADER_FMT)*MAX_N_ZOOM_LEVELS))
+        total_summary_offset = fp.tell()
+        fp.write('\0'*struct.calcsize(TOTAL_SUMMARY_FMT))
+
+        chrm_tree_offset = fp.tell()
+        _write_chrm_tree(fp, chrm_names_and_sizes)
+
+        data_offset = fp.tell()
+        fp.write(struct.pack('<Q', 0))
+        sections = _write_data_sections(fp, iter_chrm_runs(), compress)
+        index_offset = fp.tell()
+        _write_cir_tree(fp, sections.index_items, index_offset)
+        max_uncompressed_size = sections.max_uncompressed_size
+        n_sections = len(sections.index_items)
+
+        # find the total summary, and the mean run length
+        bases_covered, n_runs = 0, 0
+        min_val, max_val, sum_data, sum_sq = numpy.inf, -numpy.inf, 0.0, 0.0
+        for chrm_id, runs in iter_chrm_runs():
+            lens = runs['stop'] - runs['start']
+            values = runs['value']
+            bases_covered += int(lens.sum())
+            n_runs += len(runs)
+            min_val = min(min_val, float(values.min()))
+            max_val = max(max_val, float(values.max()))
+            sum_data += float((values*lens).sum())
+            sum_sq += float((values*values*lens).sum())
+        if n_runs == 0: min_val, max_val = 0.0, 0.0
+
+        # add zoom levels, starting at 10x the mean run length. A level is 
+        # only kept if it at least halves the size of the previous level
+        zoom_headers = []
+        reduction = max(1, 10*bases_covered//max(1, n_runs))
+        prev_n_records = n_runs
+        max_chrm_size = max([1,] + [size for chrm, size in chrm_sizes])
+        while n_runs > 0 and len(zoom_headers) < MAX_N_ZOOM_LEVELS:
+            n_records = sum(_count_zoom_records(runs, reduction)
+                            for chrm_id, runs in iter_chrm_runs())
+            if n_records*2 <= prev_n_records:
+                zoom_data_offset = fp.tell()
+                fp.write(struct.pack('<I', n_records))
+                zoom_sections, n_records = _write_zoom_sections(
+                    fp, iter_chrm_runs(), reduction, compress)
+                zoom_index_offset = fp.tell()
+                _write_cir_tree(
+                    fp, zoom_sections.index_items, zoom_index_offset)
+                max_uncompressed_size = max(
+                    max_uncompressed_size, zoom_sections.max_uncompressed_size)
+                zoom_headers.append(
+                    (reduction, 0, zoom_data_offset, zoom_index_offset))
+                prev_n_records = n_records
+            if reduction >= max_chrm_size: break
+            reduction *= ZOOM_INCREMENT
+
+        fp.write(struct.pack('<I', BIGWIG_MAGIC))
+
+        # fill in the header
+        fp.seek(0)
+        fp.write(struct.pack(
+            HEADER_FMT, BIGWIG_MAGIC, BIGWIG_VERSION, len(zoom_headers),
+            chrm_tree_offset, data_offset, index_offset, 0, 0, 0,
+            total_summary_offset, max_uncompressed_size if compress else 0,
+            0))
+        fp.seek(zoom_headers_offset)
+        for zoom_header in zoom_headers:
+            fp.write(struct.pack(ZOOM_HEADER_FMT, *zoom_header))
+        fp.seek(total_summary_offset)
+        fp.write(struct.pack(TOTAL_SUMMARY_FMT, bases_covered,
+                             min_val, max_val, sum_data, sum_sq))
+        fp.seek(data_offset)
+        fp.write(struct.pack('<Q', n_sections))
+
+    return
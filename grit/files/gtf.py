@@ -20,9 +20,15 @@ along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 import os, sys
 from collections import namedtuple, defaultdict
 import itertools
+from bisect import bisect_left, bisect_right
 
 import tempfile
 import gzip
+import hashlib
+import re
+import shutil
+
+import numpy
 
 from ..transcript import Gene, Transcript, GenomicInterval
     
@@ -122,26 +128,29 @@ def parse_gff_line( line, fix_chrm=True ):
     return GffLine( GenomicInterval(data[0], data[6], data[3], data[4]), \
                         data[2], data[5], data[1], data[7], data[8] )
 
+def get_name_from_field( name ):
+    if name.startswith('"'):
+        name = name[1:]
+    if name.endswith(';'):
+        name = name[:-1]
+    if name.endswith('"'):
+        name = name[:-1]
+    return name
+
+def parse_gtf_meta_data( group ):
+    meta_data_items = group.split()
+    return dict( zip( meta_data_items[::2], 
+                      ( get_name_from_field(x) 
+                        for x in meta_data_items[1::2] ) ) )
+
 def parse_gtf_line( line, fix_chrm=True ):
     gffl = parse_gff_line( line, fix_chrm=fix_chrm )
     if gffl == None: return None
     
     # get gene and transcript name if parsing a gtf line 
     # else it is a gff line and does not have gene or trans names
-    def get_name_from_field( name ):
-        if name.startswith('"'):
-            name = name[1:]
-        if name.endswith(';'):
-            name = name[:-1]
-        if name.endswith('"'):
-            name = name[:-1]
-        return name
-    
-    meta_data_items = (gffl.group).split()
     # parse the meta data, and grab the gene name
-    meta_data = dict( zip( meta_data_items[::2], 
-                           ( get_name_from_field(x) 
-                             for x in meta_data_items[1::2] ) ) )
+    meta_data = parse_gtf_meta_data( gffl.group )
     
     if "gene_id" not in meta_data:
         raise ValueError, "GTF lines require a gene_id field."
@@ -265,11 +274,17 @@ class Annotation(object):
     """Store a collection of genes.
 
     Contains methods for comparing annotations.
+
+    Overlap queries use a per (chrm, strand) index of the genes sorted by 
+    start, along with the running maximum of their stops. The index is built 
+    lazily, and rebuilt after genes are appended.
     """
     def __init__(self):
         self._genes = []
         self._gene_map = {}
         self._gene_locs = defaultdict(list)
+        self._gene_locs_index = {}
+        self._gene_elements = {}
     
     def __len__(self):
         return len(self._genes)
@@ -289,79 +304,418 @@ class Annotation(object):
         
         # add the gene to the location index
         self._gene_locs[(gene.chrm, gene.strand)].append(gene)
+        self._gene_locs_index.pop((gene.chrm, gene.strand), None)
+
+    def _build_locs_index(self, key):
+        genes = sorted(self._gene_locs[key], key=lambda g: (g.start, g.stop))
+        starts = [gene.start for gene in genes]
+        max_stops = []
+        for gene in genes:
+            max_stops.append( 
+                gene.stop if len(max_stops) == 0 else max(
+                    max_stops[-1], gene.stop) )
+        self._gene_locs_index[key] = (genes, starts, max_stops)
+        return self._gene_locs_index[key]
+    
+    def _iter_overlapping_genes_in_strand(self, chrm, strand, start, stop):
+        key = (clean_chr_name(chrm), strand)
+        if key not in self._gene_locs: return
+        try: 
+            genes, starts, max_stops = self._gene_locs_index[key]
+        except KeyError:
+            genes, starts, max_stops = self._build_locs_index(key)
+        # genes before lo all stop before start, and genes from hi on all 
+        # start after stop
+        lo = bisect_left(max_stops, start)
+        hi = bisect_right(starts, stop)
+        for gene in genes[lo:hi]:
+            if start > gene.stop: continue
+            yield gene
+        return
 
-    def iter_overlapping_genes(self, chrm, strand, start, stop):
-        if strand in '+-': strands = [strand,]
-        elif strand == '.': strands = ['+','-']
+    def _iter_strands(self, strand):
+        if strand in '+-': return [strand,]
+        elif strand == '.': return ['+','-']
         else: raise ValueError( "Unrecognized strand: '%s'" % strand )
-        
-        for strand in strands:
-            for gene in self._gene_locs[(clean_chr_name(chrm), strand)]:
-                if stop < gene.start: continue
-                if start > gene.stop: continue
+    
+    def iter_overlapping_genes(self, chrm, strand, start, stop):
+        for strand in self._iter_strands(strand):
+            for gene in self._iter_overlapping_genes_in_strand(
+                    chrm, strand, start, stop):
                 yield gene
-
         return
+    
+    def extract_gene_elements(self, gene):
+        """Return gene.extract_elements() as a list of (type, (start, stop)).
 
+        The elements are cached by gene id.
+        """
+        try:
+            return self._gene_elements[gene.id]
+        except KeyError:
+            elements = []
+            for element_type, regions in gene.extract_elements().iteritems():
+                elements.extend( (element_type, region) 
+                                 for region in regions )
+            self._gene_elements[gene.id] = elements
+            return elements
+    
     def iter_elements(self, chrm, strand, r_start, r_stop):
-        if strand in '+-': strands = [strand,]
-        elif strand == '.': strands = ['+','-']
-        else: assert "Unrecognized strand: '%s' % strand"
-        
-        for strand in strands:
-            for gene in self._gene_locs[(clean_chr_name(chrm), strand)]:
-                if gene.stop < r_start: continue
-                if gene.start > r_stop: continue
-                for element_type, elements in gene.extract_elements().iteritems():
-                    for start, stop in elements:
-                        if stop < r_start or start > r_stop: continue
-                        yield element_type, (start, stop)
+        for gene in self.iter_overlapping_genes(chrm, strand, r_start, r_stop):
+            for element_type, (start, stop) in self.extract_gene_elements(gene):
+                if stop < r_start or start > r_stop: continue
+                yield element_type, (start, stop)
         
         return
 
     def __iter__(self):
         return iter(self._genes)
     
-def load_gtf(fname_or_fp, contig=None, strand=None):
-    if isinstance( fname_or_fp, str ):
-        fp = open( fname_or_fp )
-    else:
-        assert isinstance( fname_or_fp, (file, gzip.GzipFile) )
-        fp = fname_or_fp
+GTF_CACHE_VERSION = 1
+GTF_COLUMN_NAMES = ( 
+    'chrm_names', 'chrm', 'strand', 'feature_names', 'feature', 
+    'start', 'stop', 'score', 'gene_ids', 'gene', 'trans_ids', 'trans', 
+    'attrs', 'attr_offsets', 'gene_bounds' )
+
+def _find_attr_value( group, attr_re ):
+    match = attr_re.search( group )
+    if match == None: return None
+    return get_name_from_field(get_name_from_field(match.group(1)))
+
+class GtfColumns(object):
+    """Columnar store of the lines of a gtf file.
+
+    Every line is a row: the chromosome, feature, gene id and transcript id 
+    are stored as integer codes into the *_names/*_ids arrays, and the 
+    unparsed attribute strings are concatenated into attrs (row i is 
+    attrs[attr_offsets[i]:attr_offsets[i+1]]). Rows are sorted by gene, in 
+    order of first appearance, so that gene i is the rows 
+    [gene_bounds[i], gene_bounds[i+1]). 
+
+    The columns are numpy arrays, so they can be saved to, and memory mapped
+    from, a directory of .npy files.
+    """
+    def __init__(self, **columns):
+        for name in GTF_COLUMN_NAMES:
+            setattr(self, name, columns[name])
+    
+    def __len__(self):
+        return len(self.start)
+    
+    @property
+    def num_genes(self):
+        return len(self.gene_bounds) - 1
+    
+    def save(self, dirname):
+        os.mkdir(dirname)
+        for name in GTF_COLUMN_NAMES:
+            numpy.save(os.path.join(dirname, name + ".npy"), getattr(self, name))
+    
+    @staticmethod
+    def load(dirname):
+        return GtfColumns(**dict( 
+            (name, numpy.load(os.path.join(dirname, name + ".npy"), 
+                              mmap_mode='r'))
+            for name in GTF_COLUMN_NAMES ))
+    
+    def build_gtf_line(self, row_i):
+        attrs = self.attrs[
+            self.attr_offsets[row_i]:self.attr_offsets[row_i+1]].tostring()
+        score = self.score[row_i]
+        return GtfLine( 
+            GenomicInterval( str(self.chrm_names[self.chrm[row_i]]), 
+                             str(self.strand[row_i]), 
+                             int(self.start[row_i]), int(self.stop[row_i]) ),
+            str(self.gene_ids[self.gene[row_i]]), 
+            str(self.trans_ids[self.trans[row_i]]),
+            str(self.feature_names[self.feature[row_i]]), 
+            '.' if numpy.isnan(score) else float(score),
+            None, None, parse_gtf_meta_data(attrs) )
+    
+    def load_gene(self, gene_i, row_mask=None):
+        """Build the gene object from the rows of gene_i.
+
+        """
+        gene_id = str(self.gene_ids[gene_i])
+        gene_lines = []
+        transcripts_data = defaultdict(list)
+        is_gene_line = self.feature_names == 'gene'
+        for row_i in xrange(self.gene_bounds[gene_i], 
+                            self.gene_bounds[gene_i+1]):
+            if row_mask is not None and not row_mask[row_i]: continue
+            line = self.build_gtf_line(row_i)
+            if is_gene_line[self.feature[row_i]]: 
+                gene_lines.append( line )
+            else:
+                transcripts_data[line.trans_id].append(line)
+        return _load_gene_from_gtf_lines(gene_id, gene_lines, transcripts_data)
+
+def parse_gtf_columns(fp):
+    """Parse the gtf lines in fp into a GtfColumns object.
+
+    The lines are filtered and fixed the same way as parse_gtf_line, but 
+    only the region, feature, score, and gene and transcript ids are parsed. 
+    The remaining attributes are kept as strings.
+    """
+    gene_id_re = re.compile(r'(?:^|\s)gene_id\s+(\S+)')
+    trans_id_re = re.compile(r'(?:^|\s)transcript_id\s+(\S+)')
     
-    gene_lines = defaultdict(lambda: ( defaultdict(list), [] ))
+    chrms, strands, features = [], [], []
+    starts, stops, scores = [], [], []
+    gene_ids, trans_ids = [], []
+    attrs = []
     for line in fp:
-        data = parse_gtf_line(line, fix_chrm=True )
-        # skip unparseable lines, or lines without gene ids
-        if None == data: continue
-        if data.gene_id == "": continue
-        if contig != None and data.region.chr != contig: continue
-        if strand != None and data.region.strand != strand: continue
-        # add gene lines directly to the gene object
-        if data.feature == 'gene': 
-            gene_lines[data.gene_id][1].append( data )
-        else:
-            gene_lines[data.gene_id][0][data.trans_id].append(data)
+        if line.startswith( '#' ): continue
+        data = line.split(None, 8)
+        if len( data ) < 9: continue
+        try:
+            start, stop = int( data[3] ), int( data[4] )
+            score = numpy.nan if data[5] == '.' else float(data[5])
+        except ValueError:
+            continue
+        if data[6] not in "+-.": continue
+        if data[7] not in ( '0', '1', '2', '.' ): continue
+        
+        group = data[8].rstrip()
+        gene_id = _find_attr_value( group, gene_id_re )
+        if gene_id == None:
+            raise ValueError, "GTF lines require a gene_id field."
+        trans_id = _find_attr_value( group, trans_id_re )
+        # skip lines without transcript ids (e.g. ENSEMBL gene lines), or
+        # without gene ids
+        if trans_id == None or gene_id == "": continue
+        
+        chrms.append(data[0][3:] if data[0].startswith("chr") else data[0])
+        strands.append(data[6])
+        features.append(data[2])
+        starts.append(start)
+        stops.append(stop)
+        scores.append(score)
+        gene_ids.append(gene_id)
+        trans_ids.append(trans_id)
+        attrs.append(group)
+    
+    def encode(values):
+        names, codes = numpy.unique(
+            numpy.array(values, dtype=str), return_inverse=True)
+        return names, codes.astype('int32')
+    
+    chrm_names, chrm = encode(chrms)
+    feature_names, feature = encode(features)
+    trans_names, trans = encode(trans_ids)
+    # number the genes in order of first appearance, and group their rows
+    gene_names, gene = encode(gene_ids)
+    first_rows = numpy.zeros(len(gene_names), dtype=int)
+    first_rows[gene[::-1]] = numpy.arange(len(gene))[::-1]
+    gene_order = numpy.argsort(first_rows, kind='mergesort')
+    gene_names = gene_names[gene_order]
+    gene = numpy.argsort(gene_order)[gene].astype('int32')
+    rows = numpy.argsort(gene, kind='mergesort')
+    gene_bounds = numpy.searchsorted(
+        gene[rows], numpy.arange(len(gene_names)+1))
+    
+    attr_lens = numpy.array([len(x) for x in attrs], dtype=int)
+    attr_offsets = numpy.append(0, numpy.cumsum(attr_lens[rows]))
+    attrs = numpy.frombuffer(
+        "".join(attrs[i] for i in rows), dtype='uint8').copy()
+    
+    return GtfColumns(
+        chrm_names=chrm_names, chrm=chrm[rows], 
+        strand=numpy.array(strands, dtype='S1')[rows],
+        feature_names=feature_names, feature=feature[rows],
+        start=numpy.array(starts, dtype='int64')[rows], 
+        stop=numpy.array(stops, dtype='int64')[rows],
+        score=numpy.array(scores, dtype=float)[rows],
+        gene_ids=gene_names, gene=gene[rows], 
+        trans_ids=trans_names, trans=trans[rows],
+        attrs=attrs, attr_offsets=attr_offsets, gene_bounds=gene_bounds )
+
+def load_gtf_columns(fname):
+    """Load the columns of a gtf, using a binary cache next to the gtf.
+
+    The cache is keyed by a hash of the gtf's contents. If it exists, the 
+    columns are memory mapped from it; otherwise the gtf is parsed and we
+    try to write the cache (which silently fails if the gtf's directory 
+    isn't writeable).
+    """
+    hasher = hashlib.sha1()
+    with open(fname) as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), ''):
+            hasher.update(chunk)
+    cache_dirname = "%s.%s.v%i.cache" % (
+        fname, hasher.hexdigest()[:16], GTF_CACHE_VERSION)
+    
+    if os.path.isdir(cache_dirname):
+        try: 
+            return GtfColumns.load(cache_dirname)
+        except Exception, inst:
+            log_statement( "WARNING: Could not load the cached gtf '%s': %s" % (
+                cache_dirname, inst), log=True )
     
-    genes = Annotation()
-    for gene_id, ( transcripts_data, gene_lines ) in gene_lines.iteritems():
+    with open(fname) as fp:
+        columns = parse_gtf_columns(fp)
+    
+    # write the cache to a temporary directory, and then move it into place
+    # so that concurrent loads never see a partial cache
+    tmp_dirname = None
+    try:
+        tmp_dirname = tempfile.mkdtemp(
+            dir=os.path.dirname(os.path.abspath(fname)), prefix=".gtfcache.")
+        columns.save(os.path.join(tmp_dirname, "columns"))
+        os.rename(os.path.join(tmp_dirname, "columns"), cache_dirname)
+    except (IOError, OSError), inst:
+        if VERBOSE: print >> sys.stderr, "Could not cache '%s': %s" % (
+            fname, inst)
+    finally:
+        if tmp_dirname != None: shutil.rmtree(tmp_dirname, ignore_errors=True)
+    
+    return columns
+
+class LazyAnnotation(Annotation):
+    """An annotation that builds gene objects from GtfColumns on demand.
+
+    Genes that load_gtf would skip (multiple gene lines, no exons, or gene 
+    lines that don't match the transcript boundaries) are found from the 
+    columns, so the gene coordinates and count are known without building
+    any gene objects. Genes that are added with append are stored as in 
+    Annotation.
+    """
+    def __init__(self, columns, contig=None, strand=None):
+        Annotation.__init__(self)
+        self._columns = columns
+        self._loaded_genes = {}
+        
+        row_mask = numpy.ones(len(columns), dtype=bool)
+        if contig != None: 
+            row_mask &= (columns.chrm_names[columns.chrm] == contig)
+        if strand != None:
+            row_mask &= (columns.strand == strand)
+        self._row_mask = None if row_mask.all() else row_mask
+        
+        # find the gene boundaries from the exons, and the gene lines
+        n_genes = columns.num_genes
+        is_exon = numpy.in1d(columns.feature_names, ('exon', 'CDS'))[
+            columns.feature] & row_mask
+        is_gene_line = (columns.feature_names == 'gene')[
+            columns.feature] & row_mask
+        starts = numpy.zeros(n_genes, dtype='int64') + numpy.iinfo('int64').max
+        numpy.minimum.at(starts, columns.gene[is_exon], columns.start[is_exon])
+        stops = numpy.zeros(n_genes, dtype='int64') - 1
+        numpy.maximum.at(stops, columns.gene[is_exon], columns.stop[is_exon])
+        first_exon_rows = numpy.zeros(n_genes, dtype=int)
+        exon_rows = is_exon.nonzero()[0]
+        first_exon_rows[columns.gene[exon_rows[::-1]]] = exon_rows[::-1]
+        
+        is_valid = (stops >= 0)
+        n_gene_lines = numpy.bincount(
+            columns.gene[is_gene_line], minlength=n_genes)
+        is_valid &= (n_gene_lines <= 1)
+        for row_i in is_gene_line.nonzero()[0]:
+            gene_i = columns.gene[row_i]
+            if ( columns.start[row_i] != starts[gene_i] 
+                 or columns.stop[row_i] != stops[gene_i] 
+                 or 'gene_name' not in columns.build_gtf_line(row_i).meta_data):
+                is_valid[gene_i] = False
+        
+        self._gene_indices = is_valid.nonzero()[0]
+        n_skipped = (row_mask[columns.gene_bounds[:-1]] & ~is_valid).sum() \
+            if n_genes > 0 else 0
+        if VERBOSE and n_skipped > 0: 
+            print >> sys.stderr, "Skipping %i genes with no exons, multiple gene lines, or gene lines that dont match their transcripts." % n_skipped
+        first_exon_rows = first_exon_rows[self._gene_indices]
+        # gff's are 1 based
+        self._gene_starts = starts[self._gene_indices] - 1
+        self._gene_stops = stops[self._gene_indices] - 1
+        self._gene_keys = zip(
+            columns.chrm_names[columns.chrm[first_exon_rows]].tolist(), 
+            columns.strand[first_exon_rows].tolist())
+        self._lazy_locs_index = None
+    
+    def __len__(self):
+        return len(self._gene_indices) + Annotation.__len__(self)
+    
+    def _build_gene(self, i):
+        gene_i = self._gene_indices[i]
         try:
-            gene = _load_gene_from_gtf_lines(
-                gene_id, gene_lines, transcripts_data)
+            return self._columns.load_gene(gene_i, self._row_mask)
         except Exception, inst:
-            log_statement( 
-                "ERROR : Could not load '%s': %s" % (gene_id, inst), log=True)
-            #log_statement( traceback.format_exc(), log=True )
+            log_statement( "ERROR : Could not load '%s': %s" % (
+                str(self._columns.gene_ids[gene_i]), inst), log=True)
             if DEBUG: raise
-            gene = None
+            return None
+    
+    def _load_gene(self, i):
+        try: 
+            return self._loaded_genes[i]
+        except KeyError:
+            pass
+        gene = self._build_gene(i)
+        self._loaded_genes[i] = gene
+        return gene
+    
+    def _build_lazy_locs_index(self):
+        index = defaultdict(list)
+        for i, key in enumerate(self._gene_keys):
+            index[key].append(i)
+        self._lazy_locs_index = {}
+        for key, indices in index.iteritems():
+            indices = numpy.array(indices)
+            indices = indices[numpy.lexsort(
+                (self._gene_stops[indices], self._gene_starts[indices]))]
+            self._lazy_locs_index[key] = ( 
+                indices, self._gene_starts[indices], 
+                numpy.maximum.accumulate(self._gene_stops[indices]) )
+        return self._lazy_locs_index
+    
+    def _iter_overlapping_genes_in_strand(self, chrm, strand, start, stop):
+        for gene in Annotation._iter_overlapping_genes_in_strand(
+                self, chrm, strand, start, stop):
+            yield gene
         
-        if gene == None: continue
-        genes.append( gene )
+        if self._lazy_locs_index == None: self._build_lazy_locs_index()
+        key = (clean_chr_name(chrm), strand)
+        if key not in self._lazy_locs_index: return
+        indices, starts, max_stops = self._lazy_locs_index[key]
+        lo = max_stops.searchsorted(start, side='left')
+        hi = starts.searchsorted(stop, side='right')
+        for i in indices[lo:hi]:
+            if start > self._gene_stops[i]: continue
+            gene = self._load_gene(i)
+            if gene != None: yield gene
+        return
     
+    def __iter__(self):
+        for i in xrange(len(self._gene_indices)):
+            gene = self._load_gene(i)
+            if gene != None: yield gene
+        for gene in Annotation.__iter__(self):
+            yield gene
+    
+    def iter_uncached(self):
+        """Iterate through the genes without storing them, so that a single
+           pass over a large annotation only keeps one gene in memory.
+
+        """
+        for i in xrange(len(self._gene_indices)):
+            if i in self._loaded_genes: gene = self._loaded_genes[i]
+            else: gene = self._build_gene(i)
+            if gene != None: yield gene
+        for gene in Annotation.__iter__(self):
+            yield gene
+
+def load_gtf(fname_or_fp, contig=None, strand=None):
+    """Load the genes in a gtf into an Annotation.
+
+    If fname_or_fp is a file name, the parsed gtf is cached next to it (see
+    load_gtf_columns). The gene objects are built lazily.
+    """
     if isinstance( fname_or_fp, str ):
-        fp.close()
+        columns = load_gtf_columns( fname_or_fp )
+    else:
+        assert isinstance( fname_or_fp, (file, gzip.GzipFile) )
+        columns = parse_gtf_columns( fname_or_fp )
     
-    return genes
+    return LazyAnnotation( columns, contig, strand )
 
 def load_next_gene_from_gtf(fp, contig=None, strand=None, 
                             all_expression_data=[]):
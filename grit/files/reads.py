@@ -18,14 +18,17 @@ along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import sys, os
+import struct
 from itertools import chain
 from collections import defaultdict, namedtuple
 from copy import copy
+from bisect import bisect
 
 import pysam
 import numpy
 
 import grit.config as config
+from grit.lib.profiling import add_to_counter
 from grit.frag_len import build_normal_density
 
 import junctions
@@ -268,6 +271,56 @@ def iter_coverage_intervals_for_read(read):
 
     return
 
+def find_coverage_intervals_for_reads(reads):
+    """Find the matched intervals of every read in reads.
+
+    Returns an array of (start, stop) rows with the same semantics as
+    iter_coverage_intervals_for_read. The cigar strings are flattened into
+    a single array so that the reference offsets of all the reads are
+    found with one cumulative sum.
+    """
+    cigar_ops, read_starts, n_ops = [], [], []
+    for read in reads:
+        cigar = read.cigar
+        if cigar == None: cigar = ()
+        cigar_ops.extend(cigar)
+        read_starts.append(read.pos)
+        n_ops.append(len(cigar))
+    if len(cigar_ops) == 0:
+        return numpy.zeros((0, 2), dtype=int)
+
+    cigar_ops = numpy.array(cigar_ops, dtype=int)
+    op_types, op_lens = cigar_ops[:,0], cigar_ops[:,1]
+    n_ops = numpy.array(n_ops, dtype=int)
+    if not numpy.in1d(op_types, (0, 1, 2, 3, 4, 5)).all():
+        print >> sys.stderr, "Unrecognized cigar format in", \
+            numpy.unique(op_types)
+    # matches, reference deletions and skipped regions consume the reference
+    ref_lens = numpy.where(numpy.in1d(op_types, (0, 2, 3)), op_lens, 0)
+    # the offset of each op from the start of its read
+    offsets = ref_lens.cumsum() - ref_lens
+    first_ops = n_ops.cumsum() - n_ops
+    offsets -= numpy.repeat(offsets[first_ops[n_ops > 0]], n_ops[n_ops > 0])
+    starts = numpy.repeat(numpy.array(read_starts, dtype=int), n_ops) + offsets
+
+    is_match = (op_types == 0)
+    return numpy.column_stack((
+        starts[is_match], starts[is_match] + op_lens[is_match] - 1))
+
+def build_coverage_array_from_intervals(intervals, start, stop):
+    """Count the intervals that cover each base in [start, stop].
+
+    The last base of each interval is not counted, to match the slicing in
+    Reads.build_read_coverage_array.
+    """
+    full_region_len = stop - start + 1
+    lower = (intervals[:,0]-start).clip(0, full_region_len)
+    upper = (intervals[:,1]-start).clip(0, full_region_len)
+    covered = (lower < upper)
+    diffs = numpy.bincount(lower[covered], minlength=full_region_len+1)
+    diffs -= numpy.bincount(upper[covered], minlength=full_region_len+1)
+    return diffs.cumsum()[:full_region_len].astype(float)
+
 def iter_coverage_regions_for_read(
     read, bam_obj, reverse_read_strand, pairs_are_opp_strand ):
     """Find the regions covered by this read
@@ -406,6 +459,260 @@ def iter_paired_reads(p1_reads, p2_reads, fl_dist=None):
 
     return
 
+CachedRead = namedtuple('CachedRead', [
+        'qname', 'is_read1', 'strand', 'rlen', 'matched_len', 'read_grp',
+        'cov_regions'])
+
+class GeneReadCache( object ):
+    """All of the read data that the element discovery and quantification
+       stages need for a gene, built from a single pass over the bam.
+
+    The cache stores the read coverage of the gene's span on each strand,
+    junction counts on both strands, the paired read data returned by
+    extract_jns_and_reads_in_region and the read pairs that are binned by
+    f_matrix.bin_rnaseq_reads. It implements build_read_coverage_array, so
+    it can be passed to code that expects a reads object. At most 
+    max_n_reads_to_store reads are stored for pairing and binning.
+    """
+    def __init__(self, reads, chrm, strand, regions,
+                 max_n_reads_to_store=1e6):
+        assert strand in '+-.', "Strand must be -, +, or . for either"
+        self.chrm = chrm
+        self.strand = strand
+        self.regions = sorted(regions)
+        self.start = self.regions[0][0]
+        self.stop = max(stop for start, stop in self.regions)
+
+        self.reads_are_stranded = reads.reads_are_stranded
+        self.fl_dists = reads.fl_dists
+        self.num_reads = reads.num_reads
+
+        self.jns = {'+': defaultdict(int), '-': defaultdict(int),
+                    '.': defaultdict(int)}
+        self.pair1_reads = defaultdict(list)
+        self.pair2_reads = defaultdict(list)
+        self.num_unique_reads = 0.0
+
+        # the reads that match the gene strand, for read pairing and binning
+        self._reads = []
+        # binned reads, keyed by (exon boundaries, include_read_type). This
+        # is filled by f_matrix.bin_rnaseq_reads
+        self.binned_reads = {}
+
+        # the coverage is built from running diffs over the gene span. 
+        # first_base_cnts counts the reads that cover the base that they 
+        # start at, because fetch doesn't return reads that start at the 
+        # stop of the region being fetched
+        span_len = self.stop - self.start + 1
+        cov_diffs = {}
+        self._first_base_cnts = {}
+        region_starts = [start for start, stop in self.regions]
+        def overlaps_region(start, stop):
+            i = bisect(region_starts, stop) - 1
+            return i >= 0 and self.regions[i][1] >= start
+
+        config.log_statement("Caching reads in %s" % str(
+                (chrm, strand, self.start, self.stop)))
+        n_obs_reads = -1
+        for n_obs_reads, (read, rd_strand) in enumerate(
+                reads.iter_reads_and_strand(chrm, self.start, self.stop+1)):
+            if n_obs_reads > 0 and n_obs_reads%100000 == 0:
+                config.log_statement("Cached %i reads in %s" % (
+                    n_obs_reads, str((chrm, strand, self.start, self.stop))))
+
+            for jn in junctions.iter_jns_in_read(read):
+                # we subtract one because the start refers to the first
+                # covered intron base, and we are talking about covered regions
+                if overlaps_region(jn[0]-1, jn[0]-1):
+                    self.jns[rd_strand][jn] += 1
+
+            cov_regions = tuple(iter_coverage_intervals_for_read(read))
+            if rd_strand not in cov_diffs:
+                cov_diffs[rd_strand] = numpy.zeros(span_len+1, dtype=int)
+                self._first_base_cnts[rd_strand] = numpy.zeros(
+                    span_len, dtype=int)
+            # the last base of each interval is not counted, to match 
+            # Reads.build_read_coverage_array
+            for start, stop in cov_regions:
+                lower = min(max(start-self.start, 0), span_len)
+                upper = min(max(stop-self.start, 0), span_len)
+                if lower >= upper: continue
+                cov_diffs[rd_strand][lower] += 1
+                cov_diffs[rd_strand][upper] -= 1
+            if ( len(cov_regions) > 0 and cov_regions[0][0] == read.pos 
+                 and cov_regions[0][1] > read.pos 
+                 and self.start <= read.pos <= self.stop ):
+                self._first_base_cnts[rd_strand][read.pos-self.start] += 1
+
+            # the rest of the data is only built for reads on the gene strand
+            if ( strand != '.' and rd_strand != '.' and rd_strand != strand ):
+                continue
+            if len(cov_regions) == 0 or not overlaps_region(
+                    cov_regions[0][0], cov_regions[-1][1]):
+                continue
+
+            map_prb = get_rd_posterior_prb(read)
+            self.num_unique_reads += (
+                map_prb/2. if read.is_paired else map_prb )
+
+            read_grp = [ val for key, val in read.tags if key == 'RG' ]
+            read_grp = read_grp[0] if len( read_grp ) == 1 else 'mean'
+
+            if max(len(self.pair1_reads), len(self.pair2_reads)
+                   ) < max_n_reads_to_store:
+                read_data = ReadData(rd_strand, read.inferred_length,
+                                     read_grp, map_prb, cov_regions)
+                if read.is_read1:
+                    self.pair1_reads[read.qname].append(read_data)
+                else:
+                    self.pair2_reads[read.qname].append(read_data)
+
+            if len(self._reads) < max_n_reads_to_store:
+                self._reads.append(CachedRead(
+                    read.qname, read.is_read1, rd_strand, read.rlen,
+                    sum( x[1] for x in read.cigar if x[0] == 0 ),
+                    read_grp, cov_regions))
+        add_to_counter('reads_fetched', n_obs_reads+1)
+
+        self._cov = {}
+        for rd_strand, diffs in cov_diffs.iteritems():
+            self._cov[rd_strand] = diffs.cumsum()[:span_len]
+
+        return
+
+    def build_read_coverage_array( self, chrm, strand,
+                                   start, stop, read_pair=None ):
+        """Coverage with the same semantics as Reads.build_read_coverage_array.
+
+        """
+        assert read_pair == None
+        assert clean_chr_name(chrm) == clean_chr_name(self.chrm)
+        assert self.start <= start and stop <= self.stop, \
+            "Region %i-%i is not in the cached region %i-%i" % (
+                start, stop, self.start, self.stop)
+        cvg = numpy.zeros(stop - start + 1)
+        for rd_strand, cov in self._cov.iteritems():
+            if not ( strand == None or rd_strand == '.'
+                     or rd_strand == strand ):
+                continue
+            cvg += cov[start-self.start:stop-self.start+1]
+            # fetch doesn't return reads that start at stop 
+            cvg[-1] -= self._first_base_cnts[rd_strand][stop-self.start]
+
+        return cvg
+
+    def iter_read_pairs( self ):
+        """Iterate through read pairs, in the same way as Reads.iter_paired_reads.
+
+        Every read1 is paired with the last read2 that shares its qname.
+        """
+        reads_pair2 = {}
+        for read in self._reads:
+            if not read.is_read1:
+                reads_pair2[read.qname] = read
+        for read1 in self._reads:
+            if not read1.is_read1: continue
+            try: read2 = reads_pair2[read1.qname]
+            except KeyError: continue
+            yield read1, read2
+
+        return
+
+    def iter_binnable_read_pairs( self ):
+        """Iterate through (read_len, read_group, cov_regions_1, cov_regions_2)
+           for read pairs that f_matrix.bin_rnaseq_reads can bin.
+
+        """
+        for r1, r2 in self.iter_read_pairs():
+            if r1.rlen == 0:
+                rlen = r1.matched_len
+            else:
+                rlen = r1.rlen
+                if rlen != r2.rlen: continue
+            rg = r1.read_grp if r1.read_grp == r2.read_grp else None
+            yield rlen, rg, r1.cov_regions, r2.cov_regions
+
+        return
+
+BAM_LINEAR_INDEX_SHIFT = 14
+BAM_METADATA_PSEUDO_BIN = 37450
+
+def load_bam_index_read_counts(index_fname):
+    """Estimate the number of reads in every linear index window of a bam.
+
+    The bam index stores, for each 2**BAM_LINEAR_INDEX_SHIFT bp window, the
+    virtual file offset of the first read that overlaps it. The number of
+    compressed bytes between adjacent windows is roughly proportional to the
+    number of reads that they contain, so we scale these byte counts to sum
+    to the number of mapped reads reported in the index metadata. 
+
+    Returns a list, indexed by reference id, of float arrays of estimated 
+    read counts.
+    """
+    with open(index_fname, 'rb') as fp:
+        data = fp.read()
+    if data[:4] != 'BAI\1':
+        raise ValueError, "'%s' is not a bam index file" % index_fname
+    
+    def read_int32(pos): 
+        return struct.unpack_from('<i', data, pos)[0], pos+4
+    def read_uint64s(pos, n): 
+        return numpy.frombuffer(data, dtype='<u8', count=n, offset=pos), pos+8*n
+    
+    all_counts = []
+    n_refs, pos = read_int32(4)
+    for ref_i in xrange(n_refs):
+        n_mapped, end_offset = None, 0
+        n_bins, pos = read_int32(pos)
+        for bin_i in xrange(n_bins):
+            bin_id = struct.unpack_from('<I', data, pos)[0]
+            n_chunks, pos = read_int32(pos+4)
+            chunks, pos = read_uint64s(pos, 2*n_chunks)
+            if bin_id == BAM_METADATA_PSEUDO_BIN:
+                n_mapped = int(chunks[2])
+            elif n_chunks > 0:
+                end_offset = max(end_offset, int(chunks[1::2].max()))
+        n_intervals, pos = read_int32(pos)
+        offsets, pos = read_uint64s(pos, n_intervals)
+        if n_intervals == 0 or end_offset == 0:
+            all_counts.append(numpy.zeros(n_intervals, dtype=float))
+            continue
+        
+        # convert the virtual offsets into approximate compressed file 
+        # positions - the low 16 bits are the offset into the uncompressed
+        # block, and BGZF blocks typically compress about 4 fold
+        def to_file_pos(v_offsets):
+            return (v_offsets >> 16).astype(float) + (v_offsets & 0xFFFF)/4.0
+        # empty windows have an offset of 0, so fill them in with the offset
+        # of the next non-empty window
+        file_pos = to_file_pos(offsets)
+        file_pos[offsets == 0] = numpy.inf
+        file_pos = numpy.minimum.accumulate(file_pos[::-1])[::-1]
+        end_pos = to_file_pos(numpy.array([end_offset,], dtype='<u8'))[0]
+        file_pos[numpy.isinf(file_pos)] = end_pos
+        n_bytes = numpy.diff(numpy.append(file_pos, end_pos)).clip(0)
+        if n_bytes.sum() == 0 or n_mapped == None:
+            all_counts.append(n_bytes)
+        else:
+            all_counts.append(n_mapped*n_bytes/n_bytes.sum())
+    
+    return all_counts
+
+def get_binned_read_counts( reads_files ):
+    """Sum the estimated linear index window read counts of a set of bams.
+
+    """
+    counts = {}
+    for reads in reads_files:
+        for contig, cnts in reads.binned_read_counts().iteritems():
+            if contig not in counts: 
+                counts[contig] = cnts.copy()
+                continue
+            if len(cnts) > len(counts[contig]):
+                cnts, counts[contig] = counts[contig], cnts.copy()
+            counts[contig][:len(cnts)] += cnts
+    return counts
+
 def get_contigs_and_lens( reads_files ):
     """Get contigs and their lengths from a set of bam files.
 
@@ -478,6 +785,10 @@ class MergedReads( object ):
     def reads_are_stranded(self):
         return all(rds.reads_are_stranded for rds in self._reads)
 
+    @property
+    def reads_are_paired(self):
+        return all(rds.reads_are_paired for rds in self._reads)
+
     def __init__(self, all_reads):
         self._reads = list(all_reads)
         self.type = self._find_reads_type(self._reads[0])
@@ -498,6 +809,16 @@ class MergedReads( object ):
 
         return
 
+    def contig_read_counts( self ):
+        counts = defaultdict(int)
+        for reads in self._reads:
+            for contig, cnt in reads.contig_read_counts().iteritems():
+                counts[contig] += cnt
+        return dict(counts)
+
+    def binned_read_counts( self ):
+        return get_binned_read_counts( self._reads )
+
     def mate(self, rd):
         for reads in self._reads:
             f_pos = reads.tell()
@@ -576,6 +897,44 @@ class Reads( pysam.Samfile ):
             self._contig_lens = dict( zip(self.references, self.lengths) )
             return self._contig_lens[self.fix_chrm_name(contig)]
 
+    def contig_read_counts( self ):
+        """Return the number of mapped reads in each contig.
+
+        The counts are read from the bam index (samtools idxstats), so they
+        are cheap to get but include duplicates and multi-mappers.
+        """
+        try:
+            return self._contig_read_counts
+        except AttributeError:
+            pass
+        try: 
+            stats = pysam.idxstats(self.filename)
+        except pysam.SamtoolsError, inst:
+            raise IOError, "Could not read the index of '%s': %s" % (
+                self.filename, inst)
+        if isinstance(stats, basestring): stats = stats.splitlines()
+        self._contig_read_counts = {}
+        for line in stats:
+            data = line.split()
+            if len(data) < 3 or data[0] == '*': continue
+            self._contig_read_counts[clean_chr_name(data[0])] = int(data[2])
+        return self._contig_read_counts
+
+    def binned_read_counts( self ):
+        """Return the estimated number of reads in each linear index window.
+
+        Returns a dict keyed by contig of arrays of read counts, where entry 
+        i covers the bases [i, i+1)*2**BAM_LINEAR_INDEX_SHIFT.
+        """
+        for index_fname in (self.filename + ".bai", 
+                            os.path.splitext(self.filename)[0] + ".bai"):
+            if os.path.exists(index_fname): break
+        else:
+            raise ValueError, "Can not find the index for '%s'" % self.filename
+        counts = load_bam_index_read_counts(index_fname)
+        return dict( (clean_chr_name(ref_name), cnts) 
+                     for ref_name, cnts in zip(self.references, counts) )
+
     def init(self, reads_are_paired, pairs_are_opp_strand,
                    reads_are_stranded, reverse_read_strand ):
         self._init_kwargs = {
@@ -699,17 +1058,13 @@ class Reads( pysam.Samfile ):
     def build_read_coverage_array( self, chrm, strand,
                                    start, stop, read_pair=None ):
         assert stop >= start
-        full_region_len = stop - start + 1
-        cvg = numpy.zeros(full_region_len)
-        for rd in self.iter_reads( chrm, strand, start, stop ):
-            if read_pair != None:
-                if read_pair==1 and not rd.is_read1: continue
-                if read_pair==2 and not rd.is_read2: continue
-            for region in iter_coverage_regions_for_read(
-                    rd, self, self.RRR, self.PAOS):
-                cvg[max(0, region[2]-start):max(0, region[3]-start)] += 1
-
-        return cvg
+        reads = self.iter_reads( chrm, strand, start, stop )
+        if read_pair == 1:
+            reads = ( rd for rd in reads if rd.is_read1 )
+        elif read_pair == 2:
+            reads = ( rd for rd in reads if rd.is_read2 )
+        return build_coverage_array_from_intervals(
+            find_coverage_intervals_for_reads(reads), start, stop)
 
     def build_paired_reads_fragment_coverage_array(
             self, chrm, strand, start, stop ):
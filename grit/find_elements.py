@@ -18,7 +18,6 @@ along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import sys, os
-import time
 import math
 import traceback
 
@@ -35,8 +34,12 @@ from copy import copy
 import multiprocessing
 import Queue
 
+from cStringIO import StringIO
+
 import networkx as nx
 
+from lib.graphs import DAG
+
 from genes import (
     GeneElements, SegmentBin, TranscriptBoundaryBin,
     find_all_gene_segments, TranscriptElement
@@ -45,7 +48,7 @@ from genes import (
 from files.reads import MergedReads, RNAseqReads, CAGEReads, \
     RAMPAGEReads, PolyAReads, \
     fix_chrm_name_for_ucsc, get_contigs_and_lens, \
-    iter_paired_reads, extract_jns_and_reads_in_region
+    iter_paired_reads, GeneReadCache
 import files.junctions
 from files.bed import create_bed_line
 from files.gtf import parse_gtf_line, load_gtf
@@ -64,6 +67,10 @@ frequency_estimation.PARAM_ABS_TOL = 1e-3
 
 import config
 
+from lib.multiprocessing_utils import WorkStealingScheduler
+from lib.profiling import StageMetrics
+from lib.checkpoint import get_gene_checkpoint, calc_signature
+
 class ThreadSafeFile( file ):
     def __init__( self, *args ):
         args = list( args )
@@ -112,8 +119,75 @@ def reverse_strand(bins_iter, contig_len):
         rev_bins.append( bin.reverse_strand( contig_len ) )
     return rev_bins
 
-class SpliceGraph(nx.DiGraph):
-    pass
+class SpliceGraph(object):
+    """The splice graph of the exon segments, TSS's and TES's in a gene.
+
+    Node i is exon segment i if i < num_segments, and otherwise a TSS or TES.
+    The node and edge types and bins are stored in lists, and the edges in a
+    DAG which is built by freeze after all of the nodes and edges are added.
+    """
+    def __init__(self, num_segments):
+        self.num_segments = num_segments
+        self.node_types = [None]*num_segments
+        self.node_bins = [None]*num_segments
+        self.edges = []
+        self.edge_types = []
+        self.edge_bins = []
+        self.dag = None
+
+    def __contains__(self, node):
+        return ( 0 <= node < len(self.node_types) 
+                 and self.node_types[node] != None )
+    
+    def add_node(self, node_type, bin, node=None):
+        """Add a node, and return its id. Segments must set their id.
+
+        """
+        assert (node_type == 'segment') == (node != None)
+        if node == None:
+            node = len(self.node_types)
+            self.node_types.append(None)
+            self.node_bins.append(None)
+        self.node_types[node] = node_type
+        self.node_bins[node] = bin
+        return node
+
+    def add_edge(self, start, stop, edge_type, bin=None):
+        assert self.dag == None
+        if start not in self or stop not in self:
+            raise KeyError, "Edge %i-%i has a missing node" % (start, stop)
+        self.edges.append((start, stop))
+        self.edge_types.append(edge_type)
+        self.edge_bins.append(bin)
+
+    def freeze(self):
+        self.dag = DAG(len(self.node_types), self.edges)
+        return self
+    
+    def successors(self, node):
+        return self.dag.successors(node)
+
+    def predecessors(self, node):
+        return self.dag.predecessors(node)
+    
+    def iter_nodes(self, node_types=None):
+        """Iterate over the (node, bin)'s with a type in node_types.
+
+        """
+        for node, (node_type, bin) in enumerate(
+                izip(self.node_types, self.node_bins)):
+            if node_type == None: continue
+            if node_types == None or node_type in node_types:
+                yield node, bin
+
+    def iter_edges(self, edge_types=None):
+        """Iterate over the (start, stop, bin)'s with a type in edge_types.
+
+        """
+        for (start, stop), edge_type, bin in izip(
+                self.edges, self.edge_types, self.edge_bins):
+            if edge_types == None or edge_type in edge_types:
+                yield start, stop, bin
 
 def find_cage_peak_bins_in_gene( gene, cage_reads, rnaseq_reads ):
     rnaseq_cov = gene.find_coverage( rnaseq_reads )
@@ -472,27 +546,15 @@ def find_transcribed_fragments_covering_region(
     return transcripts
 
 def extract_jns_and_paired_reads_in_gene(gene, reads):
-    pair1_reads = defaultdict(list)
-    pair2_reads = defaultdict(list)
-    plus_jns = defaultdict(int)
-    minus_jns = defaultdict(int)
-
-    for region in gene.regions:
-        ( r_pair1_reads, r_pair2_reads, r_plus_jns, r_minus_jns, _, _
-          ) = extract_jns_and_reads_in_region(
-            (gene.chrm, gene.strand, region.start, region.stop), reads)
-        for jn, cnt in r_plus_jns.iteritems():
-            plus_jns[jn] += cnt
-        for jn, cnt in r_minus_jns.iteritems(): 
-            minus_jns[jn] += cnt 
-        for qname, read_mappings in r_pair1_reads.iteritems(): 
-            pair1_reads[qname].extend(read_mappings)
-        for qname, read_mappings in r_pair2_reads.iteritems(): 
-            pair2_reads[qname].extend(read_mappings)
-
-    paired_reads = list(iter_paired_reads(pair1_reads, pair2_reads))
+    if not isinstance(reads, GeneReadCache):
+        reads = GeneReadCache(
+            reads, gene.chrm, gene.strand, 
+            [(region.start, region.stop) for region in gene.regions])
+
+    paired_reads = list(iter_paired_reads(reads.pair1_reads, reads.pair2_reads))
     jns, opp_strand_jns = (
-        (plus_jns, minus_jns) if gene.strand == '+' else (minus_jns, plus_jns)) 
+        (reads.jns['+'], reads.jns['-']) if gene.strand == '+' 
+        else (reads.jns['-'], reads.jns['+'])) 
     return paired_reads, jns, opp_strand_jns
 
 def find_widest_path(splice_graph):
@@ -566,12 +628,12 @@ def build_splice_graph_and_binned_reads_in_gene(
         (gene.chrm, gene.strand, gene.start, gene.stop) )
     
     # initialize the cage peaks with the reference provided set
-    tss_regions = [ Bin(pk_start, pk_stop, 
+    tss_regions = [ SegmentBin(pk_start, pk_stop, 
                      "CAGE_PEAK_START", "CAGE_PEAK_STOP", "CAGE_PEAK")
                  for pk_start, pk_stop in ref_elements['promoter'] ]
     
     # initialize the polya peaks with the reference provided set
-    tes_regions = [ Bin( pk_start, pk_stop, 
+    tes_regions = [ SegmentBin( pk_start, pk_stop, 
                       "POLYA_PEAK_START", "POLYA_PEAK_STOP", "POLYA")
                  for pk_start, pk_stop in ref_elements['polya'] ]
     
@@ -604,12 +666,13 @@ def build_splice_graph_and_binned_reads_in_gene(
     segment_bnd_labels[gene.stop+1].add("GENE_BNDRY")
     # add in empty regions - we will use these to filter bins
     # that fall outside of the gene
-    for r1, r2 in izip(gene.regions[:-1], gene.regions[1:]):
-        assert r1.stop+2 < r2.start-1+2
-        segment_bnds.add(r1.stop+1)
-        segment_bnd_labels[r1.stop+1].add( 'EMPTY_START' )
-        segment_bnds.add(r2.start-1+1)
-        segment_bnd_labels[r2.start-1+1].add( 'EMPTY_STOP' )
+    for r1_stop, r2_start in izip(gene.regions.stops[:-1].tolist(), 
+                                  gene.regions.starts[1:].tolist()):
+        assert r1_stop+2 < r2_start-1+2
+        segment_bnds.add(r1_stop+1)
+        segment_bnd_labels[r1_stop+1].add( 'EMPTY_START' )
+        segment_bnds.add(r2_start-1+1)
+        segment_bnd_labels[r2_start-1+1].add( 'EMPTY_STOP' )
     
     for (start, stop) in jns:
         segment_bnds.add(start)
@@ -650,7 +713,6 @@ def build_splice_graph_and_binned_reads_in_gene(
                 peak_cov,
                 ).set_tpm(tes_reads.num_reads))
     
-    splice_graph = SpliceGraph()
     tss_segment_map = {}
     for tss_bin in tss_regions:
         tss_start = tss_bin.start if gene.strand == '+' else tss_bin.stop + 1
@@ -683,6 +745,7 @@ def build_splice_graph_and_binned_reads_in_gene(
 
     # build the exon segment connectivity graph
     segment_bnds = numpy.array(sorted(segment_bnds))
+    splice_graph = SpliceGraph(len(segment_bnds)-1)
     
     for element_i in (x for x in xrange(0, len(segment_bnds)-1) 
                       if x not in empty_segments):
@@ -690,14 +753,14 @@ def build_splice_graph_and_binned_reads_in_gene(
         left_labels = segment_bnd_labels[start]
         right_labels = segment_bnd_labels[stop+1]
         bin = SegmentBin( start, stop, left_labels, right_labels, type=None)
-        splice_graph.add_node(element_i, type='segment', bin=bin)
+        splice_graph.add_node('segment', bin, element_i)
     
     for i in xrange(len(segment_bnds)-1-1):
         if i not in empty_segments and i+1 not in empty_segments:
             if gene.strand == '+':
-                splice_graph.add_edge(i, i+1, type='adjacent', bin=None)
+                splice_graph.add_edge(i, i+1, 'adjacent')
             else:
-                splice_graph.add_edge(i+1, i, type='adjacent', bin=None)
+                splice_graph.add_edge(i+1, i, 'adjacent')
 
     jn_edges = []
     for (start, stop), cnt in jns.iteritems():
@@ -707,34 +770,33 @@ def build_splice_graph_and_binned_reads_in_gene(
         assert segment_bnds[stop_i] == stop+1
         assert start_i in splice_graph
         # skip junctions that splice to the last base in the gene XXX
-        if stop_i == splice_graph.number_of_nodes(): continue
-        assert stop_i in splice_graph, str((stop_i, splice_graph.nodes(data=True)))
+        # ( num_segments includes the empty segments, which aren't nodes )
+        if stop_i == splice_graph.num_segments: continue
+        assert stop_i in splice_graph, str((stop_i, splice_graph.node_bins))
         if gene.strand == '+':
             bin = SegmentBin( start, stop, 'D_JN', 'R_JN', type='INTRON', cnt=cnt)
-            splice_graph.add_edge(start_i, stop_i, type='splice', bin=bin)
+            splice_graph.add_edge(start_i, stop_i, 'splice', bin)
         else:
             bin = SegmentBin( start, stop, 'R_JN', 'D_JN', type='INTRON', cnt=cnt)
-            splice_graph.add_edge(stop_i, start_i, type='splice', bin=bin)
+            splice_graph.add_edge(stop_i, start_i, 'splice', bin)
 
-    for i, (tss_bin, tss_segments) in enumerate(tss_segment_map.iteritems()):
-        node_id = "TSS_%i" % i
-        splice_graph.add_node( node_id, type='TSS', bin=tss_bin)
+    for tss_bin, tss_segments in tss_segment_map.iteritems():
+        node_id = splice_graph.add_node('TSS', tss_bin)
         for tss_start in tss_segments:
             bin_i = segment_bnds.searchsorted(tss_start)
             assert segment_bnds[bin_i] == tss_start
             if gene.strand == '-': bin_i -= 1
-            splice_graph.add_edge(node_id, bin_i, type='tss', bin=None)
+            splice_graph.add_edge(node_id, bin_i, 'tss')
 
-    for i, (tes_bin, tes_segments) in enumerate(tes_segment_map.iteritems()):
-        node_id = "TES_%i"% i
-        splice_graph.add_node( node_id, type='TES', bin=tes_bin)
+    for tes_bin, tes_segments in tes_segment_map.iteritems():
+        node_id = splice_graph.add_node('TES', tes_bin)
         for tes_start in tes_segments:
             bin_i = segment_bnds.searchsorted(tes_start)
             assert segment_bnds[bin_i] == tes_start
             if gene.strand == '+': bin_i -= 1
-            splice_graph.add_edge(bin_i, node_id, type='tes', bin=None)
+            splice_graph.add_edge(bin_i, node_id, 'tes')
 
-    return splice_graph, None
+    return splice_graph.freeze(), None
 
     config.log_statement(
         "Binning reads in Chrm %s Strand %s Pos %i-%i" %
@@ -764,33 +826,27 @@ def fast_quantify_segment_expression(
              ) in rnaseq_reads.fl_dists.iteritems():
         config.log_statement(str((marginal_frac, r1_len, r2_len, fl_dist, marginal_frac)))
         print marginal_frac, r1_len, r2_len
-        # XXX - FIXME
-        avg_read_len += marginal_frac*(r1_len[0] + r2_len[1])/2.0
+        avg_read_len += marginal_frac*(r1_len + r2_len)/2.0
 
     rnaseq_cov = gene.find_coverage(rnaseq_reads)
-    for element_i, data in splice_graph.nodes(data=True):
-        #element = splice_graph.nodes(element_i)
-        element = splice_graph.node[element_i]
-        if element['type'] != 'segment': continue
-        coverage = rnaseq_cov[element['bin'].start-gene.start
-                              :element['bin'].stop-gene.start+1]
+    for element_i, bin in splice_graph.iter_nodes(('segment',)):
+        coverage = rnaseq_cov[bin.start-gene.start:bin.stop-gene.start+1]
         n_reads_in_segment = 0 if len(coverage) == 0 else numpy.median(coverage)
-        fpkms = 1e6*(1000./element['bin'].length())*beta.ppf(
+        fpkms = 1e6*(1000./bin.length())*beta.ppf(
             quantiles,
             n_reads_in_segment+1e-6,
             rnaseq_reads.num_reads-n_reads_in_segment+1e-6)
-        element['bin'].set_expression(*fpkms)
+        bin.set_expression(*fpkms)
 
-    for start, stop, data in splice_graph.edges(data=True):
-        if data['type'] != 'splice': continue
-        n_reads_in_segment = float(data['bin'].cnt)
+    for start, stop, bin in splice_graph.iter_edges(('splice',)):
+        n_reads_in_segment = float(bin.cnt)
         effective_len = float(max(
             1, avg_read_len - 2*config.MIN_INTRON_FLANKING_SIZE))
         fpkms = 1e6*(1000./effective_len)*beta.ppf(
             quantiles, 
             n_reads_in_segment+1e-6, 
             rnaseq_reads.num_reads-n_reads_in_segment+1e-6)
-        data['bin'].set_expression(*fpkms)
+        bin.set_expression(*fpkms)
 
     return splice_graph
 
@@ -971,9 +1027,8 @@ def build_exons_from_exon_segments(gene, splice_graph, max_min_expression):
         "Building Exons from Segments in Chrm %s Strand %s Pos %i-%i" %
         (gene.chrm, gene.strand, gene.start, gene.stop) )
 
-    exon_segments = [ data['bin']
-                      for node_id, data in splice_graph.nodes(data=True)
-                      if data['type'] == 'segment' ]
+    exon_segments = [ bin for node_id, bin 
+                      in splice_graph.iter_nodes(('segment',)) ]
     if gene.strand == '-':
         exon_segments = reverse_strand(exon_segments, gene.stop)
     exon_segments = sorted(exon_segments, key=lambda x:x.start)
@@ -1024,9 +1079,15 @@ def build_exons_from_exon_segments(gene, splice_graph, max_min_expression):
     
     return exons
 
+def gene_segment_key(gene):
+    return ( gene.chrm, gene.strand, 
+             tuple(zip(gene.regions.starts.tolist(), 
+                       gene.regions.stops.tolist())) )
+
 def find_exons_in_gene( gene, contig_lens, ofp,
                         ref_elements, ref_elements_to_include,
-                        rnaseq_reads, cage_reads, polya_reads ):
+                        rnaseq_reads, cage_reads, polya_reads,
+                        checkpoint=None ):
     # extract the reference elements that we want to add in
     gene_ref_elements = defaultdict(list)
     for key, vals in ref_elements[(gene.chrm, gene.strand)].iteritems():
@@ -1040,6 +1101,11 @@ def find_exons_in_gene( gene, contig_lens, ofp,
     config.log_statement( "Finding Exons in Chrm %s Strand %s Pos %i-%i" %
                    (gene.chrm, gene.strand, gene.start, gene.stop) )
     
+    # extract all of the rnaseq read data that we need in a single pass
+    rnaseq_reads = GeneReadCache(
+        rnaseq_reads, gene.chrm, gene.strand, 
+        [(region.start, region.stop) for region in gene.regions])
+    
     # build the transcribed segment splice graph, and bin observe rnasseq reads 
     # based upon this splice graph in this gene.
     splice_graph, binned_reads = build_splice_graph_and_binned_reads_in_gene(
@@ -1056,97 +1122,88 @@ def find_exons_in_gene( gene, contig_lens, ofp,
     
     # introns are both elements and element segments
     gene.elements.extend(
-        data['bin'] for n1, n2, data in splice_graph.edges(data=True)
-        if data['type'] == 'splice'
-        and data['bin'].fpkm > min_max_exp)
+        bin for n1, n2, bin in splice_graph.iter_edges(('splice',))
+        if bin.fpkm > min_max_exp)
 
     if config.DEBUG_VERBOSE:
         gene.elements.extend(
-            data['bin'] for node_id, data in splice_graph.nodes(data=True)
-            if data['bin'].fpkm > min_max_exp )
+            bin for node_id, bin in splice_graph.iter_nodes()
+            if bin.fpkm > min_max_exp )
     
     # add T*S's
     gene.elements.extend(
-        data['bin'] for node_id, data in splice_graph.nodes(data=True)
-        if data['type'] in ('TSS', 'TES')
-        and data['bin'].fpkm > min_max_exp)
+        bin for node_id, bin in splice_graph.iter_nodes(('TSS', 'TES'))
+        if bin.fpkm > min_max_exp)
 
     # merge in the reference exons
     for tss_exon in gene_ref_elements['tss_exon']:
-        gene.elements.append( Bin(tss_exon[0], tss_exon[1], 
-                                  "REF_TSS_EXON_START", "REF_TSS_EXON_STOP",
-                                  "TSS_EXON") )
+        gene.elements.add( tss_exon[0], tss_exon[1], 
+                           "REF_TSS_EXON_START", "REF_TSS_EXON_STOP",
+                           "TSS_EXON" )
     for tes_exon in gene_ref_elements['tes_exon']:
-        gene.elements.append( Bin(tes_exon[0], tes_exon[1], 
-                                  "REF_TES_EXON_START", "REF_TES_EXON_STOP",
-                                  "TES_EXON") )
+        gene.elements.add( tes_exon[0], tes_exon[1], 
+                           "REF_TES_EXON_START", "REF_TES_EXON_STOP",
+                           "TES_EXON" )
     
     # add the gene bin
-    gene.write_elements_bed(ofp)
+    elements_bed = StringIO()
+    gene.write_elements_bed(elements_bed)
+    ofp.write(elements_bed.getvalue())
+    if checkpoint != None:
+        checkpoint.add(gene_segment_key(gene), elements_bed.getvalue())
     return
     config.log_statement( "FINISHED Finding Exons in Chrm %s Strand %s Pos %i-%i" %
                    (gene.chrm, gene.strand, gene.start, gene.stop) )
     return None
 
-def find_exons_worker( (genes_queue, genes_queue_lock, n_threads_running), 
-                       ofp, contig_lens, ref_elements, ref_elements_to_include,
-                       rnaseq_reads, cage_reads, polya_reads ):
+def find_exons_worker( genes, ofp, contig_lens, 
+                       ref_elements, ref_elements_to_include,
+                       rnaseq_reads, cage_reads, polya_reads,
+                       checkpoint=None ):
     rnaseq_reads = rnaseq_reads.reload()
     cage_reads = cage_reads.reload() if cage_reads != None else None
     polya_reads = polya_reads.reload() if polya_reads != None else None
     
-    while True:
-        # try to get a gene
-        with genes_queue_lock:
-            try: gene = genes_queue.pop()
-            except IndexError: gene = None
-        
-        # if there is no gene it process, but threads are still running, then 
-        # wait for the queue to fill or the process to finish
-        if gene == None and n_threads_running.value > 0:
-            config.log_statement( 
-                "Waiting for gene to process (%i)" % n_threads_running.value)
-            time.sleep(0.1)
-            continue
-        # otherwise, take a lock to make sure that the queue is empty and no 
-        # threads are running. If so, then return
-        elif gene == None:
-            with genes_queue_lock:
-                if len(genes_queue) == 0 and n_threads_running.value == 0:
-                    config.log_statement( "" )
-                    return
-                else: continue
-
-        # otherwise, we have a gene to process, so process it
-        assert gene != None
-        with genes_queue_lock: n_threads_running.value += 1
-
-        # find the exons and genes
+    for gene in genes:
         try:
-            rv = find_exons_in_gene(gene, contig_lens, ofp,
-                                    ref_elements, ref_elements_to_include,
-                                    rnaseq_reads, cage_reads, polya_reads )
+            with StageMetrics('find_exons_in_gene', region="%s:%s:%i-%i" % (
+                    gene.chrm, gene.strand, gene.start, gene.stop)) as metrics:
+                find_exons_in_gene(gene, contig_lens, ofp,
+                                   ref_elements, ref_elements_to_include,
+                                   rnaseq_reads, cage_reads, polya_reads,
+                                   checkpoint )
+                metrics.set_sizes(num_bins=len(gene.elements), 
+                                  num_regions=len(gene.regions))
         except Exception, inst:
             config.log_statement( 
                 "Uncaught exception in find_exons_in_gene", log=True )
             config.log_statement( traceback.format_exc(), log=True, display=False )
-            rv = None
-        
-        # if the return value is new genes, then add these to the queue
-        if rv != None:
-            with genes_queue_lock:
-                for gene in rv:
-                    genes_queue.append( gene )
-                n_threads_running.value -= 1
-        # otherwise, we found the exons and wrote out the element data,
-        # so just decrease the number of running threads
-        else:
-            with genes_queue_lock:
-                n_threads_running.value -= 1
     
-    assert False
+    config.log_statement( "" )
     return
 
+def estimate_gene_costs(genes, contig_lens, reads):
+    """Estimate the relative cost of processing each gene.
+
+    The cost is the gene span times the expected number of reads in the 
+    gene, where the read density is taken from the bam index counts. If 
+    the counts are unavailable, fall back to the span.
+    """
+    try: 
+        contig_read_counts = reads.contig_read_counts()
+    except (IOError, ValueError), inst:
+        config.log_statement(
+            "Can not estimate read counts from the bam index (%s) - using the gene spans as the gene costs" % inst, log=True)
+        contig_read_counts = {}
+    
+    costs = []
+    for gene in genes:
+        span = gene.stop - gene.start + 1
+        rd_density = ( contig_read_counts.get(gene.chrm, 0)
+                       /float(max(1, contig_lens.get(gene.chrm, 1))) )
+        costs.append( span*max(1.0, span*rd_density) )
+    return costs
+
 def extract_reference_elements(genes, ref_elements_to_include):
     ref_elements = defaultdict( lambda: defaultdict(set) )
     if not any(ref_elements_to_include):
@@ -1181,53 +1238,34 @@ def extract_reference_elements(genes, ref_elements_to_include):
 def find_exons( contig_lens, gene_bndry_bins, ofp,
                 rnaseq_reads, cage_reads, polya_reads,
                 ref_genes, ref_elements_to_include,
-                junctions=None, nthreads=None):
+                junctions=None, nthreads=None, checkpoint=None):
     assert not any(ref_elements_to_include) or ref_genes != None
     if nthreads == None: nthreads = config.NTHREADS
     assert junctions == None
     
     ref_elements = extract_reference_elements( 
         ref_genes, ref_elements_to_include )
-    genes_queue_lock = multiprocessing.Lock()
-    threads_are_running = multiprocessing.Value('i', 0)
-    if config.NTHREADS > 1:
-        manager = multiprocessing.Manager()
-        genes_queue = manager.list()
-    else:
-        genes_queue = []
-
-    genes_queue.extend( gene_bndry_bins )
     """
     for ref_gene in ref_genes:
         gene = GeneElements(ref_gene.chrm, ref_gene.strand)
         gene.regions.append(
             SegmentBin(ref_gene.start, ref_gene.stop, 
                        ["ESTART",], ["ESTOP",], "GENE"))
-        genes_queue.append(gene)
+        gene_bndry_bins.append(gene)
     """
-    args = [ (genes_queue, genes_queue_lock, threads_are_running), 
-             ofp, contig_lens, ref_elements, ref_elements_to_include,
-             rnaseq_reads, cage_reads, polya_reads ]
+    args = [ ofp, contig_lens, ref_elements, ref_elements_to_include,
+             rnaseq_reads, cage_reads, polya_reads, checkpoint ]
     
-    n_genes = len(genes_queue)
     if nthreads == 1:
-        find_exons_worker(*args)
+        find_exons_worker(iter(gene_bndry_bins), *args)
     else:
-        config.log_statement("Waiting on exon finding children (%i/%i remain)"%(
-                len(genes_queue), n_genes))
-        ps = []
-        for i in xrange( nthreads ):
-            p = multiprocessing.Process(target=find_exons_worker, args=args)
-            p.start()
-            ps.append( p )
-        
-        while True:
-            config.log_statement(
-                "Waiting on exon finding children (%i/%i remain)"%(
-                    len(genes_queue), n_genes))
-            if all( not p.is_alive() for p in ps ):
-                break
-            time.sleep( 1.0 )
+        config.log_statement("Scheduling exon finding for %i genes" 
+                             % len(gene_bndry_bins))
+        scheduler = WorkStealingScheduler(
+            gene_bndry_bins, 
+            estimate_gene_costs(gene_bndry_bins, contig_lens, rnaseq_reads),
+            nthreads)
+        scheduler.run(find_exons_worker, args)
 
     config.log_statement( "" )    
     return
@@ -1261,13 +1299,29 @@ def find_elements( promoter_reads, rnaseq_reads, polya_reads,
                 find_fls_from_annotation(ref_genes, rnaseq_reads))
         """
         
+        # write out the segments that were finished by a previous run
+        checkpoint = get_gene_checkpoint(
+            os.path.basename(ofname), 
+            calc_signature(sorted(gene_segment_key(gene) 
+                                  for gene in gene_segments),
+                           tuple(ref_elements_to_include)) )
+        if checkpoint != None and len(checkpoint) > 0:
+            config.log_statement( 
+                "Restoring the elements of %i gene segments" % len(checkpoint),
+                log=True )
+            for key, elements_bed in checkpoint.items():
+                ofp.write(elements_bed)
+            gene_segments = [ gene for gene in gene_segments 
+                              if gene_segment_key(gene) not in checkpoint ]
+        
         # sort genes from longest to shortest. This should help improve the 
         # multicore performance
         gene_segments.sort( key=lambda x: x.stop-x.start, reverse=True )
         find_exons( contig_lens, gene_segments, ofp,
                     rnaseq_reads, promoter_reads, polya_reads,
                     ref_genes, ref_elements_to_include, 
-                    junctions=None, nthreads=config.NTHREADS )            
+                    junctions=None, nthreads=config.NTHREADS,
+                    checkpoint=checkpoint )            
     except Exception, inst:
         config.log_statement( "FATAL ERROR", log=True )
         config.log_statement( traceback.format_exc(), log=True, display=False )
@@ -51,6 +51,11 @@ PARAM_ABS_TOL = 1e-8
 
 MAX_NUM_ITERATIONS = 1000
 
+# the relative tolerance of the confidence bounds, and the minimum likelihood
+# increase of a newton step, when they are estimated from profile likelihoods
+CB_REL_TOL = 1e-5
+PROFILE_LHD_ABS_TOL = 1e-8
+
 class TooFewReadsError( ValueError ):
     pass
 
@@ -540,6 +545,187 @@ def estimate_transcript_frequencies(observed_array, full_expected_array):
     return rv
         
 
+def project_onto_simplices( x, group_ids, group_starts ):
+    """Project each group of entries in x onto the simplex.
+
+    This is a vectorized version of project_onto_simplex. The groups must be
+    contiguous: group i is x[group_starts[i]:group_starts[i+1]], and 
+    group_ids gives the group of each entry. The groups are padded into the
+    rows of a 2D array, so every group is projected independently of the 
+    others.
+    """
+    n_groups = len(group_starts) - 1
+    positions = numpy.arange(len(x)) - group_starts[group_ids]
+    padded_x = numpy.zeros((n_groups, positions.max()+1)) - numpy.inf
+    padded_x[group_ids, positions] = x
+    is_padding = numpy.isinf(padded_x)
+    
+    sorted_x = -numpy.sort(-padded_x, axis=1)
+    cumsum = numpy.where(numpy.isinf(sorted_x), 0, sorted_x).cumsum(1)
+    ranks = numpy.arange(1, padded_x.shape[1]+1)
+    rhos = sorted_x - (1./ranks)*( cumsum - 1 )
+    rho = numpy.where(rhos > 0, ranks, 0).max(1)
+    theta = (1./rho)*( cumsum[numpy.arange(n_groups), rho-1] - 1 )
+    x_minus_theta = x - theta[group_ids]
+    x_minus_theta[ x_minus_theta < 0 ] = MIN_TRANSCRIPT_FREQ
+    
+    # leave groups that are already on the simplex alone
+    is_feasible = (
+        ((padded_x >= 0) | is_padding).all(1)
+        & ( numpy.abs(1 - numpy.where(is_padding, 0, padded_x).sum(1))
+            < MIN_TRANSCRIPT_FREQ ) )
+    return numpy.where(is_feasible[group_ids], x, x_minus_theta)
+
+class BatchedFrequencyProblem(object):
+    """The likelihoods of many genes packed into a single ragged layout.
+
+    The transcripts of every gene are concatenated into one frequency vector,
+    and the non-zero expected array entries of the bins with observed reads 
+    are stored as (bin, transcript, value) triplets, so the likelihoods and
+    gradients of all of the genes are computed with a few bincounts.
+    """
+    def __init__(self, observed_arrays, expected_arrays):
+        self.n_genes = len(expected_arrays)
+        n_transcripts = numpy.array([x.shape[1] for x in expected_arrays])
+        self.t_starts = numpy.append(0, n_transcripts.cumsum())
+        self.t_genes = numpy.repeat(numpy.arange(self.n_genes), n_transcripts)
+        
+        observed, bin_genes, rows, cols, vals = [], [], [], [], []
+        n_bins = 0
+        for gene_i, (observed_array, expected_array) in enumerate(
+                izip(observed_arrays, expected_arrays)):
+            # bins without reads don't contribute to the likelihood
+            bins = (observed_array > 0).nonzero()[0]
+            gene_rows, gene_cols = expected_array[bins].nonzero()
+            observed.append(observed_array[bins])
+            bin_genes.append(numpy.zeros(len(bins), dtype=int) + gene_i)
+            rows.append(gene_rows + n_bins)
+            cols.append(gene_cols + self.t_starts[gene_i])
+            vals.append(expected_array[bins][gene_rows, gene_cols])
+            n_bins += len(bins)
+        self.n_bins = n_bins
+        self.observed = numpy.concatenate(observed).astype(float)
+        self.bin_genes = numpy.concatenate(bin_genes)
+        self.rows = numpy.concatenate(rows)
+        self.cols = numpy.concatenate(cols)
+        self.vals = numpy.concatenate(vals)
+
+    def initial_freqs(self):
+        return 1./numpy.diff(self.t_starts)[self.t_genes]
+    
+    def calc_bin_freqs(self, x):
+        return numpy.bincount(self.rows, weights=self.vals*x[self.cols], 
+                              minlength=self.n_bins) + 1e-16
+    
+    def calc_lhds(self, x):
+        return numpy.bincount(
+            self.bin_genes, weights=self.observed*numpy.log(
+                self.calc_bin_freqs(x)), 
+            minlength=self.n_genes)
+
+    def calc_gradients(self, x):
+        weights = self.observed/self.calc_bin_freqs(x)
+        return numpy.bincount(self.cols, weights=self.vals*weights[self.rows], 
+                              minlength=len(x))
+
+    def project(self, x):
+        return project_onto_simplices(x, self.t_genes, self.t_starts)
+
+    def split(self, x):
+        return [ x[start:stop] for start, stop 
+                 in izip(self.t_starts[:-1], self.t_starts[1:]) ]
+
+def estimate_transcript_frequencies_batched(
+        observed_arrays, expected_arrays, abs_tol=None, 
+        max_num_iterations=MAX_NUM_ITERATIONS):
+    """Estimate the transcript frequencies of many genes at once.
+
+    This takes projected gradient steps, with a bisection line search, for 
+    all of the genes simultaneously. A gene is converged once its log 
+    likelihood has improved by less than abs_tol for NUM_ITER_FOR_CONV 
+    iterations in a row; converged genes are dropped from the batch as 
+    it shrinks.
+
+    Returns a list of frequency arrays. The entry is None for genes without
+    reads, or that did not converge, which should be estimated with
+    estimate_transcript_frequencies.
+    """
+    if abs_tol == None: abs_tol = LHD_ABS_TOL
+    rv = [None]*len(expected_arrays)
+    remaining = []
+    for i, (observed_array, expected_array) in enumerate(
+            izip(observed_arrays, expected_arrays)):
+        if observed_array.sum() == 0: continue
+        if expected_array.shape[1] == 1: rv[i] = numpy.ones(1, dtype=float)
+        else: remaining.append(i)
+    
+    x, num_small_steps = None, None
+    num_iterations = 0
+    while len(remaining) > 0 and num_iterations < max_num_iterations:
+        problem = BatchedFrequencyProblem(
+            [observed_arrays[i] for i in remaining],
+            [expected_arrays[i] for i in remaining])
+        if x == None:
+            x = problem.initial_freqs()
+            num_small_steps = numpy.zeros(problem.n_genes, dtype=int)
+        else:
+            x = numpy.concatenate(x)
+        prev_lhds = problem.calc_lhds(x)
+        is_active = numpy.ones(problem.n_genes, dtype=bool)
+        # iterate until half of the genes have converged, and then repack 
+        # the remaining genes
+        while ( is_active.sum() > problem.n_genes/2 
+                and num_iterations < max_num_iterations ):
+            num_iterations += 1
+            gradient = problem.calc_gradients(x)
+            gradient /= (numpy.bincount(problem.t_genes, weights=gradient)
+                         + 1e-12)[problem.t_genes]
+            
+            # bisection on alpha, for every gene at once
+            min_alpha = numpy.zeros(problem.n_genes)
+            max_alpha = numpy.zeros(problem.n_genes) + 10.
+            min_lhds = prev_lhds.copy()
+            is_searching = is_active.copy()
+            while is_searching.any():
+                alpha = (max_alpha + min_alpha)/2.
+                lhds = problem.calc_lhds(
+                    problem.project(x + alpha[problem.t_genes]*gradient))
+                is_better = is_searching & (lhds > min_lhds)
+                min_alpha[is_better] = alpha[is_better]
+                min_lhds[is_better] = lhds[is_better]
+                is_worse = is_searching & ~is_better
+                max_alpha[is_worse] = alpha[is_worse]
+                is_searching &= ~( 
+                    ((max_alpha - min_alpha < abs_tol) & (min_alpha > 1e-12))
+                    | (max_alpha < 1e-12) )
+            
+            # take the step for the genes whose likelihood improved
+            new_x = problem.project(x + min_alpha[problem.t_genes]*gradient)
+            is_improved = is_active & (min_alpha > 0)
+            x = numpy.where(is_improved[problem.t_genes], new_x, x)
+            lhds = numpy.where(is_improved, min_lhds, prev_lhds)
+            
+            is_small_step = (lhds - prev_lhds < abs_tol)
+            num_small_steps[is_small_step] += 1
+            num_small_steps[~is_small_step] = 0
+            is_active &= (num_small_steps < NUM_ITER_FOR_CONV)
+            prev_lhds = lhds
+        
+        if DEBUG_OPTIMIZATION:
+            config.log_statement( "Batched MLE: %i iterations, %i/%i genes converged" % (
+                    num_iterations, (~is_active).sum(), problem.n_genes) )
+        
+        x = problem.split(x)
+        for i, gene_x, gene_is_active in izip(remaining, x, is_active):
+            if not gene_is_active: rv[i] = gene_x
+        x = [gene_x for gene_x, gene_is_active in izip(x, is_active)
+             if gene_is_active]
+        remaining = [i for i, gene_is_active in izip(remaining, is_active)
+                     if gene_is_active]
+        num_small_steps = num_small_steps[is_active]
+    
+    return rv
+
 def estimate_confidence_bound( f_mat, 
                                num_reads_in_bams,
                                fixed_index,
@@ -699,6 +885,240 @@ def estimate_confidence_bound( f_mat,
     rv = chi2.sf( 2*(max_lhd-lhd), 1), value
     return rv    
 
+class LhdEvalBudgetExceeded(Exception):
+    pass
+
+class ConfidenceBoundsSession(object):
+    """Estimate all of the confidence bounds for a single gene.
+
+    The bound for x[i] is the value at which the profile likelihood - the 
+    likelihood maximized over the other frequencies with x[i] fixed - drops 
+    to the chi2 cutoff. As in the MLE, the other frequencies are kept above
+    MIN_TRANSCRIPT_FREQ, so that every bin with reads has a non-zero 
+    expected count. The observed Fisher information at the MLE seeds a 
+    bracket for each bound, which is narrowed with regula falsi, and every
+    profile likelihood is maximized with active set Newton steps that are 
+    warm started from the closest solution found so far. 
+
+    The total number of likelihood evaluations is capped at max_num_lhd_evals.
+    Once the cap is reached the search is stopped, and the bound is set to 
+    the most extreme feasible value found so far or, if there isn't one, to 
+    the Fisher information (Wald) bound.
+    """
+    def __init__(self, expected_array, observed_array, mle_estimate, alpha, 
+                 max_num_lhd_evals=None):
+        # bins without reads don't contribute to the likelihood
+        bins = (observed_array > 0).nonzero()[0]
+        self.expected_array = expected_array[bins]
+        self.observed_array = observed_array[bins].astype(float)
+        self.n = expected_array.shape[1]
+        
+        self.max_num_lhd_evals = max_num_lhd_evals
+        self.num_lhd_evals = 0
+        
+        self.mle = project_onto_simplex(mle_estimate.copy())
+        self.mle[self.mle < MIN_TRANSCRIPT_FREQ] = MIN_TRANSCRIPT_FREQ
+        self.mle /= self.mle.sum()
+        self.max_lhd = self.calc_lhd(self.mle)
+        self.alpha = alpha
+        self.lhd_drop = chi2.ppf( 1 - alpha, 1 )/2.
+        self.min_lhd = self.max_lhd - self.lhd_drop
+        
+        self.cov = self._calc_covariance()
+        # feasible points found by previous searches, to warm start from 
+        self.solutions = [self.mle,]
+    
+    def _calc_covariance(self):
+        """Invert the observed Fisher information in the simplex tangent space.
+
+        """
+        mu = numpy.dot(self.expected_array, self.mle)
+        # bins that no transcript can produce don't depend on the frequencies
+        bins = mu > 0
+        weighted = self.expected_array[bins]*numpy.sqrt(
+            self.observed_array[bins])[:,None]
+        weighted /= mu[bins][:,None]
+        fisher_info = numpy.dot(weighted.T, weighted)
+        # an orthonormal basis for the vectors that sum to zero
+        basis = svd(numpy.eye(self.n) - 1./self.n)[0][:,:self.n-1]
+        reduced_info = numpy.dot(basis.T, numpy.dot(fisher_info, basis))
+        return numpy.dot(
+            basis, numpy.dot(numpy.linalg.pinv(reduced_info), basis.T))
+    
+    def calc_lhd(self, x):
+        if ( self.max_num_lhd_evals != None 
+             and self.num_lhd_evals >= self.max_num_lhd_evals ):
+            raise LhdEvalBudgetExceeded, "Exceeded %i likelihood evaluations"%(
+                self.max_num_lhd_evals)
+        self.num_lhd_evals += 1
+        return ( self.observed_array*numpy.log(
+            numpy.dot(self.expected_array, x) + 1e-300) ).sum()
+    
+    def calc_profile_lhd(self, index, value, x):
+        """Maximize the likelihood over x, with x[index] fixed at value.
+
+        x is the warm start. Returns the likelihood and the maximizing x.
+        """
+        # the other frequencies are MIN_TRANSCRIPT_FREQ plus z, where z is
+        # non-negative and sums to total
+        offset = numpy.ones(self.n)*MIN_TRANSCRIPT_FREQ
+        offset[index] = value
+        total = 1 - offset.sum()
+        if total <= 0:
+            return self.calc_lhd(offset), offset
+        z = x - MIN_TRANSCRIPT_FREQ
+        z[index] = 0
+        z[z <= MIN_TRANSCRIPT_FREQ] = 0
+        if z.sum() == 0:
+            z[:] = 1
+            z[index] = 0
+        z *= total/z.sum()
+        y = offset + z
+        
+        lhd = self.calc_lhd(y)
+        free = z > 0
+        free[index] = False
+        for i in xrange(MAX_NUM_ITERATIONS):
+            weights = self.observed_array/(
+                numpy.dot(self.expected_array, y) + 1e-300)
+            gradient = numpy.dot(self.expected_array.T, weights)
+            # the lagrange multiplier for the sum to one constraint
+            mult = (z*gradient).sum()/total
+            # free the boundary frequencies that would increase the likelihood
+            free |= ( gradient > mult + PARAM_ABS_TOL*abs(mult) )
+            free[index] = False
+            
+            # find the newton step on the free frequencies, and drop the 
+            # boundary frequencies that it would make negative
+            candidates = free.nonzero()[0]
+            if len(candidates) == 0:
+                break
+            weighted = self.expected_array[:,candidates]*(
+                weights/numpy.sqrt(self.observed_array))[:,None]
+            full_hessian = numpy.dot(weighted.T, weighted)
+            keep = numpy.ones(len(candidates), dtype=bool)
+            while keep.any():
+                hessian = full_hessian[keep][:,keep]
+                hessian[numpy.diag_indices_from(hessian)] += (
+                    1e-9*hessian.trace()/keep.sum() + 1e-300 )
+                free_indices = candidates[keep]
+                solns = numpy.linalg.solve(hessian, numpy.vstack(
+                        (gradient[free_indices], numpy.ones(len(free_indices)))).T)
+                step = solns[:,0] - solns[:,1]*(
+                    solns[:,0].sum()/solns[:,1].sum())
+                blocked = (z[free_indices] <= 0) & (step < 0)
+                if not blocked.any(): break
+                keep[keep.nonzero()[0][blocked]] = False
+            if not keep.any(): 
+                break
+            
+            lhd_increase = numpy.dot(gradient[free_indices], step)
+            if lhd_increase < PROFILE_LHD_ABS_TOL: 
+                break
+            
+            # backtrack along the step projected onto the simplex, so that 
+            # many frequencies can move to the boundary in a single step
+            decreasing = step < 0
+            max_feasible_step_size = 1.
+            if decreasing.any():
+                max_feasible_step_size = min(1., (
+                    -z[free_indices][decreasing]/step[decreasing]).min())
+            step_size = 1.
+            for j in xrange(30):
+                new_z = z.copy()
+                new_z[free_indices] += step_size*step
+                new_z[new_z < 0] = 0
+                new_z[free_indices] *= total/new_z[free_indices].sum()
+                new_lhd = self.calc_lhd(offset + new_z)
+                if new_lhd >= lhd + 1e-4*lhd_increase*min(
+                        step_size, max_feasible_step_size): 
+                    break
+                step_size /= 2
+            else:
+                break
+            
+            z, lhd = new_z, new_lhd
+            z[z <= MIN_TRANSCRIPT_FREQ] = 0
+            free = z > 0
+            free[index] = False
+            z[free] *= total/z[free].sum()
+            y = offset + z
+        
+        return lhd, y
+    
+    def _calc_transformed_lhd(self, lhd):
+        # this is roughly linear in x[index] near the MLE
+        return math.sqrt(self.lhd_drop) - math.sqrt(max(self.max_lhd-lhd, 0))
+    
+    def estimate_bound(self, index, bound_type):
+        """Return the p-value and the bound for x[index].
+        
+        """
+        if bound_type == 'lb': bound_type = 'LOWER'
+        if bound_type == 'ub': bound_type = 'UPPER'
+        assert bound_type in ('LOWER', 'UPPER'), (
+            "Improper bound type '%s'" % bound_type )
+        if 1 == self.n:
+            return 1.0, 1.0
+        direction = -1 if bound_type == 'LOWER' else 1
+        end = 0. if bound_type == 'LOWER' else 1.
+        clip = lambda value: min(max(value, 0.), 1.)
+        
+        mle_value = self.mle[index]
+        wald_step = math.sqrt(2*self.lhd_drop*max(self.cov[index,index], 0))
+        wald_step = min(max(wald_step, MIN_TRANSCRIPT_FREQ), 1.)
+        wald_value = clip(mle_value + direction*wald_step)
+        
+        # warm start from the solution closest to the Wald bound
+        x = min(self.solutions, key=lambda x: abs(x[index]-wald_value))
+        
+        feas_value, feas_x, feas_lhd = mle_value, self.mle, self.max_lhd
+        try:
+            # expand the Wald bound until it brackets the bound
+            value = wald_value
+            while True:
+                lhd, x = self.calc_profile_lhd(index, value, x)
+                if lhd < self.min_lhd: break
+                feas_value, feas_x, feas_lhd = value, x, lhd
+                if value == end: break
+                value = clip(mle_value + 2*(value - mle_value))
+            
+            if lhd < self.min_lhd:
+                infeas_value = value
+                infeas_f = self._calc_transformed_lhd(lhd)
+                feas_f = self._calc_transformed_lhd(feas_lhd)
+                # narrow the bracket with the illinois variant of regula falsi
+                side = 0
+                for i in xrange(MAX_NUM_ITERATIONS):
+                    if abs(infeas_value - feas_value) <= max(
+                            MIN_TRANSCRIPT_FREQ, CB_REL_TOL*feas_value): 
+                        break
+                    value = infeas_value - infeas_f*(
+                        infeas_value - feas_value)/(infeas_f - feas_f)
+                    if not ( min(feas_value, infeas_value) < value 
+                             < max(feas_value, infeas_value) ):
+                        value = (feas_value + infeas_value)/2
+                    lhd, x = self.calc_profile_lhd(index, value, feas_x)
+                    if lhd >= self.min_lhd:
+                        feas_value, feas_x, feas_lhd = value, x, lhd
+                        feas_f = self._calc_transformed_lhd(lhd)
+                        if side == -1: infeas_f /= 2
+                        side = -1
+                    else:
+                        infeas_value = value
+                        infeas_f = self._calc_transformed_lhd(lhd)
+                        if side == 1: feas_f /= 2
+                        side = 1
+        except LhdEvalBudgetExceeded:
+            if feas_value == mle_value:
+                return self.alpha, wald_value
+        
+        self.solutions.append(feas_x)
+        value = feas_value
+        if value < PARAM_ABS_TOL: value = 0.
+        if 1-value < PARAM_ABS_TOL: value = 1.
+        return chi2.sf( 2*(self.max_lhd-feas_lhd), 1), value
+
 def estimate_confidence_bound_with_cvx( f_mat, 
                                num_reads_in_bams,
                                fixed_i,
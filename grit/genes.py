@@ -19,6 +19,8 @@ along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import time
+import shutil
+import tempfile
 import numpy
 import scipy
 import math
@@ -33,6 +35,9 @@ from scipy.stats import beta, binom
 
 import networkx as nx
 
+from lib.graphs import find_connected_components
+from lib.profiling import StageMetrics
+
 from copy import copy
 
 ReadCounts = namedtuple('ReadCounts', ['Promoters', 'RNASeq', 'Polya'])
@@ -47,24 +52,35 @@ import config
 
 from files.reads import MergedReads, RNAseqReads, CAGEReads, \
     RAMPAGEReads, PolyAReads, \
-    fix_chrm_name_for_ucsc, get_contigs_and_lens, calc_frag_len_from_read_data, \
+    fix_chrm_name_for_ucsc, get_contigs_and_lens, get_binned_read_counts, \
+    calc_frag_len_from_read_data, \
     iter_paired_reads, extract_jns_and_reads_in_region, TooManyReadsError
 import files.junctions
 
 from files.bed import create_bed_line
 
 class Bin(object):
-    start = None
-    stop = None
+    # bins are created in bulk, so they don't carry a per instance dict
+    __slots__ = ('start', 'stop')
+    
+    def __getstate__(self):
+        return dict( (attr, getattr(self, attr)) 
+                     for cls in type(self).__mro__
+                     for attr in getattr(cls, '__slots__', ())
+                     if hasattr(self, attr) )
+    
+    def __setstate__(self, state):
+        for attr, val in state.iteritems():
+            setattr(self, attr, val)
     
     def reverse_strand(self, contig_len):
-        kwargs = copy(self.__dict__)
-        kwargs['start'] = contig_len-1-self.stop
-        kwargs['stop'] = contig_len-1-self.start
-        if 'left_labels' in kwargs:
-            (kwargs['left_labels'], kwargs['right_labels'] 
-             ) = (kwargs['right_labels'], kwargs['left_labels'])
-        return type(self)(**kwargs)
+        rev_bin = copy(self)
+        rev_bin.start = contig_len-1-self.stop
+        rev_bin.stop = contig_len-1-self.start
+        if hasattr(self, 'left_labels'):
+            rev_bin.left_labels, rev_bin.right_labels = (
+                self.right_labels, self.left_labels)
+        return rev_bin
     
     def length(self):
         return self.stop - self.start + 1
@@ -152,6 +168,9 @@ class Bin(object):
                  self.find_bndry_color(right_label) )
 
 class SegmentBin(Bin):
+    __slots__ = ('left_labels', 'right_labels', 'type', 
+                 'fpkm_lb', 'fpkm', 'fpkm_ub', 'cnt')
+    
     def __init__(self, start, stop, left_labels, right_labels,
                  type=None, 
                  fpkm_lb=None, fpkm=None, fpkm_ub=None,
@@ -159,7 +178,10 @@ class SegmentBin(Bin):
         self.start = start
         self.stop = stop
         assert stop - start >= 0
-
+        
+        # a single label can be passed as a string
+        if isinstance(left_labels, str): left_labels = [left_labels,]
+        if isinstance(right_labels, str): right_labels = [right_labels,]
         self.left_labels = sorted(left_labels)
         self.right_labels = sorted(right_labels)
 
@@ -190,6 +212,8 @@ class SegmentBin(Bin):
         return rv
 
 class TranscriptBoundaryBin(SegmentBin):
+    __slots__ = ('cnts',)
+    
     def __init__(self, start, stop, left_labels, right_labels,
                  type, cnts):
         assert type in ('CAGE_PEAK', 'POLYA')
@@ -208,6 +232,8 @@ class TranscriptBoundaryBin(SegmentBin):
         return self
 
 class  TranscriptElement( Bin ):
+    __slots__ = ('type', 'fpkm')
+    
     def __init__( self, start, stop, type, fpkm):
         self.start = start
         self.stop = stop
@@ -226,26 +252,195 @@ class  TranscriptElement( Bin ):
             rv += ":%.2f FPKM" % self.fpkm
         return rv
 
+# the bin types and labels that can be stored in a BinTable
+BIN_TYPES = ( None, 'GENE', 'INTRON', 'EXON', 'TSS_EXON', 'TES_EXON', 
+              'SE_GENE', 'CAGE_PEAK', 'POLYA', 'RETAINED_INTRON', 
+              'INTERGENIC_SPACE', 'EXON_EXT', 'UNKNOWN' )
+BIN_LABELS = ( 'ESTART', 'ESTOP', 'D_JN', 'R_JN', 'TSS', 'TES', 
+               'GENE_BNDRY', 'CONTIG_BNDRY', 'EMPTY_START', 'EMPTY_STOP', 
+               'CAGE_PEAK_START', 'CAGE_PEAK_STOP', 
+               'POLYA_PEAK_START', 'POLYA_PEAK_STOP',
+               'REF_TSS_EXON_START', 'REF_TSS_EXON_STOP', 
+               'REF_TES_EXON_START', 'REF_TES_EXON_STOP' )
+
+class BinView(object):
+    """A read only row of a BinTable, with the attributes of a SegmentBin.
+
+    """
+    __slots__ = ('_table', '_index')
+    
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+    
+    def _get(self, column):
+        return self._table._data[column][self._index].item()
+
+    def _get_optional(self, column):
+        val = self._get(column)
+        return None if math.isnan(val) else val
+    
+    start = property(lambda self: self._get('start'))
+    stop = property(lambda self: self._get('stop'))
+    type = property(lambda self: BIN_TYPES[self._get('type')])
+    left_labels = property(
+        lambda self: self._table.decode_labels(self._get('left_labels')))
+    right_labels = property(
+        lambda self: self._table.decode_labels(self._get('right_labels')))
+    fpkm_lb = property(lambda self: self._get_optional('fpkm_lb'))
+    fpkm = property(lambda self: self._get_optional('fpkm'))
+    fpkm_ub = property(lambda self: self._get_optional('fpkm_ub'))
+    cnt = property(lambda self: self._get_optional('cnt'))
+    
+    length = Bin.__dict__['length']
+    __repr__ = SegmentBin.__dict__['__repr__']
+
+class BinTable(object):
+    """A columnar table of bins.
+
+    Every bin is a numpy record - the type and labels are stored as integer
+    codes, and missing expression values as nan - so a gene's bins are held
+    in one array rather than as many python objects. Iterating over, or 
+    indexing, the table returns BinView's.
+    """
+    dtype = [('start', 'i8'), ('stop', 'i8'), ('type', 'i1'), 
+             ('left_labels', 'i4'), ('right_labels', 'i4'), 
+             ('fpkm_lb', 'f8'), ('fpkm', 'f8'), ('fpkm_ub', 'f8'), 
+             ('cnt', 'f8')]
+    _type_codes = dict( (bin_type, i) for i, bin_type in enumerate(BIN_TYPES) )
+    _label_codes = dict( (label, 1<<i) for i, label in enumerate(BIN_LABELS) )
+    
+    def __init__(self, capacity=4):
+        self._data = numpy.zeros(capacity, dtype=self.dtype)
+        self._size = 0
+    
+    # pickle the raw records, because the dtype description is larger than 
+    # the records of a typical gene
+    def __getstate__(self):
+        return (self._data[:self._size].tostring(),)
+
+    def __setstate__(self, state):
+        self._data = numpy.frombuffer(state[0], dtype=self.dtype).copy()
+        self._size = len(self._data)
+    
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for i in xrange(self._size):
+            yield BinView(self, i)
+
+    def __getitem__(self, index):
+        if index < 0: index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError, "BinTable index out of range"
+        return BinView(self, index)
+    
+    def column(self, name):
+        return self._data[name][:self._size]
+
+    @property
+    def starts(self):
+        return self.column('start')
+
+    @property
+    def stops(self):
+        return self.column('stop')
+
+    def encode_type(self, bin_type):
+        try: return self._type_codes[bin_type]
+        except KeyError: 
+            raise ValueError, "Unrecognized bin type '%s'" % bin_type
+    
+    def encode_labels(self, labels):
+        # a single label can be passed as a string
+        if isinstance(labels, str): labels = [labels,]
+        code = 0
+        for label in labels:
+            try: code |= self._label_codes[label]
+            except KeyError: 
+                raise ValueError, "Unrecognized bin label '%s'" % label
+        return code
+    
+    def decode_labels(self, code):
+        return sorted( label for label in BIN_LABELS 
+                       if code & self._label_codes[label] )
+    
+    def _reserve(self, size):
+        if size <= len(self._data): return
+        data = numpy.zeros(max(size, 2*len(self._data)), dtype=self.dtype)
+        data[:self._size] = self._data[:self._size]
+        self._data = data
+    
+    def add(self, start, stop, left_labels=(), right_labels=(),
+            type=None, fpkm_lb=None, fpkm=None, fpkm_ub=None, cnt=None):
+        """Add a bin with the same arguments as SegmentBin.
+
+        """
+        assert stop - start >= 0
+        self._reserve(self._size+1)
+        self._data[self._size] = (
+            start, stop, self.encode_type(type), 
+            self.encode_labels(left_labels), self.encode_labels(right_labels),
+            numpy.nan if fpkm_lb == None else fpkm_lb, 
+            numpy.nan if fpkm == None else fpkm, 
+            numpy.nan if fpkm_ub == None else fpkm_ub,
+            numpy.nan if cnt == None else cnt)
+        self._size += 1
+    
+    def add_intervals(self, intervals, left_labels=(), right_labels=(), 
+                      type=None):
+        """Add a bin for every (start, stop) in intervals.
+
+        """
+        intervals = numpy.array(intervals, dtype=int).reshape((-1, 2))
+        assert (intervals[:,1] - intervals[:,0] >= 0).all()
+        self._reserve(self._size+len(intervals))
+        data = self._data[self._size:self._size+len(intervals)]
+        data['start'] = intervals[:,0]
+        data['stop'] = intervals[:,1]
+        data['type'] = self.encode_type(type)
+        data['left_labels'] = self.encode_labels(left_labels)
+        data['right_labels'] = self.encode_labels(right_labels)
+        for column in ('fpkm_lb', 'fpkm', 'fpkm_ub', 'cnt'):
+            data[column] = numpy.nan
+        self._size += len(intervals)
+    
+    def append(self, bin):
+        self.add( bin.start, bin.stop, 
+                  getattr(bin, 'left_labels', ()), 
+                  getattr(bin, 'right_labels', ()),
+                  bin.type, 
+                  getattr(bin, 'fpkm_lb', None), 
+                  getattr(bin, 'fpkm', None), 
+                  getattr(bin, 'fpkm_ub', None), 
+                  getattr(bin, 'cnt', None) )
+    
+    def extend(self, bins):
+        for bin in bins: self.append(bin)
+
 class GeneElements(object):
     def __init__( self, chrm, strand  ):
         self.chrm = chrm
         self.strand = strand
         
-        self.regions = []
+        self.regions = BinTable()
         self.element_segments = []
-        self.elements = []
+        self.elements = BinTable()
 
     def find_coverage(self, reads):
         cov = numpy.zeros(self.stop-self.start+1, dtype=float)
-        for x in self.regions:
+        for start, stop in izip(self.regions.starts.tolist(), 
+                                self.regions.stops.tolist()):
             seg_cov = reads.build_read_coverage_array( 
-                self.chrm, self.strand, x.start, x.stop )
-            cov[x.start-self.start:x.stop-self.start+1] = seg_cov
+                self.chrm, self.strand, start, stop )
+            cov[start-self.start:stop-self.start+1] = seg_cov
         #if gene.strand == '-': cov = cov[::-1]
         return cov
     
     def base_is_in_gene(self, pos):
-        return all( r.start <= pos <= r.stop for r in self.regions )
+        return bool( (self.regions.starts <= pos).all() 
+                     and (pos <= self.regions.stops).all() )
     
     def reverse_strand( self, contig_len ):
         rev_gene = GeneElements( self.chrm, self.strand )
@@ -271,11 +466,11 @@ class GeneElements(object):
         
     @property
     def start(self):
-        return min( x.start for x in self.regions )
+        return self.regions.starts.min().item()
 
     @property
     def stop(self):
-        return max( x.stop for x in self.regions )
+        return self.regions.stops.max().item()
 
     def __repr__( self ):
         loc_str = "GENE:%s:%s:%i-%i" % ( 
@@ -322,32 +517,29 @@ class GeneElements(object):
                                     score=1000,
                                     color=color_mapping['GENE'],
                                     use_thick_lines=True,
-                                    blocks=[(x.start, x.stop) for x in self.regions])
+                                    blocks=zip(self.regions.starts.tolist(),
+                                               self.regions.stops.tolist()))
         ofp.write( bed_line + "\n"  )
-        try: max_min_fpkm = max(1e-1, max(bin.fpkm for bin in self.elements)) \
-           if len(self.elements) > 0 else 0
-        except:  max_min_fpkm = 1000
         
-        for element in self.elements:
-            region = ( chrm, self.strand, element.start, element.stop)
-
+        # read the element columns directly, rather than building a view for
+        # every element
+        for start, stop, type_code in izip(
+                self.elements.starts.tolist(), 
+                self.elements.stops.tolist(),
+                self.elements.column('type').tolist()):
             blocks = []
-            use_thick_lines=(element.type != 'INTRON')
-            element_type = element.type
+            element_type = BIN_TYPES[type_code]
+            use_thick_lines=(element_type != 'INTRON')
             if element_type == None: 
                 element_type = 'UNKNOWN'
                 continue
             
-            try: fpkm = element.fpkm_ub
-            except: fpkm = element.fpkm
-            score = min(1000, int(1000*fpkm/max_min_fpkm))
             score = 1000
-            grp_id = element_type + "_%s_%s_%i_%i" % region
 
             # also, add 1 to stop because beds are open-closed ( which means no net 
             # change for the stop coordinate )
             bed_line = create_bed_line( chrm, self.strand, 
-                                        element.start, element.stop+1, 
+                                        start, stop+1, 
                                         feature_mapping[element_type],
                                         score=score,
                                         color=color_mapping[element_type],
@@ -627,11 +819,44 @@ def find_transcribed_regions_and_jns_in_segment(
         transcribed_regions, jn_reads, 
         ReadCounts(*num_unique_reads), fragment_lengths )
 
+def find_equal_read_count_boundaries(
+        read_counts, window_size, start, stop, n_segments):
+    """Split [start, stop) into n_segments with equal estimated read counts.
+
+    read_counts[i] is the number of reads in [i, i+1)*window_size. Reads are
+    assumed to be uniformly distributed within a window. Returns the 
+    n_segments+1 segment boundaries.
+    """
+    window_bnds = numpy.arange(len(read_counts)+1)*window_size
+    cum_counts = numpy.append(0, numpy.cumsum(read_counts))
+    def cum_count_at(pos):
+        i = min(pos//window_size, len(read_counts))
+        if i == len(read_counts): return cum_counts[-1]
+        return cum_counts[i] + read_counts[i]*float(pos-window_bnds[i])/window_size
+    
+    targets = numpy.linspace(
+        cum_count_at(start), cum_count_at(stop), n_segments+1)[1:-1]
+    # find the window that each target falls in. Since cum_counts[i] < target 
+    # <= cum_counts[i+1], read_counts[i] is positive
+    windows = numpy.searchsorted(cum_counts, targets, side='left') - 1
+    bnds = ( window_bnds[windows] 
+             + window_size*(targets-cum_counts[windows])/read_counts[windows] )
+    return [start,] + bnds.astype(int).tolist() + [stop,]
+
 def split_genome_into_segments(contig_lens, region_to_use, 
-                               min_segment_length=5000):
+                               min_segment_length=5000,
+                               binned_read_counts=None, 
+                               read_counts_window_size=2**14,
+                               max_reads_per_segment=5e5):
     """Return non-overlapping segments that cover the genome.
 
     The segments are closed-closed, and strand specific.
+
+    If binned_read_counts is set - a dict of arrays of read counts in 
+    consecutive windows of size read_counts_window_size, keyed by contig - 
+    then the segments are cut so that they contain roughly equal numbers of
+    reads (and at most max_reads_per_segment). Otherwise they are of equal 
+    length.
     """
     if region_to_use != None:
         r_chrm, (r_start, r_stop) = region_to_use
@@ -640,6 +865,15 @@ def split_genome_into_segments(contig_lens, region_to_use,
     total_length = sum(contig_lens.values())
     segment_length = max(min_segment_length, 
                          int(total_length/float(config.NTHREADS*1000)))
+    max_segment_length = 10*segment_length
+    if binned_read_counts != None:
+        total_num_reads = sum( binned_read_counts[contig].sum()
+                               for contig in contig_lens
+                               if contig in binned_read_counts )
+        reads_per_segment = min(
+            max_reads_per_segment, 
+            max(1.0, total_num_reads/float(config.NTHREADS*1000)))
+    
     segments = []
     # sort by shorter contigs, so that the short contigs (e.g. mitochondrial)
     # whcih usually take longer to finish are started first
@@ -647,42 +881,156 @@ def split_genome_into_segments(contig_lens, region_to_use,
             contig_lens.iteritems(), key=lambda x:x[1]):
         if region_to_use != None and r_chrm != contig: 
             continue
-        for start in xrange(r_start, min(r_stop,contig_length), segment_length):
-            segments.append(
-                (contig, start, 
-                 min(contig_length, start+segment_length-1)))
+        c_start, c_stop = r_start, min(r_stop, contig_length)
+        if c_start >= c_stop: continue
+        
+        read_counts = None
+        if binned_read_counts != None and contig in binned_read_counts:
+            read_counts = binned_read_counts[contig]
+        if read_counts is None or read_counts.sum() == 0:
+            bnds = range(c_start, c_stop, segment_length) + [c_stop,]
+        else:
+            n_reads = read_counts.sum()*float(c_stop-c_start)/contig_length
+            bnds = find_equal_read_count_boundaries(
+                read_counts, read_counts_window_size, c_start, c_stop, 
+                max(1, int(math.ceil(n_reads/reads_per_segment))))
+        
+        # merge segments that are too short, and split segments that are
+        # too long (e.g. large empty regions)
+        merged_bnds = [bnds[0],]
+        for bnd in bnds[1:-1]:
+            if bnd - merged_bnds[-1] >= min_segment_length: 
+                merged_bnds.append(bnd)
+        if len(merged_bnds) > 1 and c_stop - merged_bnds[-1] < min_segment_length:
+            merged_bnds.pop()
+        merged_bnds.append(c_stop)
+        
+        for start, stop in izip(merged_bnds[:-1], merged_bnds[1:]):
+            for seg_start in xrange(start, stop, max_segment_length):
+                seg_stop = min(stop, seg_start+max_segment_length)
+                segments.append(
+                    (contig, seg_start, 
+                     seg_stop-1 if seg_stop < contig_length else contig_length))
     return segments
 
 class GlobalGeneSegmentData(object):
+    """Collect the gene segment data found by the worker processes.
+
+    Every call to update_all_data writes a shard - numpy record arrays of the
+    transcribed regions, junctions and fragment lengths, sorted by 
+    (contig, strand) - into a temporary directory. After the workers finish,
+    the parent merges the shards one (contig, strand) at a time.
+    """
+    regions_dtype = [('key', 'i4'), ('start', 'i8'), ('stop', 'i8')]
+    jns_dtype = [('key', 'i4'), ('start', 'i8'), ('stop', 'i8'), ('cnt', 'f8')]
+
     def __init__(self, contig_lens):
-        self.manager = multiprocessing.Manager()
+        self.keys = sorted( (contig, strand) 
+                            for contig in contig_lens.keys()
+                            for strand in "+-" )
+        self._key_indices = dict( (key, i) for i, key in enumerate(self.keys) )
         self.num_unique_reads = ReadCounts(multiprocessing.Value('d', 0.0), 
                                            multiprocessing.Value('d', 0.0), 
                                            multiprocessing.Value('d', 0.0))
-        self.transcribed_regions = {}
-        self.jns = {}
-        for strand in "+-":
-            for contig in contig_lens.keys():
-                self.transcribed_regions[(contig, strand)] = self.manager.list()
-                self.jns[(contig, strand)] = self.manager.list()
-        self.frag_lens = self.manager.dict()
         self.lock = multiprocessing.Lock()
+        self.shard_dir = tempfile.mkdtemp(
+            prefix="gene_segments.", dir=config.tmp_dir)
+        self._num_shards_written = 0
+        self._shards = {}
+
+    def _shard_fname(self, shard_id, data_type):
+        return os.path.join(self.shard_dir, "%s.%s.npy" % (shard_id, data_type))
 
     def update_all_data(self, frag_lens, transcribed_regions, jns, rd_cnts):
+        shard_id = "%i.%i" % (os.getpid(), self._num_shards_written)
+        self._num_shards_written += 1
+        
+        regions = numpy.array(
+            [ (self._key_indices[key], start, stop)
+              for key, intervals in transcribed_regions.iteritems()
+              for start, stop in intervals ], dtype=self.regions_dtype)
+        regions.sort(order=['key', 'start', 'stop'])
+        numpy.save(self._shard_fname(shard_id, 'regions'), regions)
+
+        jns = numpy.array(
+            [ (self._key_indices[key], start, stop, cnt)
+              for key, key_jns in jns.iteritems()
+              for (start, stop), cnt in key_jns ], dtype=self.jns_dtype)
+        jns.sort(order=['key', 'start', 'stop'])
+        numpy.save(self._shard_fname(shard_id, 'jns'), jns)
+
+        # read groups are strings, or None if the pair's read groups differ
+        max_rd_grp_len = max( 
+            [1,] + [len(rd_grp) for rd_grp, rls, fl in frag_lens 
+                    if rd_grp != None] )
+        frag_lens = numpy.array(
+            [ (rd_grp if rd_grp != None else '', rd_grp == None, 
+               rls[0], rls[1], fl, cnt)
+              for (rd_grp, rls, fl), cnt in frag_lens.iteritems() ], 
+            dtype=[('read_grp', 'S%i' % max_rd_grp_len), 
+                   ('read_grp_is_none', '?'),
+                   ('read_len_1', 'i4'), ('read_len_2', 'i4'), 
+                   ('frag_len', 'i4'), ('cnt', 'f8')] )
+        numpy.save(self._shard_fname(shard_id, 'frag_lens'), frag_lens)
+        
         with self.lock:
-            for key, cnt in frag_lens.iteritems():
-                if key not in self.frag_lens: self.frag_lens[key] = cnt
-                else: self.frag_lens[key] += cnt
-            for key, regions in transcribed_regions.iteritems():
-                self.transcribed_regions[key].extend(regions)
-            for key, vals in jns.iteritems():
-                self.jns[key].extend( vals )
             for i, val in enumerate(rd_cnts):
                 self.num_unique_reads[i].value += val
         return
 
+    def _load_shards(self, data_type):
+        if data_type not in self._shards:
+            self._shards[data_type] = [
+                numpy.load(os.path.join(self.shard_dir, fname), mmap_mode='r')
+                for fname in sorted(os.listdir(self.shard_dir))
+                if fname.endswith(".%s.npy" % data_type) ]
+        return self._shards[data_type]
+    
+    def _merge_shards(self, data_type, key):
+        """Merge the sorted records for key from all of the shards.
+
+        """
+        key_i = self._key_indices[key]
+        runs = []
+        for shard in self._load_shards(data_type):
+            start, stop = shard['key'].searchsorted([key_i, key_i+1])
+            if stop > start: runs.append(numpy.array(shard[start:stop]))
+        if len(runs) == 0:
+            dtype = (self.regions_dtype if data_type == 'regions' 
+                     else self.jns_dtype)
+            return numpy.zeros(0, dtype=dtype)
+        merged = numpy.concatenate(runs)
+        # every run is already sorted, which merge sort takes advantage of
+        merged.sort(order=['start', 'stop'], kind='mergesort')
+        return merged
+
+    def merged_transcribed_regions(self, key):
+        regions = self._merge_shards('regions', key)
+        return zip(regions['start'].tolist(), regions['stop'].tolist())
+
+    def merged_jns(self, key):
+        jns = self._merge_shards('jns', key)
+        merged_jns = defaultdict(int)
+        for start, stop, cnt in izip(jns['start'].tolist(), 
+                                     jns['stop'].tolist(), 
+                                     jns['cnt'].tolist()):
+            merged_jns[(start, stop)] += cnt
+        return merged_jns
+
+    def merged_frag_lens(self):
+        merged_frag_lens = defaultdict(float)
+        for shard in self._load_shards('frag_lens'):
+            for rec in shard:
+                rd_grp = None if rec['read_grp_is_none'] else str(rec['read_grp'])
+                key = ( rd_grp, 
+                        (int(rec['read_len_1']), int(rec['read_len_2'])),
+                        int(rec['frag_len']) )
+                merged_frag_lens[key] += float(rec['cnt'])
+        return dict(merged_frag_lens)
+
     def shutdown(self):
-        self.manager.shutdown()
+        self._shards = {}
+        shutil.rmtree(self.shard_dir, ignore_errors=True)
         
 def find_segments_and_jns_worker(
         segments, global_gene_data,
@@ -712,10 +1060,13 @@ def find_segments_and_jns_worker(
             break
         config.log_statement("Finding genes and jns in %s" % str(segment) )
         try:
-            ( r_transcribed_regions, r_jns, r_n_unique_reads, r_frag_lens,
-                ) = find_transcribed_regions_and_jns_in_segment(
-                    segment, rnaseq_reads, promoter_reads, polya_reads, 
-                    ref_elements, ref_elements_to_include) 
+            with StageMetrics('find_all_gene_segments', region="%s:%i-%i" % 
+                              tuple(segment[:3])) as metrics:
+                ( r_transcribed_regions, r_jns, r_n_unique_reads, r_frag_lens,
+                    ) = find_transcribed_regions_and_jns_in_segment(
+                        segment, rnaseq_reads, promoter_reads, polya_reads, 
+                        ref_elements, ref_elements_to_include) 
+                metrics.set_sizes(num_reads=sum(r_n_unique_reads))
         except TooManyReadsError:
             seg1 = list(segment)
             seg1[2] = segment[1] + (segment[2]-segment[1])/2
@@ -768,39 +1119,44 @@ def load_gene_bndry_bins( genes, contig, strand, contig_len ):
             "Loading gene boundaries from annotated genes in %s:%s" % (  
                 contig, strand) )  
   
-    regions_graph = nx.Graph()
+    genes_regions = []
     for gene in genes:
         if gene.chrm != contig: continue  
         if gene.strand != strand: continue
-        regions = [tuple(x) for x in gene.find_transcribed_regions()]
-        regions_graph.add_nodes_from(regions)
-        regions_graph.add_edges_from(izip(regions[:-1], regions[1:]))
+        genes_regions.append(
+            [tuple(x) for x in gene.find_transcribed_regions()])
 
     # group overlapping regions
-    all_regions = sorted(regions_graph.nodes())
+    all_regions = sorted(set(chain(*genes_regions)))
     if len(all_regions) == 0: return []  
+    region_ids = dict((x, i) for i, x in enumerate(all_regions))
 
-    grpd_regions = [[],]
+    # join the regions in the same gene
+    edges = []
+    for regions in genes_regions:
+        edges.extend((region_ids[x], region_ids[y])
+                     for x, y in izip(regions[:-1], regions[1:]))
+    
+    # join overlapping regions
     curr_start, curr_stop = all_regions[0]
-    for x in all_regions:
+    for i, x in enumerate(all_regions):
         if x[0] < curr_stop:
             curr_stop = max(x[1], curr_stop)
-            grpd_regions[-1].append(x)
+            if i > 0: edges.append((i-1, i))
         else:
             curr_start, curr_stop = x
-            grpd_regions.append([x,])
-    # add edges for overlapping regions
-    for grp in grpd_regions:
-        regions_graph.add_edges_from(izip(grp[:-1], grp[1:]))
-
+    
     # build gene objects with the intervals  
+    components = find_connected_components(len(all_regions), edges)
+    regions_clusters = [[] for i in xrange(components.max()+1)]
+    for region, component in izip(all_regions, components):
+        regions_clusters[component].append(region)
     gene_bndry_bins = []  
-    for regions_cluster in nx.connected_components(regions_graph):
+    for regions_cluster in regions_clusters:
         gene_bin = GeneElements( contig, strand )
         regions = sorted(files.gtf.flatten(regions_cluster))
-        for start, stop in regions:
-            gene_bin.regions.append(
-                SegmentBin(start, stop, ["ESTART",], ["ESTOP",], "GENE"))
+        gene_bin.regions.add_intervals(
+            regions, ["ESTART",], ["ESTOP",], "GENE")
         gene_bndry_bins.append( gene_bin )  
 
     # XXX TODO expand gene boundaries
@@ -852,7 +1208,18 @@ def find_all_gene_segments( rnaseq_reads, promoter_reads, polya_reads,
         pids.append(pid)
 
     config.log_statement("Populating gene segment queue")        
-    segments = split_genome_into_segments(contig_lens, region_to_use)
+    # cut the genome into segments with roughly equal numbers of reads, 
+    # using the read counts stored in the bam indices
+    try: 
+        binned_read_counts = get_binned_read_counts(
+            [ reads for reads in [rnaseq_reads, promoter_reads, polya_reads]
+              if reads != None ] )
+    except Exception, inst:
+        config.log_statement(
+            "Can not estimate read counts from the bam index (%s) - using fixed length gene segments" % inst, log=True)
+        binned_read_counts = None
+    segments = split_genome_into_segments(
+        contig_lens, region_to_use, binned_read_counts=binned_read_counts)
     for segment in segments: 
         segments_queue.put(segment)
     for i in xrange(config.NTHREADS): segments_queue.put('FINISHED')
@@ -870,25 +1237,22 @@ def find_all_gene_segments( rnaseq_reads, promoter_reads, polya_reads,
         os.waitpid(pid, 0) 
             
     config.log_statement("Merging gene segments")
-    merged_transcribed_regions = {}
-    for key, intervals in global_gene_data.transcribed_regions.iteritems():
-        merged_transcribed_regions[
-            key] = merge_adjacent_intervals(
-                intervals, config.MAX_EMPTY_REGION_SIZE)
-    transcribed_regions = merged_transcribed_regions
+    transcribed_regions = {}
+    for key in global_gene_data.keys:
+        transcribed_regions[key] = merge_adjacent_intervals(
+            global_gene_data.merged_transcribed_regions(key), 
+            config.MAX_EMPTY_REGION_SIZE)
     
     config.log_statement("Filtering junctions")    
     filtered_jns = defaultdict(dict)
     for contig in contig_lens.keys():
-        plus_jns = defaultdict(int)
-        for jn, cnt in global_gene_data.jns[(contig, '+')]: plus_jns[jn] += cnt
-        minus_jns = defaultdict(int)
-        for jn, cnt in global_gene_data.jns[(contig, '-')]: minus_jns[jn] += cnt
+        plus_jns = global_gene_data.merged_jns((contig, '+'))
+        minus_jns = global_gene_data.merged_jns((contig, '-'))
         filtered_jns[(contig, '+')] = filter_jns(plus_jns, minus_jns)
         filtered_jns[(contig, '-')] = filter_jns(minus_jns, plus_jns)
 
     config.log_statement("Building FL dist")        
-    fl_dists = build_fl_dists_from_fls_dict(dict(global_gene_data.frag_lens))
+    fl_dists = build_fl_dists_from_fls_dict(global_gene_data.merged_frag_lens())
         
     if ref_elements_to_include.junctions:
         for gene in ref_genes:
@@ -900,25 +1264,20 @@ def find_all_gene_segments( rnaseq_reads, promoter_reads, polya_reads,
     # build bins for all of the genes and junctions, converting them to 1-based
     # in the process
     new_genes = []
-    new_introns = []
     for contig, contig_len in contig_lens.iteritems():
         for strand in '+-':
             key = (contig, strand)
             jns = [ (start, stop, cnt) 
                     for (start, stop), cnt 
                     in sorted(filtered_jns[key].iteritems()) ]
-            for start, stop, cnt in jns:
-                new_introns.append(
-                    SegmentBin(start, stop, ["D_JN",], ["R_JN",], "INTRON"))
             intervals = cluster_intron_connected_segments(
                 transcribed_regions[key], 
                 [(start, stop) for start, stop, cnt in jns ] )
             # add the intergenic space, since there could be interior genes
             for segments in intervals: 
                 new_gene = GeneElements( contig, strand )
-                for start, stop in segments:
-                    new_gene.regions.append( 
-                        SegmentBin(start, stop, ["ESTART",],["ESTOP",],"GENE"))
+                new_gene.regions.add_intervals(
+                    segments, ["ESTART",], ["ESTOP",], "GENE")
                 if new_gene.stop-new_gene.start+1 < config.MIN_GENE_LENGTH: 
                     continue
                 new_genes.append(new_gene)
@@ -0,0 +1,223 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import struct
+import zlib
+import fcntl
+import json
+import hashlib
+import tempfile
+from itertools import chain
+import cPickle as pickle
+
+from grit import config
+from grit.lib.profiling import add_to_counter
+
+def calc_signature(*args):
+    """Return a hex digest of args, which must pickle deterministically.
+
+    """
+    return hashlib.sha1(pickle.dumps(args, protocol=2)).hexdigest()
+
+def calc_files_signature(fnames):
+    """Return a hex digest of the contents of fnames.
+
+    """
+    hasher = hashlib.sha1()
+    for fname in fnames:
+        with open(fname, "rb") as fp:
+            while True:
+                data = fp.read(1<<20)
+                if len(data) == 0: break
+                hasher.update(data)
+    return hasher.hexdigest()
+
+def atomic_write(fname, data):
+    """Durably replace the contents of fname with data.
+
+    """
+    fd, tmp_fname = tempfile.mkstemp(
+        prefix=os.path.basename(fname) + ".",
+        dir=os.path.dirname(fname))
+    try:
+        os.write(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(tmp_fname, fname)
+
+class GeneCheckpoint(object):
+    """An append only record of the per gene results of a stage.
+
+    Every record is a length and crc32 prefixed pickle of (key, value),
+    written with a single O_APPEND write so that forked workers can add
+    records concurrently, and fsync'ed before add returns. The first record stores the signature of the
+    stage's inputs: when resuming, the old records are only kept if the
+    signatures match. A partially written record, and everything after it,
+    is ignored.
+
+    Opening a checkpoint rewrites its file, so it must be opened once,
+    before the workers are forked.
+    """
+    _record_header_fmt = '<qI'
+
+    def _iter_records(self):
+        header_size = struct.calcsize(self._record_header_fmt)
+        with open(self.fname, "rb") as fp:
+            while True:
+                header = fp.read(header_size)
+                if len(header) < header_size: return
+                size, crc = struct.unpack(self._record_header_fmt, header)
+                data = fp.read(size)
+                if len(data) < size or zlib.crc32(data) & 0xffffffff != crc:
+                    return
+                yield pickle.loads(data)
+
+    def _pack_record(self, record):
+        data = pickle.dumps(record, protocol=-1)
+        add_to_counter('bytes_pickled', len(data))
+        return struct.pack(self._record_header_fmt,
+                           len(data), zlib.crc32(data) & 0xffffffff) + data
+
+    def __init__(self, fname, signature, resume=False):
+        self.fname = fname
+        self.signature = signature
+        self._records = []
+
+        if resume and os.path.exists(self.fname):
+            records = list(self._iter_records())
+            if len(records) > 0 and records[0] == (None, signature):
+                self._records = records[1:]
+            else:
+                config.log_statement(
+                    "Discarding the out of date checkpoint '%s'" % fname,
+                    log=True)
+        # start a new file, with the valid records from the old one
+        atomic_write(self.fname, "".join(
+                self._pack_record(record) for record in 
+                chain([(None, signature),], self._records)))
+
+        self._values = dict(self._records)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def items(self):
+        """Return every (key, value) record, in the order they were added.
+
+        """
+        return list(self._records)
+
+    def add(self, key, value):
+        fd = os.open(self.fname, os.O_WRONLY|os.O_APPEND)
+        try: 
+            os.write(fd, self._pack_record((key, value)))
+            os.fsync(fd)
+        finally: os.close(fd)
+
+class CheckpointManifest(object):
+    """The finished stages of a run, and the signatures of their inputs.
+
+    The manifest is a json file that is locked while it's updated, so that
+    concurrently running samples can share it.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+
+    def _load(self):
+        try:
+            with open(self.fname) as fp:
+                return json.load(fp)
+        except IOError:
+            return {}
+
+    def _update(self, stage, value):
+        with open(self.fname + ".lock", "w") as lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)
+            stages = self._load()
+            if value is None: stages.pop(stage, None)
+            else: stages[stage] = value
+            atomic_write(self.fname, json.dumps(stages, indent=2))
+
+    def is_finished(self, stage, signature):
+        return self._load().get(stage) == signature
+
+    def mark_finished(self, stage, signature):
+        self._update(stage, signature)
+
+    def mark_unfinished(self, stage):
+        self._update(stage, None)
+
+def _ensure_checkpoint_dir():
+    dirname = config.get_checkpoint_dirname()
+    try: os.makedirs(dirname)
+    except OSError:
+        if not os.path.isdir(dirname): raise
+    return dirname
+
+def get_gene_checkpoint(stage, signature, sample_type=None, rep_id=None):
+    """Return the checkpoint for stage, or None if checkpoints are disabled.
+
+    Old records are only loaded if the run is being resumed.
+    """
+    if not config.WRITE_CHECKPOINTS or config.tmp_dir == None:
+        return None
+    _ensure_checkpoint_dir()
+    return GeneCheckpoint(
+        config.get_checkpoint_fname(stage, sample_type, rep_id),
+        signature, config.RESUME_FROM_CHECKPOINTS)
+
+def get_checkpoint_manifest():
+    """Return the run's manifest, or None if checkpoints are disabled.
+
+    """
+    if not config.WRITE_CHECKPOINTS or config.tmp_dir == None:
+        return None
+    _ensure_checkpoint_dir()
+    return CheckpointManifest(config.get_checkpoint_manifest_fname())
+
+def load_stage_result(stage, signature):
+    """Return the stored result of a finished stage, or raise a KeyError.
+
+    """
+    manifest = get_checkpoint_manifest()
+    if ( manifest == None or not config.RESUME_FROM_CHECKPOINTS
+         or not manifest.is_finished(stage, signature) ):
+        raise KeyError, "'%s' hasn't been finished" % stage
+    with open(config.get_checkpoint_fname(stage)) as fp:
+        return pickle.load(fp)
+
+def save_stage_result(stage, signature, result):
+    manifest = get_checkpoint_manifest()
+    if manifest == None: return
+    try:
+        data = pickle.dumps(result, protocol=-1)
+    except Exception, inst:
+        config.log_statement(
+            "Can not checkpoint '%s': %s" % (stage, inst), log=True)
+        return
+    atomic_write(config.get_checkpoint_fname(stage), data)
+    manifest.mark_finished(stage, signature)
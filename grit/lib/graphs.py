@@ -0,0 +1,238 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy
+
+from array import array
+
+def _build_csr(num_nodes, srcs, dsts):
+    """Return the (indptr, indices) arrays of the edges src->dst.
+
+    """
+    order = numpy.lexsort((dsts, srcs))
+    indptr = numpy.zeros(num_nodes+1, dtype=int)
+    indptr[1:] = numpy.bincount(srcs, minlength=num_nodes).cumsum()
+    return indptr, dsts[order]
+
+class PathTrie(object):
+    """A set of paths through a graph, stored as a trie that shares the
+       paths' common prefixes.
+
+    Trie node i is the graph node nodes[i], and follows the trie node 
+    parents[i] (-1 for the first node of a path). leaves holds the trie node 
+    that ends each path, in the order that the paths were added.
+    """
+    def __init__(self):
+        self.nodes = array('i')
+        self.parents = array('i')
+        self.leaves = array('i')
+
+    def add_node(self, node, parent):
+        self.nodes.append(node)
+        self.parents.append(parent)
+        return len(self.nodes) - 1
+
+    def add_path(self, trie_node):
+        self.leaves.append(trie_node)
+
+    def path(self, path_i):
+        path = []
+        trie_node = self.leaves[path_i]
+        while trie_node != -1:
+            path.append(self.nodes[trie_node])
+            trie_node = self.parents[trie_node]
+        path.reverse()
+        return path
+
+    def __len__(self):
+        return len(self.leaves)
+    
+    def __iter__(self):
+        for path_i in xrange(len(self.leaves)):
+            yield self.path(path_i)
+        return
+
+class DAG(object):
+    """A directed acyclic graph with integer node ids, stored in CSR form.
+
+    The successors of node i are indices[indptr[i]:indptr[i+1]], sorted by
+    id, and duplicate edges are merged. nodes optionally labels the node ids,
+    and node_ids maps the labels back to ids.
+    """
+    def __init__(self, num_nodes, edges, nodes=None):
+        self.num_nodes = num_nodes
+        if nodes != None:
+            assert len(nodes) == num_nodes
+            self.nodes = nodes
+            self.node_ids = dict( (node, i) for i, node in enumerate(nodes) )
+
+        edges = numpy.array(list(edges), dtype=int).reshape((-1, 2))
+        if len(edges) > 0:
+            assert edges.min() >= 0 and edges.max() < num_nodes
+            # merge duplicate edges
+            edges = numpy.unique(edges[:,0]*num_nodes + edges[:,1])
+            edges = numpy.vstack((edges//num_nodes, edges%num_nodes)).T
+        self.num_edges = len(edges)
+        self.indptr, self.indices = _build_csr(
+            num_nodes, edges[:,0], edges[:,1])
+        self._pred_indptr, self._pred_indices = _build_csr(
+            num_nodes, edges[:,1], edges[:,0])
+
+        self.topological_order = self._find_topological_order()
+
+    def _find_topological_order(self):
+        in_degrees = numpy.diff(self._pred_indptr)
+        order = numpy.zeros(self.num_nodes, dtype=int)
+        order_len = 0
+        ready = numpy.flatnonzero(in_degrees == 0).tolist()
+        while len(ready) > 0:
+            node = ready.pop()
+            order[order_len] = node
+            order_len += 1
+            successors = self.successors(node)
+            in_degrees[successors] -= 1
+            ready.extend(successors[in_degrees[successors] == 0].tolist())
+        if order_len < self.num_nodes:
+            raise ValueError, "The graph contains a cycle"
+        return order
+
+    def successors(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node+1]]
+
+    def predecessors(self, node):
+        return self._pred_indices[
+            self._pred_indptr[node]:self._pred_indptr[node+1]]
+
+    def _build_sinks_mask(self, sinks):
+        is_sink = numpy.zeros(self.num_nodes, dtype=bool)
+        is_sink[numpy.array(list(sinks), dtype=int)] = True
+        return is_sink
+
+    def count_paths(self, sources, sinks, max_count=None):
+        """Count the paths that start at a node in sources, and stop at the
+           first node in sinks that they reach.
+
+        If max_count is set then the per node counts are capped at
+        max_count+1, so the result is only exact up to max_count.
+        """
+        is_sink = self._build_sinks_mask(sinks)
+        # the number of paths that start at each node, not counting the node
+        # itself as a sink
+        counts = numpy.zeros(
+            self.num_nodes, dtype=(object if max_count == None else int))
+        # the number of paths that start at each node, where sinks end a path
+        sink_counts = numpy.zeros_like(counts)
+        for node in self.topological_order[::-1]:
+            counts[node] = sink_counts[self.successors(node)].sum()
+            if max_count != None:
+                counts[node] = min(counts[node], max_count+1)
+            sink_counts[node] = 1 if is_sink[node] else counts[node]
+        n_paths = counts[numpy.array(list(sources), dtype=int)].sum()
+        if max_count != None:
+            n_paths = min(n_paths, max_count+1)
+        return int(n_paths)
+
+    def _find_reaches_sink(self, is_sink):
+        # whether a path that starts at each node reaches a sink
+        reaches_sink = numpy.zeros(self.num_nodes, dtype=bool)
+        for node in self.topological_order[::-1]:
+            successors = self.successors(node)
+            reaches_sink[node] = ( 
+                is_sink[successors].any() or reaches_sink[successors].any() )
+        return reaches_sink
+
+    def build_path_trie(self, sources, sinks):
+        """Build a PathTrie of the paths that iter_paths yields, in the 
+           same order. 
+
+        Prefixes that do not lead to a sink are not stored.
+        """
+        is_sink = self._build_sinks_mask(sinks)
+        reaches_sink = self._find_reaches_sink(is_sink)
+        trie = PathTrie()
+        for source in reversed(list(sources)):
+            if not reaches_sink[source]: continue
+            # the trie node of every node in the current path, and the
+            # non-sink children that remain to be visited from it
+            stack = [(-1, iter([source,])),]
+            while len(stack) > 0:
+                parent, children = stack[-1]
+                try: node = next(children)
+                except StopIteration:
+                    stack.pop()
+                    continue
+                trie_node = trie.add_node(node, parent)
+                successors = self.successors(node)
+                for child in successors[is_sink[successors]].tolist():
+                    trie.add_path(trie.add_node(child, trie_node))
+                successors = successors[
+                    ~is_sink[successors] & reaches_sink[successors]]
+                stack.append((trie_node, iter(successors[::-1].tolist())))
+        return trie
+
+    def iter_paths(self, sources, sinks):
+        """Iterate over the paths that start at a node in sources, and stop
+           at the first node in sinks that they reach.
+
+        The paths are yielded depth first, starting from the last source,
+        and only complete paths are copied.
+        """
+        is_sink = self._build_sinks_mask(sinks)
+        for source in reversed(list(sources)):
+            path = []
+            # the non-sink children that remain to be visited, for every
+            # node in the path
+            stack = [iter([source,]),]
+            while len(stack) > 0:
+                try: node = next(stack[-1])
+                except StopIteration:
+                    stack.pop()
+                    if len(path) > 0: path.pop()
+                    continue
+                path.append(node)
+                successors = self.successors(node)
+                for child in successors[is_sink[successors]].tolist():
+                    yield path + [child,]
+                stack.append(iter(
+                    successors[~is_sink[successors]][::-1].tolist()))
+        return
+
+def find_connected_components(num_nodes, edges):
+    """Return the connected component of every node, treating the edges as
+       undirected. Components are numbered by their smallest node.
+
+    """
+    # union find, with path halving
+    parents = range(num_nodes)
+    def find_root(node):
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    for node_1, node_2 in edges:
+        root_1, root_2 = find_root(node_1), find_root(node_2)
+        # point the larger root at the smaller, so every root is the
+        # smallest node in its component
+        if root_1 < root_2: parents[root_2] = root_1
+        elif root_2 < root_1: parents[root_1] = root_2
+
+    roots = numpy.array([find_root(node) for node in xrange(num_nodes)],
+                        dtype=int)
+    return numpy.unique(roots, return_inverse=True)[1]
@@ -21,16 +21,96 @@ import os, sys
 import time
 import curses
 import multiprocessing
+import struct
+import select
+import fcntl
+import errno
+
+from collections import defaultdict
 
 import grit
 
 from grit import config
 
-MAX_REFRESH_TIME = 1e-2
+MAX_REFRESH_TIME = 1e-1
 MAX_NCOL = 120
 N_LOG_ROWS = 10
 
-def manage_curses_display(stdscr, msg_queue, msg_queue_lock, nthreads=1):
+# messages are sent to the display process as fixed size records. Writes to a
+# pipe of at most PIPE_BUF (>= 512) bytes are atomic, so the records from
+# different processes never interleave
+RECORD_SIZE = 512
+RECORD_HEADER = struct.Struct("=iBH")
+MAX_RECORD_MSG_LEN = RECORD_SIZE - RECORD_HEADER.size
+LOG_FLAG, DISPLAY_FLAG, CONTINUED_FLAG, CLOSE_FLAG = 1, 2, 4, 8
+
+def build_records(pid, flags, message):
+    """Split message into records. All but the last are flagged CONTINUED.
+
+    """
+    records = []
+    for start in xrange(0, max(len(message), 1), MAX_RECORD_MSG_LEN):
+        chunk = message[start:start+MAX_RECORD_MSG_LEN]
+        chunk_flags = flags
+        if start + MAX_RECORD_MSG_LEN < len(message):
+            chunk_flags |= CONTINUED_FLAG
+        records.append( RECORD_HEADER.pack(pid, chunk_flags, len(chunk)) 
+                        + chunk.ljust(MAX_RECORD_MSG_LEN, '\0') )
+    return records
+
+class MessagesReader( object ):
+    """Reassemble the messages from the records in a pipe.
+
+    """
+    def __init__(self, msgs_fd):
+        self.msgs_fd = msgs_fd
+        self.buffer = ""
+        self.partial_msgs = defaultdict(list)
+    
+    def read(self, timeout=None):
+        """Return the (pid, flags, message)'s that arrive within timeout.
+
+        """
+        if len(select.select([self.msgs_fd,], [], [], timeout)[0]) == 0:
+            return []
+        data = os.read(self.msgs_fd, 64*RECORD_SIZE)
+        # every writer has closed the pipe
+        if data == "": return [(None, CLOSE_FLAG, ""),]
+        self.buffer += data
+
+        msgs = []
+        n_records = len(self.buffer)//RECORD_SIZE
+        for i in xrange(n_records):
+            pid, flags, msg_len = RECORD_HEADER.unpack_from(
+                self.buffer, i*RECORD_SIZE)
+            msg_start = i*RECORD_SIZE + RECORD_HEADER.size
+            self.partial_msgs[pid].append(
+                self.buffer[msg_start:msg_start+msg_len])
+            if flags & CONTINUED_FLAG: continue
+            msgs.append((pid, flags, "".join(self.partial_msgs.pop(pid))))
+        self.buffer = self.buffer[n_records*RECORD_SIZE:]
+        return msgs
+
+def write_to_log(log_ofstream, msg):
+    if log_ofstream != None:
+        log_ofstream.write(msg.strip() + "\n")
+
+def manage_stderr_display(msgs_fd, log_ofstream):
+    msgs = MessagesReader(msgs_fd)
+    while True:
+        for pid, flags, msg in msgs.read():
+            if flags & CLOSE_FLAG: 
+                if log_ofstream != None: log_ofstream.flush()
+                return
+            if flags & LOG_FLAG:
+                write_to_log(log_ofstream, msg)
+            if flags & DISPLAY_FLAG:
+                sys.stderr.write(msg.strip() + "\n")
+        if log_ofstream != None: log_ofstream.flush()
+    
+    return
+
+def manage_curses_display(stdscr, msgs_fd, log_ofstream, main_pid, nthreads=1):
     curses.curs_set(0)
     base_pad = curses.newpad(1000, 500)
     base_pad.timeout(0)
@@ -53,124 +133,128 @@ def manage_curses_display(stdscr, msg_queue, msg_queue_lock, nthreads=1):
 
     header.addstr(0, 0, "GRIT (version %s)" % grit.__version__ )
     
+    # the main process always displays in the first row, and the other 
+    # processes take the first row that isnt used by a running process
+    pid_to_index_mapping = { main_pid: 0 }
+    def find_thread_index(pid):
+        if pid in pid_to_index_mapping: 
+            return pid_to_index_mapping[pid]
+        for old_pid in pid_to_index_mapping.keys():
+            if old_pid != main_pid and not os.path.exists("/proc/%i"%old_pid):
+                del pid_to_index_mapping[old_pid]
+        used_indices = set(pid_to_index_mapping.values())
+        for index in xrange(1, nthreads+1):
+            if index not in used_indices:
+                pid_to_index_mapping[pid] = index
+                return index
+        return None
+    
+    msgs = MessagesReader(msgs_fd)
+    last_refresh_time = 0
     while True:
-        start_time = time.time()
-        while True:
-            # make sure that we refresh at least every 10 messages
-            counter = 0
+        for pid, flags, msg in msgs.read(MAX_REFRESH_TIME):
+            # if the message is CLOSE, then we are done so exit the thread
+            if flags & CLOSE_FLAG:
+                if log_ofstream != None: log_ofstream.flush()
+                return
             
-            # make sure that we refresh every one in a while
-            if start_time - time.time() > MAX_REFRESH_TIME:
-                break
-
-            # try to acquire a message. If none exists, brak
-            # to refresh and sleep
-            try:
-                thread_index, do_log, msg = msg_queue.pop()
-            except IndexError, inst:
-                break
-            except IOError, inst:
-                break
+            if flags & LOG_FLAG:
+                write_to_log(log_ofstream, msg)
+            if not flags & DISPLAY_FLAG: continue
             
-            # if the message is BREAK, then we are done so exit the thread
-            if msg == 'BREAK': 
-                return
-
-            if do_log:
+            thread_index = find_thread_index(pid)
+            if thread_index == None: continue
+            
+            if flags & LOG_FLAG:
                 log.insertln()
                 log.insstr( msg )
             
             # truncate the message so that it doesnt extend past 80 charcters
             msg = msg[:MAX_NCOL-11]
-            if thread_index != None:
-                line = ("Thread %i:" % (thread_index)).ljust(11) \
-                    + msg.ljust(MAX_NCOL-11)
-                thread_data_windows[thread_index].erase()
-                thread_data_windows[thread_index].insstr(0, 0, line )
-            
-            counter += 1
-            if counter >= 10: break
+            line = ("Thread %i:" % (thread_index)).ljust(11) \
+                + msg.ljust(MAX_NCOL-11)
+            thread_data_windows[thread_index].erase()
+            thread_data_windows[thread_index].insstr(0, 0, line )
         
+        # rate limit the display and log file updates
+        if time.time() - last_refresh_time < MAX_REFRESH_TIME: continue
+        last_refresh_time = time.time()
+        if log_ofstream != None: log_ofstream.flush()
         nrow, ncol = stdscr.getmaxyx()
-        try:
-            base_pad.refresh(0, 0, 0, 0, max(nrow-1,0), max(ncol-1,0))
-        except:
-            raise
+        base_pad.refresh(0, 0, 0, 0, max(nrow-1,0), max(ncol-1,0))
     
     return
 
-class Logger( object ):
-    def _init_ncurses_manager(self):
-        self.manager = multiprocessing.Manager()
-        self.msgs_lock = multiprocessing.Lock()
-        self.msgs = self.manager.list()
-        p = multiprocessing.Process( target=curses.wrapper, 
-                     args=(manage_curses_display, 
-                           self.msgs, self.msgs_lock, self.nthreads) )
-        p.start()
-        self.curses_p = p
-        self.main_pid = os.getpid()
-
-        self.pid_to_index_mapping = self.manager.list()
-        self.pid_to_index_mapping.append( self.main_pid )
-        for loop in xrange(self.nthreads):
-            self.pid_to_index_mapping.append( None )
+def run_display_process(msgs_fd, unused_fd, log_ofstream, 
+                        use_ncurses, main_pid, nthreads):
+    # close the write end, so that the pipe is closed once every writer exits
+    os.close(unused_fd)
+    if use_ncurses:
+        curses.wrapper(manage_curses_display, 
+                       msgs_fd, log_ofstream, main_pid, nthreads)
+    else:
+        manage_stderr_display(msgs_fd, log_ofstream)
+    return
 
+class Logger( object ):
+    """Send log and display messages to a separate display process.
 
+    Every process that inherits the logger writes its messages into a shared
+    pipe as fixed size records. Display only messages are dropped when the 
+    pipe is full, so logging never blocks on the display.
+    """
     def __init__(self, nthreads, use_ncurses=False, log_ofstream=None):
         self.use_ncurses = use_ncurses
         self.nthreads = nthreads
         self.log_ofstream = log_ofstream
+        self.main_pid = os.getpid()
         
-        if self.use_ncurses:
-            self._init_ncurses_manager()
+        read_fd, self.msgs_fd = os.pipe()
+        fcntl.fcntl(self.msgs_fd, fcntl.F_SETFL, 
+                    fcntl.fcntl(self.msgs_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.display_p = multiprocessing.Process( 
+            target=run_display_process,
+            args=(read_fd, self.msgs_fd, log_ofstream, 
+                  use_ncurses, self.main_pid, nthreads) )
+        self.display_p.start()
+        os.close(read_fd)
         
         return
     
+    def _write_record(self, record, block):
+        while True:
+            try: 
+                os.write(self.msgs_fd, record)
+                return True
+            except OSError, inst:
+                if inst.errno != errno.EAGAIN: raise
+                if not block: return False
+                select.select([], [self.msgs_fd,], [])
+    
     def __call__( self, message, display=True, log=False ):
         message = str(message)
-        if not self.use_ncurses:
-            if log or (config.DEBUG_VERBOSE and message.strip() != ''): 
-                self.log_ofstream.write(message.strip() + "\n" )
-                self.log_ofstream.flush()
-                sys.stderr.write(message.strip() + "\n" )
-            return
-
         # if the message is empty, always display and never log
         if message == "": 
             display = True
             log = False
-        # if we want to log this, and we have an output stream, write this
-        # to the log
-        if (log or config.DEBUG_VERBOSE) and self.log_ofstream != None:
-            self.log_ofstream.write(message.strip() + "\n" )
-            self.log_ofstream.flush()
-        
-        # if we're not using ncurses, then write the message to standard err
-        if display and not self.use_ncurses:
-            sys.stderr.write(message.strip() + "\n" )
+        log = (log or config.DEBUG_VERBOSE) and message.strip() != ''
+        # if we're not using ncurses, then only the logged messages are 
+        # written to standard error
+        if not self.use_ncurses:
+            display = log
+        if not (display or log): return
         
-        # if we are using ncurses, and this is a message to display, then add
-        # it to the display queue
-        if display and self.use_ncurses:
-            with self.msgs_lock:
-                try: 
-                    p_index = self.pid_to_index_mapping.index( os.getpid() )
-                except ValueError:
-                    try: 
-                        p_index = min( i for i, pid in enumerate(self.pid_to_index_mapping) 
-                                       if pid == None or not os.path.exists("/proc/%i"%pid))
-                        self.pid_to_index_mapping[p_index] = os.getpid()
-                    except:
-                        #raise
-                        return
-
-                # only log message from main
-                self.msgs.append( (p_index, log, message) )
+        # messages that are only displayed fit in one record, so that they
+        # can be dropped without splitting them
+        if not log: message = message[:MAX_RECORD_MSG_LEN]
+        flags = (LOG_FLAG if log else 0) | (DISPLAY_FLAG if display else 0)
+        for record in build_records(os.getpid(), flags, message):
+            self._write_record(record, block=log)
         
-        time.sleep(1e-2)
+        return
     
     def close(self):
-        if self.use_ncurses:
-            self.msgs.append( (None, False, 'BREAK') )
-            self.curses_p.join()
+        if os.getpid() != self.main_pid: return
+        for record in build_records(os.getpid(), CLOSE_FLAG, ""):
+            self._write_record(record, block=True)
+        self.display_p.join()
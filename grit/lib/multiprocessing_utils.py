@@ -22,7 +22,10 @@ import sys
 import time
 import signal
 import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 import traceback
+import tempfile
+import cPickle as pickle
 
 from grit import config
 
@@ -151,3 +154,207 @@ def run_in_parallel(n_proc, target, all_args):
         return
 
     fork_and_wait(n_proc, worker)
+
+class WorkStealingScheduler(object):
+    """Distribute a fixed set of items over forked workers.
+
+    Every worker owns a deque of item indices, pre-seeded so that the
+    estimated cost is balanced (largest items first). A worker pops from
+    the head of its own deque and, when that runs dry, steals from the
+    tail of the deque with the most remaining items. Items are never added
+    after construction, so a worker is finished as soon as it fails to
+    find an item in every deque - no polling is needed.
+
+    The items themselves are never pickled: workers are forked after the
+    scheduler is built, and only indices live in shared memory.
+    """
+    def __init__(self, items, costs=None, n_workers=None):
+        if n_workers == None: n_workers = config.NTHREADS
+        if costs == None: costs = [1]*len(items)
+        assert len(costs) == len(items)
+        self.items = items
+        self.n_workers = max(1, n_workers)
+
+        # assign items to workers greedily, from most to least expensive
+        deques = [[] for i in xrange(self.n_workers)]
+        loads = [0.0]*self.n_workers
+        for index in sorted(xrange(len(items)), 
+                            key=lambda i: costs[i], reverse=True):
+            worker_i = min(xrange(self.n_workers), key=loads.__getitem__)
+            deques[worker_i].append(index)
+            loads[worker_i] += costs[index]
+
+        # pack the deques into a single shared array. Deque i occupies the
+        # slice [heads[i], tails[i]) of indices
+        self._indices = RawArray('l', sum(deques, []))
+        self._heads = RawArray('l', self.n_workers)
+        self._tails = RawArray('l', self.n_workers)
+        offset = 0
+        for worker_i, deque in enumerate(deques):
+            self._heads[worker_i] = offset
+            offset += len(deque)
+            self._tails[worker_i] = offset
+        self._locks = [multiprocessing.Lock() for i in xrange(self.n_workers)]
+
+    def __len__(self):
+        return sum(self._tails[i] - self._heads[i] 
+                   for i in xrange(self.n_workers))
+    
+    def _pop_head(self, worker_i):
+        with self._locks[worker_i]:
+            if self._heads[worker_i] == self._tails[worker_i]: return None
+            index = self._indices[self._heads[worker_i]]
+            self._heads[worker_i] += 1
+        return index
+
+    def _pop_tail(self, worker_i):
+        with self._locks[worker_i]:
+            if self._heads[worker_i] == self._tails[worker_i]: return None
+            self._tails[worker_i] -= 1
+            index = self._indices[self._tails[worker_i]]
+        return index
+
+    def pop(self, worker_i):
+        """Return the index of the next item for worker_i, or None if done.
+
+        """
+        index = self._pop_head(worker_i)
+        if index != None: return index
+        # steal from the fullest deque. The sizes are read without taking 
+        # the locks, so they are only used to order the victims
+        victims = sorted(
+            (i for i in xrange(self.n_workers) if i != worker_i),
+            key=lambda i: self._tails[i] - self._heads[i], reverse=True)
+        for victim_i in victims:
+            index = self._pop_tail(victim_i)
+            if index != None: return index
+        return None
+
+    def iter_items(self, worker_i):
+        while True:
+            index = self.pop(worker_i)
+            if index == None: return
+            yield self.items[index]
+
+    def run(self, target, args=[]):
+        """Fork self.n_workers processes and run target(items, *args) in each.
+
+        items iterates over the items scheduled for the calling worker.
+        """
+        worker_ids = Counter()
+        def worker():
+            worker_i = worker_ids.return_and_increment()
+            target(self.iter_items(worker_i), *args)
+        fork_and_wait(self.n_workers, worker)
+
+class CoreBudgetScheduler(object):
+    """Run a graph of jobs in forked processes that share a core budget.
+
+    A job is started as soon as all of its dependencies have finished, and 
+    runs with config.NTHREADS set to its share of the free cores. At most 
+    max_n_running_jobs jobs run at once, and ready jobs with a higher 
+    priority are started first. The return value of each job is pickled 
+    back to the parent. If only one job can run at a time, then the jobs 
+    are run in this process with the full budget.
+    """
+    def __init__(self, n_cores=None, max_n_running_jobs=1):
+        if n_cores == None: n_cores = config.NTHREADS
+        self.n_cores = max(1, n_cores)
+        self.max_n_running_jobs = max(1, min(max_n_running_jobs, self.n_cores))
+        self._jobs = []
+        self._job_ids = set()
+    
+    def add_job(self, job_id, target, args=[], dependencies=[], priority=0):
+        assert job_id not in self._job_ids, \
+            "Job '%s' already exists" % (job_id,)
+        assert all(x in self._job_ids for x in dependencies), \
+            "The dependencies of '%s' must be added first" % (job_id,)
+        self._jobs.append((job_id, target, args, list(dependencies), priority))
+        self._job_ids.add(job_id)
+    
+    def _ready_jobs(self, pending, results):
+        ready = [ job for job in pending 
+                  if all(x in results for x in job[3]) ]
+        # sort is stable, so jobs with equal priority run in insertion order
+        ready.sort(key=lambda job: job[4], reverse=True)
+        return ready
+    
+    def _start_job(self, (job_id, target, args, dependencies, priority),
+                   n_cores):
+        res_fd, res_fname = tempfile.mkstemp(
+            prefix="job_result.", dir=config.tmp_dir)
+        os.close(res_fd)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                signal.signal(signal.SIGINT, handle_interrupt_signal)
+                config.NTHREADS = n_cores
+                rv = target(*args)
+                with open(res_fname, "wb") as ofp:
+                    pickle.dump(rv, ofp, pickle.HIGHEST_PROTOCOL)
+                os._exit(os.EX_OK)
+            except Exception, inst:
+                config.log_statement( "Uncaught exception in job '%s'\n" 
+                                      % (job_id,) + traceback.format_exc(), 
+                                      log=True)
+                os._exit(os.EX_SOFTWARE)
+        config.log_statement( "Started '%s' with %i threads" % (
+                job_id, n_cores), log=True )
+        return pid, res_fname
+
+    def run(self):
+        """Run every job, and return a dict of their return values.
+
+        """
+        results = {}
+        pending = list(self._jobs)
+        if self.max_n_running_jobs == 1:
+            while len(pending) > 0:
+                job = self._ready_jobs(pending, results)[0]
+                pending.remove(job)
+                job_id, target, args, dependencies, priority = job
+                results[job_id] = target(*args)
+            return results
+        
+        running = {}
+        n_free_cores = self.n_cores
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                ready = self._ready_jobs(pending, results)
+                n_slots = min(len(ready), 
+                              self.max_n_running_jobs - len(running))
+                # split the free cores between the jobs that we can start now
+                for job in ready[:n_slots]:
+                    if n_free_cores == 0: break
+                    n_cores = max(1, n_free_cores/n_slots)
+                    pid, res_fname = self._start_job(job, n_cores)
+                    running[pid] = (job[0], n_cores, res_fname)
+                    pending.remove(job)
+                    n_free_cores -= n_cores
+                    n_slots -= 1
+                
+                if len(running) == 0:
+                    raise ValueError, "Can not satisfy the job dependencies"
+                
+                ret_pid, status = os.wait()
+                # ignore processes that weren't started by this scheduler
+                if ret_pid not in running: continue
+                job_id, n_cores, res_fname = running.pop(ret_pid)
+                n_free_cores += n_cores
+                if os.WIFSIGNALED(status):
+                    raise OSError, "Job '{}' was killed by signal '{}'".format(
+                        job_id, os.WTERMSIG(status))
+                if os.WEXITSTATUS(status) != os.EX_OK: 
+                    raise OSError, "Job '{}' returned error code '{}'".format(
+                        job_id, os.WEXITSTATUS(status)) 
+                with open(res_fname, "rb") as fp:
+                    results[job_id] = pickle.load(fp)
+                os.remove(res_fname)
+                config.log_statement("Finished '%s'" % (job_id,), log=True)
+        except (KeyboardInterrupt, OSError):
+            for pid in running:
+                try: os.kill(pid, signal.SIGHUP)
+                except: pass
+            raise
+        
+        return results
@@ -0,0 +1,180 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import json
+import resource
+from collections import defaultdict
+
+# the file descriptor of the metrics file. Every process that is forked after
+# the file is opened appends its records to it
+METRICS_FD = None
+
+# counters that are incremented by the stages, and reported as the change
+# in their value over a stage (e.g. the number of reads fetched)
+COUNTERS = defaultdict(int)
+
+# the sample and replicate that the stages are being run for. These are set
+# at the start of every sample job, and inherited by its forked workers
+SAMPLE_TYPE = None
+REP_ID = None
+
+# the record fields that aren't sizes or counters
+RECORD_FIELDS = ('stage', 'sample', 'rep', 'gene', 'region', 'pid', 
+                 'wall_time', 'cpu_time', 'process_peak_rss_mb', 'failed')
+
+def open_metrics_file(fname):
+    global METRICS_FD
+    METRICS_FD = os.open(fname, os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0644)
+    return
+
+def close_metrics_file():
+    global METRICS_FD
+    if METRICS_FD != None:
+        os.close(METRICS_FD)
+    METRICS_FD = None
+    return
+
+def set_sample(sample_type, rep_id=None):
+    global SAMPLE_TYPE, REP_ID
+    SAMPLE_TYPE = sample_type
+    REP_ID = rep_id
+    return
+
+def add_to_counter(name, value):
+    if METRICS_FD != None:
+        COUNTERS[name] += value
+    return
+
+def calc_cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+def calc_process_peak_rss_mb():
+    # ru_maxrss is in KB on linux. It is the peak over the process's lifetime
+    # (including the parent's memory at fork), not over the stage
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+class StageMetrics(object):
+    """Measure the wall time, CPU time, and counters of a stage.
+
+    Used as a context manager, this appends a JSON record to the metrics
+    file when the stage exits, and does nothing if the file isn't open.
+    Stages are run either for a gene, or for a genomic region (e.g. in the 
+    element discovery stages, before there are genes). The record also 
+    stores the process's peak RSS so far. set_sizes adds size data (e.g. 
+    the number of transcripts) to the record.
+    """
+    def __init__(self, stage, gene=None, region=None, **sizes):
+        self.stage = stage
+        self.gene = gene
+        self.region = region
+        self.sizes = sizes
+
+    def set_sizes(self, **sizes):
+        self.sizes.update(sizes)
+
+    def __enter__(self):
+        if METRICS_FD == None: return self
+        self.start_counters = dict(COUNTERS)
+        self.start_cpu_time = calc_cpu_time()
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if METRICS_FD == None: return False
+        record = {
+            'stage': self.stage,
+            'sample': SAMPLE_TYPE,
+            'rep': REP_ID,
+            'gene': self.gene,
+            'region': self.region,
+            'pid': os.getpid(),
+            'wall_time': time.time() - self.start_time,
+            'cpu_time': calc_cpu_time() - self.start_cpu_time,
+            'process_peak_rss_mb': calc_process_peak_rss_mb(),
+            'failed': exc_type != None
+        }
+        for key, value in COUNTERS.iteritems():
+            record[key] = value - self.start_counters.get(key, 0)
+        record.update(self.sizes)
+        # appends of a single write don't interleave with other processes
+        os.write(METRICS_FD, json.dumps(record, sort_keys=True) + "\n")
+        return False
+
+def load_metrics(fname):
+    with open(fname) as fp:
+        return [ json.loads(line) for line in fp if line.strip() != '' ]
+
+def find_slowest(metrics, key, num):
+    """Return the num genes (or regions, if key is 'region') with the 
+    largest total wall time. 
+
+    The genes are grouped by their sample and replicate, so each is returned
+    as ((sample, rep, gene), total wall time, the time in each stage, the 
+    largest value of each size and counter).
+    """
+    totals = defaultdict(float)
+    stage_times = defaultdict(lambda: defaultdict(float))
+    sizes = defaultdict(dict)
+    for record in metrics:
+        if record.get(key) == None: continue
+        group = (record.get('sample'), record.get('rep'), record[key])
+        totals[group] += record['wall_time']
+        stage_times[group][record['stage']] += record['wall_time']
+        for name, value in record.iteritems():
+            if name in RECORD_FIELDS: continue
+            if not isinstance(value, (int, long, float)): continue
+            sizes[group][name] = max(sizes[group].get(name, 0), value)
+
+    slowest = sorted(totals.iteritems(), key=lambda x: -x[1])[:num]
+    return [ (group, wall_time, dict(stage_times[group]), sizes[group])
+             for group, wall_time in slowest ]
+
+def find_slowest_genes(metrics, num_genes):
+    return find_slowest(metrics, 'gene', num_genes)
+
+def find_slowest_regions(metrics, num_regions):
+    return find_slowest(metrics, 'region', num_regions)
+
+def write_slowest(ofp, key, slowest):
+    ofp.write("\t".join(("sample".ljust(12), "rep".ljust(8), key.ljust(30), 
+                         "wall_time", "stage_times", "sizes")) + "\n")
+    for (sample, rep, name), wall_time, stage_times, sizes in slowest:
+        ofp.write("\t".join((
+            str(sample).ljust(12),
+            str(rep).ljust(8),
+            name.ljust(30),
+            "%.2f" % wall_time,
+            ",".join("%s:%.2f" % x for x in sorted(stage_times.iteritems())),
+            ",".join("%s:%s" % x for x in sorted(sizes.iteritems()))
+        )) + "\n")
+    return
+
+def write_slowest_genes(metrics_fname, ofp, num_genes):
+    """Write the num_genes slowest genes, and then the num_genes slowest 
+    element discovery regions, to ofp.
+
+    """
+    metrics = load_metrics(metrics_fname)
+    write_slowest(ofp, "gene", find_slowest_genes(metrics, num_genes))
+    ofp.write("\n")
+    write_slowest(ofp, "region", find_slowest_regions(metrics, num_genes))
+    return
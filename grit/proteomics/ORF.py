@@ -25,7 +25,7 @@ import multiprocessing
 import Queue
 import time
 import numpy
-import re
+import string
 
 from collections import defaultdict, namedtuple
 from itertools import izip
@@ -56,8 +56,26 @@ GENCODE = {
     'TAC':'Y', 'TAT':'Y', 'TAA':'_', 'TAG':'_',
     'TGC':'C', 'TGT':'C', 'TGA':'_', 'TGG':'W'}
 
-COMP_BASES = { 'A':'T', 'T':'A', 'C':'G', 'G':'C',
-               'a':'t', 't':'a', 'c':'g', 'g':'c' }
+COMP_BASES_TABLE = string.maketrans( 'ATCGatcg', 'TAGCtagc' )
+
+# the index of every base in a codon id. Bases that aren't ACGT get index 4
+BASE_INDICES = 4*numpy.ones(256, dtype=int)
+for i, base in enumerate('ACGT'):
+    BASE_INDICES[ord(base)] = i
+
+def calc_codon_id( codon ):
+    return 25*BASE_INDICES[ord(codon[0])] \
+        + 5*BASE_INDICES[ord(codon[1])] + BASE_INDICES[ord(codon[2])]
+
+# the amino acid of every codon id, or 0 if the codon has an unknown base
+AA_TABLE = numpy.zeros(125, dtype=numpy.uint8)
+for codon, AA in GENCODE.iteritems():
+    AA_TABLE[calc_codon_id(codon)] = ord(AA)
+
+START_CODON_ID = calc_codon_id( 'ATG' )
+IS_STOP_CODON = numpy.zeros(125, dtype=bool)
+for codon in ( 'TAG', 'TAA', 'TGA' ):
+    IS_STOP_CODON[calc_codon_id(codon)] = True
 
 # Variables effecting .annotation.gtf output
 ONLY_USE_LONGEST_ORF = False
@@ -81,18 +99,9 @@ from ..files.fasta import iter_x_char_lines
 def reverse_complement( seq ):
     """Emulate Biopython reverse_complement method, but faster
     """
-    rev_comp_seq = ''
-    # loop through sequence in reverse sequence
-    for base in seq[::-1]:
-        if base in COMP_BASES:
-            # else add the compelemntary base
-            rev_comp_seq += COMP_BASES[ base ]
-        else:
-            assert base in "nN"
-            # if the base is invalid just add it to the rev_comp
-            rev_comp_seq += base
-    
-    return rev_comp_seq
+    # the only bases that can't be complemented are N's
+    assert seq.translate( None, 'ATCGatcgnN' ) == ''
+    return seq.translate( COMP_BASES_TABLE )[::-1]
 
 def get_gene_seq( fasta, chrm, strand, gene_start, gene_stop ):
     if not chrm.startswith( 'chr' ):
@@ -150,59 +159,53 @@ def convert_to_genomic( pos, exons ):
     
     return exons[i][0] + (pos - rna_pos)
 
-def find_all( sequence, codon ):
-    """ Returns a list of positions within sequence that are 'codon'
+def calc_codon_ids( sequence ):
+    """ Returns the id of the codon that starts at every position of sequence
     """
-    return [ x.start() for x in re.finditer( codon, sequence ) ]
+    if len( sequence ) < 3: 
+        return numpy.zeros(0, dtype=int)
+    bases = BASE_INDICES[ numpy.frombuffer(sequence, dtype=numpy.uint8) ]
+    return 25*bases[:-2] + 5*bases[1:-1] + bases[2:]
 
-def find_orfs( sequence ):
+def translate_codons( codon_ids ):
+    """ Returns the amino acid sequence of an array of codon ids
+    """
+    AA_seq = AA_TABLE[ codon_ids ]
+    if not AA_seq.all():
+        # raise the same error as a GENCODE lookup of the unknown codon
+        codon_id = codon_ids[ AA_seq.argmin() ]
+        raise KeyError, "".join( 
+            'ACGTN'[x] for x in (codon_id//25, (codon_id//5)%5, codon_id%5) )
+    return AA_seq.tostring()
+
+def find_orfs( sequence, codon_ids=None ):
     """ Finds all valid open reading frames in the string 'sequence', and
     returns them as tuple of start and stop coordinates
     """    
-    def grp_by_frame( locs ):
-        locs_by_frame = { 0: [], 1:[], 2:[] }
-        for loc in locs:
-            locs_by_frame[ loc%3 ].append( loc )
-        for frame in locs_by_frame.keys():
-            locs_by_frame[ frame ].reverse()
-        return locs_by_frame
-
-    def find_orfs_in_frame( starts, stops ):
-        prev_stop = -1
-        while len( starts ) > 0 and len( stops ) > 0:
-            start = starts.pop()
-            if start < prev_stop: continue
-            stop = stops.pop()
-            while stop < start and len( stops ) > 0:
-                stop = stops.pop()
-            if start > stop:
-                assert len( stops ) == 0
-                break
-            if (stop - start + 1) >= (MIN_AAS_PER_ORF * 3):
-                yield ( start, stop-1 )
-            prev_stop = stop
-
-        return
-
-    # find all start and stop codon positions along sequence
-    starts = find_all( sequence, 'ATG' )
-
-    stop_amber = find_all( sequence, 'TAG' )
-    stop_ochre = find_all( sequence, 'TAA' )
-    stop_umber = find_all( sequence, 'TGA' )
-    stops = stop_amber + stop_ochre + stop_umber
-    stops.sort()
+    if codon_ids is None:
+        codon_ids = calc_codon_ids( sequence )
+    # key every codon by its frame and then its position, so that the next 
+    # stop codon in a start codon's frame can be found with a binary search
+    seq_len = len( codon_ids )
+    positions = numpy.arange( seq_len )
+    keys = (positions%3)*seq_len + positions
+    starts = numpy.sort( keys[codon_ids == START_CODON_ID] )
+    stops = numpy.sort( keys[IS_STOP_CODON[codon_ids]] )
     
-    orfs = []    
-    starts_by_frame = grp_by_frame( starts )
-    stops_by_frame = grp_by_frame( stops )
+    # find the next stop codon in each start codon's frame
+    next_stops = stops.searchsorted( starts )
+    has_stop = ( next_stops < len(stops) )
+    starts, next_stops = starts[has_stop], next_stops[has_stop]
+    in_frame = ( stops[next_stops]//seq_len == starts//seq_len )
+    starts, next_stops = starts[in_frame], next_stops[in_frame]
     
-    for frame in (0, 1, 2):
-        starts = starts_by_frame[ frame ]
-        stops = stops_by_frame[ frame ]
-        orfs.extend( find_orfs_in_frame(starts, stops) )
+    # the orf that ends at each stop codon begins at the first start codon 
+    next_stops, first_starts = numpy.unique( next_stops, return_index=True )
+    starts = starts[first_starts] % seq_len
+    stops = stops[next_stops] % seq_len
     
-    return orfs
+    is_long = ( (stops - starts + 1) >= (MIN_AAS_PER_ORF * 3) )
+    return zip( starts[is_long].tolist(), (stops[is_long]-1).tolist() )
 
 def find_cds_for_gene( gene, fasta, only_longest_orf ):
     """Find all of the unique open reading frames in a gene
@@ -213,7 +216,8 @@ def find_cds_for_gene( gene, fasta, only_longest_orf ):
     
     for trans in gene.transcripts:
         trans_seq = get_trans_seq( gene, gene_seq, trans )
-        orfs = find_orfs( trans_seq )
+        codon_ids = calc_codon_ids( trans_seq )
+        orfs = find_orfs( trans_seq, codon_ids )
         if len( orfs ) == 0:
             annotated_transcripts.append( trans )
             continue
@@ -228,9 +232,9 @@ def find_cds_for_gene( gene, fasta, only_longest_orf ):
             filtered_orfs = orfs
         
         for orf_id, (start, stop) in enumerate( filtered_orfs ):
-            ORF = trans_seq[start:stop+1]
-            AA_seq= "".join( GENCODE[ORF[3*i:3*(i+1)]] 
-                             for i in xrange(len(ORF)/3) )
+            num_codons = (stop - start + 1)/3
+            AA_seq = translate_codons( 
+                codon_ids[start:start+3*num_codons:3] )
             
             if INCLUDE_STOP_CODON:
                 stop += 3
@@ -24,8 +24,10 @@ import numpy
 import pickle
 import pysam
 import math
+import shutil
 from random import random
 from collections import defaultdict
+from itertools import izip
 import tempfile
 
 DEFAULT_QUALITY_SCORE = 'r'
@@ -34,6 +36,7 @@ DEFAULT_FRAG_LENGTH = 150
 DEFAULT_READ_LENGTH = 100
 DEFAULT_NUM_FRAGS = 100
 NUM_NORM_SDS = 4
+MAX_NUM_FL_RESAMPLES = 1000
 FREQ_GTF_STRINGS = [ 'freq', 'frac' ]
 
 # add slide dir to sys.path and import frag_len mod
@@ -42,6 +45,7 @@ sys.path.insert(0, "/home/nboley/grit/grit/")
 import grit.frag_len as frag_len
 from grit.files.gtf import load_gtf
 from grit.files.reads import clean_chr_name
+from grit.lib.multiprocessing_utils import WorkStealingScheduler
 
 def fix_chr_name(x):
     return "chr" + clean_chr_name(x)
@@ -190,6 +194,69 @@ def write_fastq_lines( fp1, fp2, transcript, read_len, frag_len, offset,
     """
     pass
 
+def calc_scale_factor( t, fl_dist, assay ):
+    """Scale a transcript's frequency to its expected relative number of 
+       fragments.
+
+    """
+    if assay in ('RNAseq',):
+        length = t.calc_length()
+        if length < fl_dist.fl_min: return 0
+        fl_min, fl_max = fl_dist.fl_min, min(length, fl_dist.fl_max)
+        allowed_fl_lens = numpy.arange(fl_min, fl_max+1)
+        weights = fl_dist.fl_density[
+            fl_min-fl_dist.fl_min:fl_max-fl_dist.fl_min+1]
+        mean_fl_len = float((allowed_fl_lens*weights).sum())
+        return length - mean_fl_len
+    elif assay in ('CAGE', 'RAMPAGE', 'PASseq'):
+        return 1.0
+
+def load_transcripts_and_weights( genes, fl_dist, fasta, assay ):
+    """Load the transcripts' sequences, and calculate the probability that a
+       fragment is drawn from each transcript, and the contig lengths.
+
+    """
+    transcript_weights = []
+    transcripts = []
+    
+    contig_lens = defaultdict(int)
+    
+    for gene in genes:
+        contig_lens[fix_chr_name(gene.chrm)] = max(
+            gene.stop+1000, contig_lens[fix_chr_name(gene.chrm)])
+        for transcript in gene.transcripts:
+            if fasta != None:
+                transcript.seq = get_transcript_sequence(transcript, fasta)
+            else:
+                transcript.seq = None
+            if transcript.fpkm != None:
+                weight = transcript.fpkm*calc_scale_factor(
+                    transcript, fl_dist, assay)
+            elif transcript.frac != None:
+                assert len(genes) == 1
+                weight = transcript.frac
+            else: 
+                weight = 1./len(gene.transcripts)
+                #assert False, "Transcript has neither an FPKM nor a frac"
+            transcripts.append( transcript )
+            transcript_weights.append( weight )
+    
+    #assert False
+    assert len( transcripts ) > 0, "No valid trancripts."
+
+    # normalize the transcript weights to be on 0,1
+    transcript_weights = numpy.array(transcript_weights, dtype=float)
+    transcript_weights = transcript_weights/transcript_weights.sum()
+
+    # update the contig lens from the fasta file, if available 
+    if fasta != None:
+        for name, length in zip(fasta.references, fasta.lengths):
+            if fix_chr_name(name) in contig_lens:
+                contig_lens[fix_chr_name(name)] = max(
+                    length, contig_lens[name])
+    
+    return transcripts, transcript_weights, contig_lens
+
 def simulate_reads( genes, fl_dist, fasta, quals, num_frags, single_end, 
                     full_fragment, read_len, assay='RNAseq'):
     """write a SAM format file with the specified options
@@ -304,66 +371,10 @@ def simulate_reads( genes, fl_dist, fasta, quals, num_frags, single_end,
         
         return sam_lines
     
-    def get_fl_min():
-        if isinstance( fl_dist, int ):
-            return fl_dist
-        else:
-            return fl_dist.fl_min
-    
-    def calc_scale_factor(t):
-        if assay in ('RNAseq',):
-            length = t.calc_length()
-            if length < fl_dist.fl_min: return 0
-            fl_min, fl_max = fl_dist.fl_min, min(length, fl_dist.fl_max)
-            allowed_fl_lens = numpy.arange(fl_min, fl_max+1)
-            weights = fl_dist.fl_density[
-                fl_min-fl_dist.fl_min:fl_max-fl_dist.fl_min+1]
-            mean_fl_len = float((allowed_fl_lens*weights).sum())
-            return length - mean_fl_len
-        elif assay in ('CAGE', 'RAMPAGE', 'PASseq'):
-            return 1.0
-    
-    # initialize the transcript objects, and calculate their relative weights
-    transcript_weights = []
-    transcripts = []
-    
-    contig_lens = defaultdict(int)
-    
-    min_transcript_length = get_fl_min()
-    for gene in genes:
-        contig_lens[fix_chr_name(gene.chrm)] = max(
-            gene.stop+1000, contig_lens[fix_chr_name(gene.chrm)])
-        for transcript in gene.transcripts:
-            if fasta != None:
-                transcript.seq = get_transcript_sequence(transcript, fasta)
-            else:
-                transcript.seq = None
-            if transcript.fpkm != None:
-                weight = transcript.fpkm*calc_scale_factor(transcript)
-            elif transcript.frac != None:
-                assert len(genes) == 1
-                weight = transcript.frac
-            else: 
-                weight = 1./len(gene.transcripts)
-                #assert False, "Transcript has neither an FPKM nor a frac"
-            transcripts.append( transcript )
-            transcript_weights.append( weight )
-    
-    #assert False
-    assert len( transcripts ) > 0, "No valid trancripts."
-
-    # normalize the transcript weights to be on 0,1
-    transcript_weights = numpy.array(transcript_weights, dtype=float)
-    transcript_weights = transcript_weights/transcript_weights.sum()
+    transcripts, transcript_weights, contig_lens = \
+        load_transcripts_and_weights( genes, fl_dist, fasta, assay )
     transcript_weights_cumsum = transcript_weights.cumsum()
 
-    # update the contig lens from the fasta file, if available 
-    if fasta != None:
-        for name, length in zip(fasta.references, fasta.lengths):
-            if fix_chr_name(name) in contig_lens:
-                contig_lens[fix_chr_name(name)] = max(
-                    length, contig_lens[name])
-
     # create the output directory
     bam_prefix = assay + ".sorted"
     
@@ -397,7 +408,345 @@ def simulate_reads( genes, fl_dist, fasta, quals, num_frags, single_end,
         os.system( 'samtools index {}.bam'.format( bam_prefix ) )
         
     return
+
+class TranscriptsTable(object):
+    """The flattened exons of a list of transcripts, used to convert 
+       transcript coordinates into genome coordinates and cigar strings in 
+       bulk.
+
+    """
+    def __init__(self, transcripts):
+        self.transcripts = transcripts
+        self.lengths = numpy.array(
+            [t.calc_length() for t in transcripts], dtype=int)
+        
+        exons = numpy.array(
+            [exon for t in transcripts for exon in t.exons], dtype=int)
+        self.exon_starts = exons[:,0]
+        self.exon_stops = exons[:,1]
+        exon_lens = self.exon_stops - self.exon_starts + 1
+        
+        # the exons of transcript i are [exon_offsets[i], exon_offsets[i+1])
+        self.exon_offsets = numpy.zeros(len(transcripts)+1, dtype=int)
+        self.exon_offsets[1:] = numpy.array(
+            [len(t.exons) for t in transcripts]).cumsum()
+        
+        # the exon boundaries, in the concatenated transcripts' coordinates
+        self.exon_cum_stops = exon_lens.cumsum()
+        self.exon_cum_starts = self.exon_cum_stops - exon_lens
+        self.transcript_cum_starts = self.exon_cum_starts[self.exon_offsets[:-1]]
+        
+        # cache the cigar strings of the introns and internal exons between 
+        # two exons, keyed by the exon indices
+        self._internal_cigars = {}
+    
+    def find_exons(self, t_indices, coords):
+        """Return the indices of the exons that contain each transcript 
+           coordinate. Coordinates past the end map to the last exon, to match
+           Transcript.genome_pos.
+
+        """
+        indices = self.exon_cum_stops.searchsorted(
+            self.transcript_cum_starts[t_indices] + coords, side='right')
+        return numpy.minimum(indices, self.exon_offsets[t_indices+1]-1)
+    
+    def genome_pos(self, t_indices, coords):
+        exon_indices = self.find_exons(t_indices, coords)
+        return ( self.exon_starts[exon_indices] 
+                 + self.transcript_cum_starts[t_indices] + coords 
+                 - self.exon_cum_starts[exon_indices] )
+
+    def _build_internal_cigar(self, start_exon, stop_exon):
+        key = (start_exon, stop_exon)
+        try: return self._internal_cigars[key]
+        except KeyError: pass
+        cigar = []
+        for i in xrange(start_exon, stop_exon):
+            cigar.append("%iN" % (
+                    self.exon_starts[i+1]-self.exon_stops[i]-1))
+            if i+1 < stop_exon:
+                cigar.append("%iM" % (
+                        self.exon_stops[i+1]-self.exon_starts[i+1]+1))
+        cigar = "".join(cigar)
+        self._internal_cigars[key] = cigar
+        return cigar
+    
+    def build_cigars(self, t_indices, starts, stops):
+        """Return the cigar strings of the reads that cover the transcript 
+           coordinates [start, stop). This matches get_cigar.
+
+        """
+        start_exons = self.find_exons(t_indices, starts)
+        stop_exons = self.find_exons(t_indices, stops-1)
+        t_cum_starts = self.transcript_cum_starts[t_indices]
+        first_lens = numpy.where(
+            start_exons == stop_exons, stops - starts, 
+            self.exon_cum_stops[start_exons] - t_cum_starts - starts)
+        last_lens = t_cum_starts + stops - self.exon_cum_starts[stop_exons]
         
+        cigars = []
+        for first_len, last_len, start_exon, stop_exon in izip(
+                first_lens, last_lens, start_exons, stop_exons):
+            if start_exon == stop_exon:
+                cigars.append("%iM" % first_len)
+            else:
+                cigars.append("%iM%s%iM" % (
+                        first_len, 
+                        self._build_internal_cigar(start_exon, stop_exon), 
+                        last_len))
+        return cigars
+
+def sample_fragment_lengths( rng, fl_dist, t_lengths, read_len, 
+                             full_fragment, assay ):
+    """Choose a random fragment length from fl_dist for every transcript 
+       length in t_lengths. This matches sample_fragment_length in 
+       simulate_reads.
+
+    """
+    if assay == 'CAGE':
+        return numpy.zeros(len(t_lengths), dtype=int) + read_len
+    
+    # if the fl_dist is constant
+    if isinstance( fl_dist, int ):
+        assert (fl_dist <= t_lengths).all(), 'Transcript which ' + \
+            'cannot contain a valid fragment was included in transcripts.'
+        return numpy.zeros(len(t_lengths), dtype=int) + fl_dist
+
+    # sample all of the fragment lengths, and then resample the invalid ones
+    fls = numpy.zeros(len(t_lengths), dtype=int)
+    to_sample = numpy.arange(len(t_lengths))
+    for i in xrange(MAX_NUM_FL_RESAMPLES):
+        if len(to_sample) == 0: return fls
+        fls[to_sample] = fl_dist.fl_density_cumsum.searchsorted(
+            rng.random_sample(len(to_sample))) - 1 + fl_dist.fl_min
+        is_valid = fls[to_sample] <= t_lengths[to_sample]
+        if not full_fragment:
+            is_valid &= fls[to_sample] >= read_len
+        to_sample = to_sample[~is_valid]
+    
+    raise ValueError, "Could not sample a valid fragment length for a " \
+        + "transcript of length %i" % t_lengths[to_sample[0]]
+
+def sample_read_offsets( rng, t_lengths, t_strands, fls, assay ):
+    """Choose a random read start for every fragment. This matches 
+       sample_read_offset in simulate_reads.
+
+    """
+    # calculate maximum offset
+    max_offsets = t_lengths - fls
+    if assay in ('CAGE', 'RAMPAGE'):
+        return numpy.where(t_strands == '+', 0, max_offsets)
+    elif assay == 'RNAseq':
+        return (rng.random_sample(len(fls))*max_offsets).astype(int)
+    elif assay == 'PASseq':
+        return numpy.where(t_strands == '-', 0, max_offsets)
+
+def sample_qual_strings( rng, quals, read_len, n ):
+    """Return n random quality strings of length read_len. This matches 
+       get_random_qual_score in simulate_reads.
+
+    """
+    # if no quality score were provided
+    if len(quals) == 0:
+        return [DEFAULT_QUALITY_SCORE*read_len,]*n
+    # else concatenate random quality strings from the input quality file, 
+    # enough to cover the read
+    quals = numpy.asarray(quals, dtype=str)
+    min_len = max(1, min(len(qual) for qual in quals))
+    qual_indices = rng.randint(
+        len(quals), size=(n, int(math.ceil(read_len/float(min_len)))))
+    return [ "".join(quals[indices])[:read_len] for indices in qual_indices ]
+
+def cluster_overlapping_transcripts( t_indices, transcripts ):
+    """Group transcripts that overlap, in order of their start. 
+
+    """
+    clusters = []
+    cluster_stop = -1
+    for t_index in sorted(t_indices, key=lambda i: (
+            transcripts[i].start, transcripts[i].stop)):
+        if transcripts[t_index].start > cluster_stop:
+            clusters.append([])
+        clusters[-1].append(t_index)
+        cluster_stop = max(cluster_stop, transcripts[t_index].stop)
+    return clusters
+
+def build_cluster_sam_lines( rng, table, t_indices, frag_counts, 
+                             frag_id_offsets, fl_dist, quals, single_end, 
+                             full_fragment, read_len, assay ):
+    """Simulate the fragments from a cluster of overlapping transcripts, and 
+       return their sam lines sorted by position.
+
+    """
+    transcripts = table.transcripts
+    counts = frag_counts[t_indices]
+    frag_t_indices = numpy.repeat(t_indices, counts)
+    if len(frag_t_indices) == 0: return []
+    # fragment ids are contiguous within a transcript
+    frag_ids = numpy.repeat(frag_id_offsets[t_indices] - counts.cumsum(), counts)
+    frag_ids += numpy.arange(1, len(frag_ids)+1)
+    
+    t_lengths = table.lengths[frag_t_indices]
+    t_strands = numpy.array(
+        [transcripts[i].strand for i in t_indices]).repeat(counts)
+    
+    fls = sample_fragment_lengths(
+        rng, fl_dist, t_lengths, read_len, full_fragment, assay)
+    offsets = sample_read_offsets(rng, t_lengths, t_strands, fls, assay)
+    if not full_fragment:
+        read_lens = numpy.zeros(len(fls), dtype=int) + read_len
+    elif single_end:
+        read_lens = fls
+    else:
+        read_lens = numpy.ceil(fls/2.).astype(int)
+    
+    # the insert size is calculated from the upstream read in both modes
+    up_starts = table.genome_pos(frag_t_indices, offsets)
+    insert_sizes = table.genome_pos(
+        frag_t_indices, offsets+read_lens) - up_starts
+    up_cigars = table.build_cigars(
+        frag_t_indices, offsets, offsets+read_lens)
+    
+    chrm = fix_chr_name(transcripts[t_indices[0]].chrm)
+    def build_seq(t_index, start, stop):
+        seq = transcripts[t_index].seq
+        return '*' if seq == None else seq[start:stop]
+    def build_qual(t_index, qual):
+        return '*' if transcripts[t_index].seq == None else qual
+    
+    lines = []
+    if single_end:
+        flags = numpy.where(t_strands == '+', 16, 0)
+        qual_strs = sample_qual_strings(rng, quals, read_lens.max(), len(fls))
+        for (t_index, frag_id, flag, start, cigar, insert_size, 
+             offset, r_len, qual) in izip(
+                frag_t_indices, frag_ids, flags, up_starts, up_cigars, 
+                insert_sizes, offsets, read_lens, qual_strs):
+            lines.append('\t'.join( (
+                'SIM:%015d:%s' % (frag_id, transcripts[t_index].id), 
+                str(flag), chrm, str(start+1), '255', cigar, "*", '0', 
+                str(insert_size), build_seq(t_index, offset, offset+r_len), 
+                build_qual(t_index, qual[:r_len]), 
+                "NM:i:0", "NH:i:1" ) ) + "\n")
+        order = numpy.lexsort((frag_ids, up_starts))
+        return [lines[i] for i in order]
+    
+    dn_offsets = offsets + fls - read_lens
+    dn_starts = table.genome_pos(frag_t_indices, dn_offsets)
+    dn_cigars = table.build_cigars(frag_t_indices, dn_offsets, offsets+fls)
+    qual_strs = sample_qual_strings(
+        rng, quals, read_lens.max(), 2*len(fls))
+    # read 1 is upstream for fragments from the + strand transcripts, and the
+    # downstream read's qualities are reversed
+    positions = []
+    for (t_index, frag_id, strand, up_start, up_cigar, dn_start, dn_cigar, 
+         insert_size, offset, dn_offset, r_len, fl, qual1, qual2) in izip(
+            frag_t_indices, frag_ids, t_strands, up_starts, up_cigars, 
+            dn_starts, dn_cigars, insert_sizes, offsets, dn_offsets, 
+            read_lens, fls, qual_strs[::2], qual_strs[1::2]):
+        read_identifier = 'SIM:%015d:%s' % (frag_id, transcripts[t_index].id)
+        up_qual, dn_qual = (qual1, qual2) if strand == '+' else (qual2, qual1)
+        up_line = ( str(up_start+1), "255", up_cigar, "=", str(dn_start+1), 
+                    str(insert_size), build_seq(t_index, offset, offset+r_len),
+                    build_qual(t_index, up_qual[:r_len]), "NM:i:0", "NH:i:1" )
+        dn_line = ( str(dn_start+1), "255", dn_cigar, "=", str(up_start+1), 
+                    str(-insert_size), 
+                    build_seq(t_index, dn_offset, offset+fl),
+                    build_qual(t_index, dn_qual[:r_len][::-1]), 
+                    "NM:i:0", "NH:i:1" )
+        if strand == '+':
+            lines.append('\t'.join(
+                    (read_identifier, '99', chrm) + up_line) + "\n")
+            lines.append('\t'.join(
+                    (read_identifier, '147', chrm) + dn_line) + "\n")
+            positions.extend((up_start, dn_start))
+        else:
+            lines.append('\t'.join(
+                    (read_identifier, '83', chrm) + dn_line) + "\n")
+            lines.append('\t'.join(
+                    (read_identifier, '163', chrm) + up_line) + "\n")
+            positions.extend((dn_start, up_start))
+    
+    order = numpy.lexsort((numpy.arange(len(lines)), positions))
+    return [lines[i] for i in order]
+
+def build_sam_header( contig_lens ):
+    lines = ["@HD\tVN:1.0\tSO:coordinate\n",]
+    for contig, contig_len in sorted(contig_lens.iteritems()):
+        lines.append("@SQ\tSN:%s\tLN:%i\n" % (contig, contig_len))
+    return lines
+
+def simulate_contigs_reads( contigs, table, frag_counts, frag_id_offsets, 
+                            header, shards_dir, fl_dist, quals, single_end, 
+                            full_fragment, read_len, assay, seed ):
+    """Write the sorted reads from every contig in contigs into a bam shard.
+
+    """
+    for contig_index, contig, t_indices in contigs:
+        rng = numpy.random.RandomState(
+            None if seed == None else seed + contig_index + 1)
+        sam_fname = os.path.join(shards_dir, "%s.sam" % contig)
+        with open(sam_fname, "w") as sam_fp:
+            sam_fp.writelines( header )
+            for cluster in cluster_overlapping_transcripts(
+                    t_indices, table.transcripts):
+                sam_fp.writelines( build_cluster_sam_lines( 
+                        rng, table, numpy.array(cluster), frag_counts, 
+                        frag_id_offsets, fl_dist, quals, single_end, 
+                        full_fragment, read_len, assay ) )
+        pysam.view('-b', '-o', os.path.join(shards_dir, "%s.bam" % contig),
+                   sam_fname, catch_stdout=False)
+        os.remove(sam_fname)
+    return
+
+def simulate_reads_batched( genes, fl_dist, fasta, quals, num_frags, 
+                            single_end, full_fragment, read_len, 
+                            assay='RNAseq', num_threads=1, seed=None ):
+    """write a sorted, indexed BAM file with the specified options.
+
+    The fragments are drawn in bulk from each contig, in parallel, and the 
+    contigs' bam files are concatenated.
+    """
+    transcripts, transcript_weights, contig_lens = \
+        load_transcripts_and_weights( genes, fl_dist, fasta, assay )
+    table = TranscriptsTable(transcripts)
+
+    # choose the number of fragments drawn from each transcript. Note that 
+    # they should be chosen in proportion to the *expected number of reads*, 
+    # not their relative frequencies.
+    rng = numpy.random.RandomState(seed)
+    frag_counts = rng.multinomial(num_frags, transcript_weights)
+    frag_id_offsets = frag_counts.cumsum()
+    
+    contig_transcripts = defaultdict(list)
+    for t_index, transcript in enumerate(transcripts):
+        contig_transcripts[fix_chr_name(transcript.chrm)].append(t_index)
+    contigs = [ (i, contig, contig_transcripts[contig]) 
+                for i, contig in enumerate(sorted(contig_transcripts)) ]
+    costs = [ frag_counts[t_indices].sum() for i, contig, t_indices in contigs ]
+    
+    bam_fname = assay + ".sorted.bam"
+    shards_dir = tempfile.mkdtemp(prefix=assay + ".", dir=".")
+    try:
+        WorkStealingScheduler(contigs, costs, num_threads).run(
+            simulate_contigs_reads, 
+            [ table, frag_counts, frag_id_offsets, 
+              build_sam_header(contig_lens), shards_dir, fl_dist, quals, 
+              single_end, full_fragment, read_len, assay, seed ])
+        # the contigs are sorted in the header order, so the concatenated 
+        # shards are sorted
+        shard_fnames = [ os.path.join(shards_dir, "%s.bam" % contig)
+                         for i, contig, t_indices in contigs ]
+        if len(shard_fnames) == 1:
+            shutil.move(shard_fnames[0], bam_fname)
+        else:
+            pysam.cat('-o', bam_fname, *shard_fnames, catch_stdout=False)
+        pysam.index(bam_fname)
+    finally:
+        shutil.rmtree(shards_dir)
+    
+    return
+
 def build_objs( gtf_fp, fl_dist_const, 
                 fl_dist_norm, full_fragment,
                 read_len, fasta_fn, qual_fn ):
@@ -493,6 +842,14 @@ def parse_arguments():
     parser.add_argument( '--out_prefix', '-o', default='simulated_reads', \
                              help='Prefix for output FASTQ/BAM file ' + \
                              '(default: %(default)s)' )
+    parser.add_argument( '--batched', default=False, action='store_true',
+                         help='Draw the fragments in bulk, in parallel over ' +
+                         'the contigs.' )
+    parser.add_argument( '--threads', '-t', type=int, default=1,
+                         help='Number of threads to use with --batched ' +
+                         '(default: %(default)s)' )
+    parser.add_argument( '--seed', type=int, 
+                         help='Random seed for --batched.' )
     parser.add_argument( '--verbose', '-v', default=False, action='store_true', \
                              help='Print status information.' )
     
@@ -521,11 +878,13 @@ def parse_arguments():
     return ( args.gtf, args.fl_dist_const, args.fl_dist_norm, 
              args.fasta, args.quality, args.num_frags, 
              args.single_end, args.full_fragment, 
-             args.read_len, args.out_prefix, args.assay )
+             args.read_len, args.out_prefix, args.assay, 
+             args.batched, args.threads, args.seed )
 
 def main():
     ( gtf_fp, fl_dist_const, fl_dist_norm, fasta_fn, qual_fn, 
-      num_frags, single_end, full_fragment, read_len, out_prefix, assay )\
+      num_frags, single_end, full_fragment, read_len, out_prefix, assay, 
+      batched, num_threads, seed )\
         = parse_arguments()
     
     try: os.mkdir(out_prefix)
@@ -547,8 +906,14 @@ def main():
             print t.build_gtf_lines(gene.id, {})
     assert False
     """
-    simulate_reads( genes, fl_dist, fasta, quals, num_frags, single_end, 
-                    full_fragment, read_len, assay=assay )
+    if batched:
+        simulate_reads_batched( 
+            genes, fl_dist, fasta, quals, num_frags, single_end, 
+            full_fragment, read_len, assay=assay, 
+            num_threads=num_threads, seed=seed )
+    else:
+        simulate_reads( genes, fl_dist, fasta, quals, num_frags, single_end, 
+                        full_fragment, read_len, assay=assay )
 
 if __name__ == "__main__":
     main()
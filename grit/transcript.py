@@ -27,6 +27,7 @@ from collections import namedtuple, defaultdict
 
 import files.gtf
 import config
+from lib.profiling import add_to_counter
 
 GenomicInterval = namedtuple('GenomicInterval', 
                              ['chr', 'strand', 'start', 'stop'])
@@ -106,6 +107,11 @@ class Gene( object ):
             ofname = os.path.join(opdir, self.id + ".gene")
         with open(ofname, "w") as ofp:
             pickle.dump(self, ofp)
+            add_to_counter('bytes_pickled', ofp.tell())
+            # the transcripts checkpoint stores ofname, so make sure that 
+            # the file is on disk first
+            ofp.flush()
+            os.fsync(ofp.fileno())
         return ofname
     
     def find_transcribed_regions( self ):
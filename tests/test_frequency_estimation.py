@@ -0,0 +1,81 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Confidence bounds from the profile likelihood session.
+
+"""
+
+import unittest
+
+import numpy
+
+from grit.frequency_estimation import (
+    ConfidenceBoundsSession, estimate_transcript_frequencies,
+    MIN_TRANSCRIPT_FREQ )
+
+ALPHA = 0.025
+
+# the last bin can only be produced by the last transcript
+EXPECTED_ARRAY = numpy.array([[0.5, 0.3, 0.0],
+                              [0.5, 0.3, 0.2],
+                              [0.0, 0.4, 0.3],
+                              [0.0, 0.0, 0.5]])
+OBSERVED_ARRAY = numpy.array([50, 60, 40, 5])
+
+class TestConfidenceBoundsSession(unittest.TestCase):
+    def find_bounds(self, mle_estimate):
+        session = ConfidenceBoundsSession(
+            EXPECTED_ARRAY, OBSERVED_ARRAY, mle_estimate, ALPHA)
+        bounds = []
+        for index in xrange(EXPECTED_ARRAY.shape[1]):
+            (lb_p_value, lb), (ub_p_value, ub) = [
+                session.estimate_bound(index, bnd_type)
+                for bnd_type in ('lb', 'ub') ]
+            self.assertTrue(0 <= lb <= mle_estimate[index] <= ub <= 1,
+                            str((index, lb, ub)))
+            bounds.append(((lb_p_value, lb), (ub_p_value, ub)))
+        return bounds
+
+    def test_mle(self):
+        mle = estimate_transcript_frequencies(OBSERVED_ARRAY, EXPECTED_ARRAY)
+        for (lb_p_value, lb), (ub_p_value, ub) in self.find_bounds(mle):
+            self.assertTrue(0 < lb < ub < 1)
+            self.assertAlmostEqual(lb_p_value, ALPHA, places=3)
+            self.assertAlmostEqual(ub_p_value, ALPHA, places=3)
+
+    def test_clamped_mle(self):
+        # the transcript that is the only source of the last bin's reads
+        # has been clamped to MIN_TRANSCRIPT_FREQ
+        mle = estimate_transcript_frequencies(OBSERVED_ARRAY, EXPECTED_ARRAY)
+        clamped_mle = mle.copy()
+        clamped_mle[-1] = MIN_TRANSCRIPT_FREQ
+        clamped_mle /= clamped_mle.sum()
+        bounds = self.find_bounds(clamped_mle)
+        # the other transcripts' bounds aren't the trivial 0 and 1
+        for (lb_p_value, lb), (ub_p_value, ub) in bounds[:-1]:
+            self.assertTrue(0 < lb < ub < 1)
+            self.assertAlmostEqual(lb_p_value, ALPHA, places=3)
+            self.assertAlmostEqual(ub_p_value, ALPHA, places=3)
+        # and the clamped transcript's upper bound covers its real frequency
+        (lb_p_value, lb), (ub_p_value, ub) = bounds[-1]
+        self.assertTrue(mle[-1] < ub < 1)
+        self.assertAlmostEqual(ub_p_value, ALPHA, places=3)
+
+if __name__ == '__main__':
+    unittest.main()
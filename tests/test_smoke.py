@@ -0,0 +1,206 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""End to end smoke run of run_grit: elements, transcripts, quantification.
+
+A small paired, stranded RNAseq bam is simulated from a set of three exon
+genes, and run_grit is run on it in batch mode with the TSS and TES exons
+taken from the reference. There need to be enough genes in the reference for
+run_grit to infer the read strand.
+"""
+
+import os, sys
+import random
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+import pysam
+
+RUN_GRIT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "bin", "run_grit")
+
+CONTIG = 'chr1'
+NUM_GENES = 50
+GENE_SPACING = 5000
+CONTIG_LEN = NUM_GENES*GENE_SPACING
+EXONS = [(1001, 1500), (2001, 2500), (3001, 3500)]
+READ_LEN = 50
+NUM_FRAGMENTS_PER_GENE = 600
+
+def gene_exons(gene_i):
+    offset = gene_i*GENE_SPACING
+    return [ (start+offset, stop+offset) for start, stop in EXONS ]
+
+def write_reference(fname):
+    with open(fname, "w") as ofp:
+        for gene_i in xrange(NUM_GENES):
+            for start, stop in gene_exons(gene_i):
+                ofp.write("\t".join((
+                    CONTIG, 'smoke', 'exon', str(start), str(stop), '.', '+',
+                    '.', 'gene_id "G%i"; transcript_id "G%i.T1";' % (
+                        gene_i, gene_i))) + "\n")
+    return
+
+def map_read(exons, tx_start, read_len):
+    """Return the genome start and cigar of a read that starts at tx_start
+    on the transcript with exons exons.
+    """
+    cigar = []
+    read_start = None
+    pos = 0
+    remaining = read_len
+    for start, stop in exons:
+        exon_len = stop - start + 1
+        if remaining == read_len and tx_start >= pos + exon_len:
+            pos += exon_len
+            prev_stop = stop
+            continue
+        if read_start == None:
+            read_start = start - 1 + tx_start - pos
+        else:
+            cigar.append((3, start - prev_stop - 1))
+        offset = max(tx_start - pos, 0)
+        block_len = min(exon_len - offset, remaining)
+        cigar.append((0, block_len))
+        remaining -= block_len
+        pos += exon_len
+        prev_stop = stop
+        if remaining == 0: break
+    return read_start, cigar
+
+def write_reads(fname):
+    random.seed(0)
+    tx_len = sum(stop - start + 1 for start, stop in EXONS)
+    header = {'HD': {'VN': '1.0', 'SO':'coordinate'},
+              'SQ': [{'LN': CONTIG_LEN, 'SN': CONTIG}]}
+    reads = []
+    for i in xrange(NUM_GENES*NUM_FRAGMENTS_PER_GENE):
+        exons = gene_exons(i%NUM_GENES)
+        frag_len = random.randrange(150, 300)
+        frag_start = random.randrange(0, tx_len - frag_len)
+        # the first read in the pair is on the transcript's strand
+        mates = [map_read(exons, frag_start, READ_LEN),
+                 map_read(exons, frag_start + frag_len - READ_LEN, READ_LEN)]
+        for mate_i, (start, cigar) in enumerate(mates):
+            read = pysam.AlignedSegment()
+            read.query_name = "r%i" % i
+            read.query_sequence = "A"*READ_LEN
+            read.query_qualities = pysam.qualitystring_to_array("I"*READ_LEN)
+            read.reference_id = 0
+            read.reference_start = start
+            read.cigartuples = cigar
+            read.mapping_quality = 50
+            read.next_reference_id = 0
+            read.next_reference_start = mates[1-mate_i][0]
+            read.template_length = (
+                frag_len if mate_i == 0 else -frag_len)
+            read.flag = (1|2|64|32) if mate_i == 0 else (1|2|128|16)
+            read.set_tag('NH', 1)
+            reads.append(read)
+    reads.sort(key=lambda read: read.reference_start)
+    with pysam.AlignmentFile(fname, "wb", header=header) as ofp:
+        for read in reads: ofp.write(read)
+    pysam.index(fname)
+    return
+
+class TestRunGritSmoke(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bam_fname = os.path.join(self.tmp_dir, "reads.bam")
+        self.ref_fname = os.path.join(self.tmp_dir, "reference.gtf")
+        self.control_fname = os.path.join(self.tmp_dir, "control.txt")
+        self.output_dir = os.path.join(self.tmp_dir, "output")
+        write_reads(self.bam_fname)
+        write_reference(self.ref_fname)
+
+    def write_control(self, sample_types):
+        with open(self.control_fname, "w") as ofp:
+            for sample_type in sample_types:
+                ofp.write("\t".join((sample_type, "R1", "rnaseq", "true", 
+                                     "true", "forward", self.bam_fname)) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_grit(self, args=(), threads=1):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.join(os.path.dirname(RUN_GRIT), ".."),]
+            + [x for x in [env.get('PYTHONPATH'),] if x])
+        call = [sys.executable, RUN_GRIT,
+                '--control', self.control_fname,
+                '--reference', self.ref_fname,
+                '--use-reference-tss-exons', '--use-reference-tes-exons',
+                '--output-dir', self.output_dir,
+                '--batch-mode', '--threads', str(threads)] + list(args)
+        proc = subprocess.Popen(call, env=env, cwd=self.tmp_dir,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        self.assertEqual(proc.returncode, 0, output)
+        return output
+
+    def check_transcripts(self, gtf_fname):
+        with open(gtf_fname) as fp:
+            lines = [ line.split("\t") for line in fp
+                      if not line.startswith("track") ]
+        num_exons = sum(1 for line in lines if line[2] == 'exon')
+        self.assertEqual(num_exons, NUM_GENES*len(EXONS), gtf_fname)
+
+    def check_expression(self, sample_types):
+        expression_fnames = sorted(
+            fname for fname in os.listdir(self.output_dir)
+            if fname.endswith("expression_tracking") )
+        self.assertEqual(
+            expression_fnames, 
+            ["%s.R1.expression_tracking" % x for x in sorted(sample_types)])
+        for fname in expression_fnames:
+            with open(os.path.join(self.output_dir, fname)) as fp:
+                header = fp.readline().split()
+                records = [ dict(zip(header, line.split())) for line in fp ]
+            self.assertEqual(len(records), NUM_GENES)
+            # every transcript should have been quantified
+            for record in records:
+                self.assertTrue(float(record['FPKM']) > 0, str(record))
+
+    def test_build_and_quantify(self):
+        self.write_control(["S1",])
+        self.run_grit()
+        self.assertTrue(os.path.exists(
+            os.path.join(self.output_dir, "S1.elements.bed")))
+        self.check_transcripts(os.path.join(self.output_dir, "S1.gtf"))
+        self.check_transcripts(os.path.join(self.output_dir, "merged.gtf"))
+        self.check_expression(["S1",])
+
+    def test_stream_quantification(self):
+        # run two samples at once, so that the sample jobs are run in 
+        # forked processes
+        self.write_control(["S1", "S2"])
+        self.run_grit(['--stream-quantification', 
+                       '--max-concurrent-samples', '2'], threads=2)
+        for sample_type in ("S1", "S2"):
+            self.check_transcripts(
+                os.path.join(self.output_dir, "%s.gtf" % sample_type))
+        self.check_transcripts(os.path.join(self.output_dir, "merged.gtf"))
+        self.check_expression(["S1", "S2"])
+
+if __name__ == '__main__':
+    unittest.main()